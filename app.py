@@ -20,6 +20,8 @@ from num2words import num2words
 from PIL import Image
 from pathlib import Path
 import shutil
+import hashlib
+import hmac
 
 from packages.attr.validators import disabled
 
@@ -134,6 +136,15 @@ def consultar_dni_reniec(dni: str) -> Optional[Dict]:
     # Si todas las APIs fallaron, retorna None
     return None
 
+@st.cache_data(ttl=30*86400, show_spinner=False, max_entries=5000)
+def _cached_reniec(dni: str) -> Dict:
+    """consultar_dni_reniec con caché: repetir la búsqueda no gasta cuota de la API.
+    Si no hay datos lanza LookupError (los fallos no se guardan en caché)."""
+    datos = consultar_dni_reniec(dni)
+    if not datos:
+        raise LookupError(f"RENIEC: sin datos para {dni}")
+    return datos
+
 def obtener_departamentos() -> List[str]:
     """Obtiene lista de departamentos del Perú"""
     try:
@@ -334,6 +345,36 @@ def obtener_distritos(departamento: str, provincia: str) -> List[str]:
         traceback.print_exc()
         return []
 
+# Cachés UBIGEO compartidas por todas las sesiones (la API casi nunca cambia).
+# Una respuesta vacía (API caída) lanza LookupError para que no quede en caché.
+@st.cache_data(ttl=86400, show_spinner="Cargando departamentos...")
+def _deps() -> List[str]:
+    deps = obtener_departamentos()
+    if not deps:
+        raise LookupError("UBIGEO: sin departamentos")
+    return deps
+
+@st.cache_data(ttl=86400, show_spinner="Cargando provincias...", max_entries=30)
+def _provs(departamento: str) -> List[str]:
+    provs = obtener_provincias(departamento)
+    if not provs:
+        raise LookupError(f"UBIGEO: sin provincias para {departamento}")
+    return provs
+
+@st.cache_data(ttl=86400, show_spinner="Cargando distritos...", max_entries=400)
+def _dists(departamento: str, provincia: str) -> List[str]:
+    dists = obtener_distritos(departamento, provincia)
+    if not dists:
+        raise LookupError(f"UBIGEO: sin distritos para {departamento}/{provincia}")
+    return dists
+
+def _ubigeo(loader, *args) -> List[str]:
+    """Lista UBIGEO desde la caché global; [] si la API no respondió."""
+    try:
+        return loader(*args)
+    except LookupError:
+        return []
+
 # ====================================================================
 
 def inject_css():
@@ -508,25 +549,116 @@ os.makedirs(BASE_DIR, exist_ok=True)
 
 import threading
 import sqlite3
+import atexit
 
 DB_LOCK = threading.Lock()  # opcional, por si necesitas secciones críticas
 _correlativo_lock = threading.Lock()  # ← 🆕 AGREGAR ESTA LÍNEA
 
-def get_conn(timeout_sec: int = 10) -> sqlite3.Connection:
+class _SharedConnection(sqlite3.Connection):
     """
-    Abre conexión con PRAGMAs de concurrencia.
-    Cada operación abre/cierra su propia conexión.
+    Conexión única del proceso (ver _conn). Como la comparten todas las sesiones
+    de Streamlit, el uso se serializa con un RLock propio de la conexión.
     """
-    conn = sqlite3.connect(DB_PATH, timeout=timeout_sec, isolation_level=None)  # autocommit
-    conn.execute("PRAGMA journal_mode=WAL;")   # lecturas y escrituras concurrentes
-    conn.execute("PRAGMA synchronous=NORMAL;") # buen balance durabilidad/velocidad
-    conn.execute("PRAGMA busy_timeout=5000;")  # espera 5s si hay bloqueo
-    conn.execute("PRAGMA foreign_keys=ON;")    # por si usas FK ahora o después
+    OPTIMIZE_EVERY_SEC = 3600  # PRAGMA optimize periódico (conexión de larga vida)
+    ANALYSIS_LIMIT = 400       # filas muestreadas por índice en el ANALYZE automático
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.RLock()
+        self._last_optimize = time.monotonic()
+        self.permisos_rev = 0  # sube con cada escritura en permisos (ver _permisos_modificados)
+        self.busy_ms = None    # busy_timeout vigente (lo ajusta cada get_conn)
+
+    def optimize(self):
+        try:
+            self.execute("PRAGMA optimize;")  # acotado por analysis_limit (ver _conn)
+        except sqlite3.Error:
+            pass
+        self._last_optimize = time.monotonic()
+
+    def close(self):
+        # Recomendación de SQLite: PRAGMA optimize justo antes de cerrar
+        self.optimize()
+        super().close()
+
+@st.cache_resource(show_spinner=False)
+def _conn() -> _SharedConnection:
+    """Abre (una sola vez por proceso) la conexión SQLite con sus PRAGMAs."""
+    conn = sqlite3.connect(
+        DB_PATH, timeout=10, isolation_level=None,  # autocommit
+        check_same_thread=False, factory=_SharedConnection,
+        cached_statements=256,  # app + asistente superan las 128 sentencias por defecto
+    )
+    conn.row_factory = None                      # tuplas simples (sin sqlite3.Row)
+    conn.execute("PRAGMA journal_mode=WAL;")     # lecturas y escrituras concurrentes
+    conn.execute("PRAGMA synchronous=NORMAL;")   # buen balance durabilidad/velocidad
+    conn.execute("PRAGMA busy_timeout=5000;")    # espera 5s si hay bloqueo
+    conn.busy_ms = 5000
+    conn.execute("PRAGMA foreign_keys=ON;")      # por si usas FK ahora o después
+    conn.execute("PRAGMA temp_store=MEMORY;")    # tablas/índices temporales en RAM
+    conn.execute("PRAGMA mmap_size=268435456;")  # 256 MB mapeados: menos read()
+    conn.execute("PRAGMA cache_size=-64000;")    # ~64 MB de caché de páginas
+    conn.execute(f"PRAGMA analysis_limit={conn.ANALYSIS_LIMIT};")
+    conn.optimize()
+    atexit.register(conn.close)  # optimize + cierre al terminar el proceso
     return conn
 
+class _ConnHandle:
+    """
+    Context manager sobre la conexión compartida: toma el lock, aplica el
+    busy_timeout pedido, entrega la conexión y al salir confirma (o revierte)
+    la transacción abierta, si la hay.
+    """
+    def __init__(self, conn: _SharedConnection, busy_ms: int):
+        self._conn = conn
+        self._busy_ms = busy_ms
+
+    def __enter__(self) -> _SharedConnection:
+        conn = self._conn
+        conn.lock.acquire()
+        try:
+            if conn.busy_ms != self._busy_ms:  # solo cambia el PRAGMA si otro uso pidió otro valor
+                conn.execute(f"PRAGMA busy_timeout={self._busy_ms};")
+                conn.busy_ms = self._busy_ms
+        except BaseException:
+            conn.lock.release()
+            raise
+        return conn
+
+    def __exit__(self, exc_type, exc, tb):
+        conn = self._conn
+        try:
+            if conn.in_transaction:
+                if exc_type is None:
+                    conn.commit()
+                else:
+                    conn.rollback()
+            if time.monotonic() - conn._last_optimize > conn.OPTIMIZE_EVERY_SEC:
+                conn.optimize()
+        finally:
+            conn.lock.release()
+        return False
+
+def get_conn(timeout_sec: int = 10) -> _ConnHandle:
+    """
+    Devuelve la conexión compartida para usar con 'with get_conn() as conn:'.
+    'timeout_sec' es cuánto espera SQLite si otro proceso (p. ej. backup_db.py) tiene la BD bloqueada.
+    """
+    return _ConnHandle(_conn(), int(timeout_sec * 1000))
+
+def _permisos_modificados():
+    """Registra un cambio en la tabla permisos: invalida las respuestas cacheadas del asistente."""
+    _conn().permisos_rev += 1
+
 def init_db():
     """Crea la BD y tablas si no existen."""
     with get_conn(timeout_sec=10) as conn:
+        # auto_vacuum=INCREMENTAL (2): solo se aplica a una BD nueva o tras un VACUUM,
+        # por eso se hace una única vez cuando la BD aún está en modo 0 (NONE).
+        if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            conn.execute("VACUUM;")
+
         conn.execute("""
         CREATE TABLE IF NOT EXISTS correlativos (
             anio INTEGER NOT NULL PRIMARY KEY,
@@ -658,6 +790,19 @@ def init_db():
             conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_doc_ocultos_unique ON doc_ocultos(rol, doc_num)")
         except Exception:
             pass
+
+        # Bitácora del asistente (ver _log_q)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS asistente_logs(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT DEFAULT CURRENT_TIMESTAMP,
+            pregunta TEXT, respuesta TEXT, filas INTEGER
+        )
+        """)
+
+        # Estadísticas iniciales para que el planificador use los índices (una sola vez)
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone():
+            conn.execute("ANALYZE;")
         
 def migrate_db():
     """Agrega columnas nuevas si aún no existen."""
@@ -712,10 +857,80 @@ def migrate_db():
         conn.execute("""
             UPDATE permisos
             SET updated_at = COALESCE(updated_at, fecha_registro)
-            WHERE updated_at IS NULL OR updated_at = ''          
-         """)        
+            WHERE updated_at IS NULL OR updated_at = ''
+         """)
+
+        # Índices de expresión para las consultas del asistente (_h_*): deben escribirse
+        # igual que en el WHERE/ORDER BY para que SQLite los use. (anio, numero) ya está
+        # cubierto por UNIQUE(anio, numero).
+        try:
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_perm_fecha ON permisos(date(fecha_registro))")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_perm_tipo_fecha ON permisos(UPPER(tipo_viaje), date(fecha_registro))")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_perm_estado_u ON permisos(UPPER(COALESCE(estado,'')))")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_perm_destino_u ON permisos(UPPER(destino))")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_perm_anio_desc_num ON permisos(anio DESC, numero ASC)")
+            conn.execute("""CREATE INDEX IF NOT EXISTS idx_perm_ultimos
+                            ON permisos(COALESCE(datetime(updated_at), datetime(fecha_registro)) DESC, id DESC)""")
+        except Exception:
+            pass
+
+        # Columnas generadas (VIRTUAL: ALTER TABLE no admite STORED) que concatenan los tres
+        # documentos / nombres: el LIKE de respaldo del asistente evalúa una sola expresión.
+        try:
+            xcols = {r[1] for r in conn.execute("PRAGMA table_xinfo(permisos)").fetchall()}
+            if "docs_all" not in xcols:
+                conn.execute("""ALTER TABLE permisos ADD COLUMN docs_all TEXT GENERATED ALWAYS AS (
+                                    UPPER(COALESCE(menor_doc_num, menor_dni, '') || '|' ||
+                                          COALESCE(padre_doc_num, padre_dni, '') || '|' ||
+                                          COALESCE(madre_doc_num, madre_dni, ''))) VIRTUAL""")
+            if "nombres_all" not in xcols:
+                conn.execute("""ALTER TABLE permisos ADD COLUMN nombres_all TEXT GENERATED ALWAYS AS (
+                                    UPPER(COALESCE(menor_nombre, '') || '|' ||
+                                          COALESCE(padre_nombre, '') || '|' ||
+                                          COALESCE(madre_nombre, ''))) VIRTUAL""")
+        except Exception:
+            pass
+
+        # Índice de texto (FTS5 trigram) para búsquedas "contiene" de nombres, destino y
+        # documentos: un LIKE '%x%' no puede usar índices B-tree. Se sincroniza por triggers.
+        # Si el SQLite del sistema no trae FTS5/trigram, el asistente sigue con LIKE.
+        try:
+            existia = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='permisos_fts'"
+            ).fetchone()
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS permisos_fts USING fts5(
+                    menor_nombre, padre_nombre, madre_nombre, destino,
+                    menor_doc, padre_doc, madre_doc,
+                    tokenize='trigram'
+                )""")
+            _fts_cols = "rowid, menor_nombre, padre_nombre, madre_nombre, destino, menor_doc, padre_doc, madre_doc"
+            _fts_vals = ("{p}.id, {p}.menor_nombre, {p}.padre_nombre, {p}.madre_nombre, {p}.destino, "
+                         "COALESCE({p}.menor_doc_num, {p}.menor_dni, ''), "
+                         "COALESCE({p}.padre_doc_num, {p}.padre_dni, ''), "
+                         "COALESCE({p}.madre_doc_num, {p}.madre_dni, '')")
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS permisos_fts_ai AFTER INSERT ON permisos BEGIN
+                    INSERT INTO permisos_fts({_fts_cols}) VALUES ({_fts_vals.format(p="new")});
+                END""")
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS permisos_fts_au AFTER UPDATE ON permisos BEGIN
+                    DELETE FROM permisos_fts WHERE rowid = old.id;
+                    INSERT INTO permisos_fts({_fts_cols}) VALUES ({_fts_vals.format(p="new")});
+                END""")
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS permisos_fts_ad AFTER DELETE ON permisos BEGIN
+                    DELETE FROM permisos_fts WHERE rowid = old.id;
+                END""")
+            if not existia:
+                conn.execute(f"INSERT INTO permisos_fts({_fts_cols}) SELECT {_fts_vals.format(p='permisos')} FROM permisos")
+        except Exception:
+            pass
         conn.commit()
 
+# Texto SQL fijo: el caché de sentencias de sqlite3 reutiliza el plan entre reruns
+_SQL_CORREL_NUMERO = "SELECT numero FROM correlativos WHERE anio = ?"
+
 def get_next_correlativo(anio: int) -> int:
     """
     Obtiene el siguiente correlativo para un año dado.
@@ -738,8 +953,7 @@ def get_next_correlativo(anio: int) -> int:
     with _correlativo_lock:
         with get_conn(timeout_sec=10) as conn:
             conn.execute("BEGIN IMMEDIATE")
-            cur = conn.execute("SELECT numero FROM correlativos WHERE anio = ?", (anio,))
-            row = cur.fetchone()
+            row = conn.execute(_SQL_CORREL_NUMERO, (anio,)).fetchone()
             if row is None:
                 numero = 1
                 conn.execute("INSERT INTO correlativos(anio, numero) VALUES (?, ?)", (anio, numero))
@@ -750,7 +964,15 @@ def get_next_correlativo(anio: int) -> int:
             
             # Log para auditoría
             logger.info(f"✅ Correlativo generado: {numero:04d}-NSC-{anio}")
-            return numero
+    _get_correl.clear()
+    return numero
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _get_correl(anio: int) -> int | None:
+    """Último correlativo usado en el año (cacheado; se invalida al cambiarlo)."""
+    with get_conn() as conn:
+        (numero,) = conn.execute(_SQL_CORREL_NUMERO, (anio,)).fetchone() or (None,)
+    return numero
 
 def save_permiso_registro(data: dict) -> None:
     """Inserta un registro de permiso emitido en la BD (columnas=valores 1:1)."""
@@ -797,6 +1019,8 @@ def save_permiso_registro(data: dict) -> None:
     with get_conn(timeout_sec=10) as conn:
         conn.execute(sql, values)
         conn.commit()
+    _cached_local_lookup.clear()
+    _permisos_modificados()
 
 def fetch_permisos(anio: int | None = None):
     q = ("SELECT id, anio, numero, nsc, fecha_registro, ciudad, notario, "
@@ -877,6 +1101,8 @@ def update_permiso(pid: int, data: dict):
     with get_conn() as conn:
         conn.execute(f"UPDATE permisos SET {set_clause} WHERE id = ?", values)
         conn.commit()
+    _cached_local_lookup.clear()
+    _permisos_modificados()
         
         
 def _norm_doc(x: str) -> str:
@@ -913,7 +1139,10 @@ def propagar_cambio_doc(rol: str, old_doc: str, new_doc: str) -> int:
                 WHERE REPLACE(menor_doc_num, ' ', '') = ? OR REPLACE(menor_dni, ' ', '') = ?
             """, (new_doc, new_doc, old_doc, old_doc))
         conn.commit()
-        return cur.rowcount
+        filas = cur.rowcount
+    _cached_local_lookup.clear()
+    _permisos_modificados()
+    return filas
 
 def _update_hermano_doc_json(old_doc: str, new_doc: str) -> int:
     """
@@ -927,8 +1156,9 @@ def _update_hermano_doc_json(old_doc: str, new_doc: str) -> int:
         return 0
 
     import json
-    afectados = 0
+    cambios = []
     with get_conn(timeout_sec=10) as conn:
+        conn.execute("BEGIN IMMEDIATE")  # un solo lock/flush para todas las filas
         cur = conn.execute("SELECT id, hermanos_json FROM permisos WHERE COALESCE(hermanos_json,'') <> ''")
         rows = cur.fetchall()
         for pid, hjson in rows:
@@ -948,13 +1178,16 @@ def _update_hermano_doc_json(old_doc: str, new_doc: str) -> int:
                     changed = True
 
             if changed:
-                conn.execute(
-                    "UPDATE permisos SET hermanos_json=?, updated_at=CURRENT_TIMESTAMP WHERE id=?",
-                    (json.dumps(arr, ensure_ascii=False), int(pid))
-                )
-                afectados += 1
+                cambios.append((_json_col(arr), int(pid)))
+
+        conn.executemany(
+            "UPDATE permisos SET hermanos_json=?, updated_at=CURRENT_TIMESTAMP WHERE id=?",
+            cambios
+        )
         conn.commit()
-    return afectados
+    if cambios:
+        _permisos_modificados()
+    return len(cambios)
 
    
 def admin_actualizar_doc(rol: str, old_doc: str, new_doc: str, mover_oculto: bool = True) -> tuple[bool, str, int]:
@@ -1015,6 +1248,9 @@ def admin_actualizar_doc(rol: str, old_doc: str, new_doc: str, mover_oculto: boo
             # No hay columnas directas; actualizamos dentro del JSON de hermanos en TODOS los permisos
             filas = _update_hermano_doc_json(old_doc_n, new_doc_n)
 
+        _cached_local_lookup.clear()
+        _permisos_modificados()
+
         # Mover estado "oculto" si corresponde (si llevas esa bitácora por (rol, doc))
         if mover_oculto:
             try:
@@ -1077,17 +1313,14 @@ def backup_sqlite_y_emitidos(retention_days: int = 60) -> list[str]:
     out_paths = []
 
     # 1️⃣ Copia segura de la base de datos
-    src = get_conn(timeout_sec=30)
-    try:
-        dst_path = os.path.join(BACKUP_DIR, f"permisos_{ts}.db")
+    dst_path = os.path.join(BACKUP_DIR, f"permisos_{ts}.db")
+    with get_conn(timeout_sec=30) as src:
         dst = sqlite3.connect(dst_path)
         try:
             src.backup(dst)
         finally:
             dst.close()
-        out_paths.append(dst_path)
-    finally:
-        src.close()
+    out_paths.append(dst_path)
 
     # 2️⃣ Comprimir carpeta "emitidos"
     emitidos_dir = os.path.join(BASE_DIR, "emitidos")
@@ -1437,6 +1670,48 @@ def _fecha_ddmmyyyy(iso_ymd: str) -> str:
 def s(x: str | None) -> str:
     return (x or "").strip()
 
+# JSON de columnas (hermanos_json, rec_list_json, terceros_json): orjson si está, si no json estándar.
+# Ambos dejan los acentos tal cual (UTF-8); orjson además sin espacios tras ':' y ','.
+try:
+    import orjson
+
+    def _json_col(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+except Exception:
+    def _json_col(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+def _norm_up(x: str | None) -> str:
+    """s(x).upper(): normaliza el texto de los campos del formulario."""
+    return s(x).upper()
+
+@st.cache_resource(show_spinner=False)
+def _opt_index_cache() -> dict:
+    """Mapas opción→índice compartidos entre reruns y sesiones.
+    (Un lru_cache a nivel de módulo se pierde: Streamlit re-ejecuta app.py en cada rerun.)"""
+    return {}
+
+def _opt_index_map(opts: tuple[str, ...]) -> dict[str, int]:
+    cache = _opt_index_cache()
+    idx = cache.get(opts)
+    if idx is None:
+        if len(cache) >= 256:  # listas UBIGEO: acota la memoria
+            cache.clear()
+        idx = {}
+        for i, o in enumerate(opts):
+            idx.setdefault(o, i)  # igual que list.index: primera aparición
+        cache[opts] = idx
+    return idx
+
+def _upper_cb(key: str) -> None:
+    """on_change de text_input: deja el valor del widget en mayúsculas dentro de session_state."""
+    st.session_state[key] = _norm_up(st.session_state.get(key))
+
+def safe_index(options: list[str], value: str | None, default_idx: int = 0) -> int:
+    """Nunca lanza ValueError (si value es '', None o inválido, devuelve default_idx)."""
+    v = (value or "").strip().upper()
+    return _opt_index_map(tuple(options)).get(v, default_idx)
+
 def fecha_iso_a_letras(fecha_iso: str) -> str:
     if not fecha_iso:
         return ""
@@ -1463,13 +1738,21 @@ def _date_from_iso_like(x: str | None) -> date:
 def calcular_edad(fecha_nac_iso: str, hoy: date | None = None) -> int:
     if not fecha_nac_iso:
         return 0
-    d = datetime.strptime(fecha_nac_iso, "%Y-%m-%d").date()
+    return _edad_desde_date(datetime.strptime(fecha_nac_iso, "%Y-%m-%d").date(), hoy)
+
+def _edad_desde_date(d: date, hoy: date | None = None) -> int:
     hoy = hoy or date.today()
     return hoy.year - d.year - ((hoy.month, hoy.day) < (d.month, d.day))
 
 def edad_en_letras(n: int) -> str:
     return num2words(n, lang="es").upper()
 
+@st.cache_data(show_spinner=False, max_entries=256)
+def _edad_cached(d: date, hoy: date) -> tuple[int, str]:
+    """(edad, edad en letras) para el formulario; 'hoy' va en la clave para no arrastrar edades de otro día."""
+    n = _edad_desde_date(d, hoy)
+    return n, edad_en_letras(n)
+
 
 def parse_iso(x: str | None):
     """Devuelve date si x='YYYY-MM-DD', si no, None."""
@@ -1493,6 +1776,22 @@ def canon_doc(t: str) -> str:
     t = (t or "").strip().upper()
     return _DOC_CANON.get(t, "DNI")
 
+# Opciones fijas del formulario (sección 5: vías; sección 6: acompañante y recepción al arribo)
+_VIAS_PERMITIDAS = ("TERRESTRE", "AÉREA")
+_VIAS_SET = frozenset(_VIAS_PERMITIDAS)
+_ACOMP_OPCIONES = ("PADRE", "MADRE", "AMBOS", "TERCERO", "SOLO(A)/SOLOS(AS)")
+_ACOMP_SOLO_IDX = _ACOMP_OPCIONES.index("SOLO(A)/SOLOS(AS)")
+# valor guardado → índice del radio ("SOLO" = rótulo de permisos antiguos)
+_ACOMP_IDX = {**{o: i for i, o in enumerate(_ACOMP_OPCIONES)}, "SOLO": _ACOMP_SOLO_IDX}
+_REC_DOC_TIPOS = ("DNI PERUANO", "DNI EXTRANJERO", "PASAPORTE")
+_REC_DOC_TIPO_IDX = {v: i for i, v in enumerate(_REC_DOC_TIPOS)}
+_REC_CAMPOS = ("rec_nombre", "rec_doc_tipo", "rec_doc_num", "rec_doc_pais")  # filas: f"{campo}_{i}"
+_REC_PREFIXES = tuple(f"{c}_" for c in _REC_CAMPOS)
+_TERCERO_CAMPOS = ("tercero_rol", "tercero_nombre", "tercero_dni")  # filas: f"{campo}_{i}"
+
+# Rótulo del Nº de documento en los formularios (clave = tipo canónico)
+_DOC_LABEL = {"DNI": "DNI", "PASAPORTE": "Pasaporte", "DNI_EXTRANJERO": "DNI Extranjero"}
+
 def doc_label(t: str) -> str:
     ct = canon_doc(t)
     if ct == "DNI":             return "DNI"
@@ -1533,6 +1832,9 @@ def _recep_items_from_state() -> list[dict]:
             rec_list.append({"nombre": nom, "tipo": tipo, "num": num, "pais": pais})
     return rec_list
 
+# Plantilla base de OBS cuando el/los menor(es) viajan solos (usa claves de 'ac')
+_SOLO_TMPL = "SE DEJA CONSTANCIA QUE {ART} {SUST} {VERB_VIAJAR} {ADJ_SOLO}."
+
 def _obs_con_recepcion_plural(ac: dict, rec_list: list[dict]) -> str:
     """
     Construye: '... Y QUE A SU ARRIBO SERÁ(N) RECOGIDO(S)/A(S) POR X, DOC; Y/O POR Y, DOC.'
@@ -1554,7 +1856,8 @@ def _clear_form_keys_for_new():
     para que '➕ Nuevo permiso' no herede valores de '✏ Editar / Re-generar'.
     """
     # Prefijos habituales de tus widgets (padre, madre, menor, viaje, etc.)
-    prefixes = [
+    # (tupla: str.startswith la recorre en C de una sola vez)
+    prefixes = (
         # padre/madre/menor
         "padre_", "madre_", "menor_",
         # campos simples
@@ -1573,7 +1876,7 @@ def _clear_form_keys_for_new():
         # banderas internas que podrían reinyectar datos
         "_prefill_hermanos_pid", "pid_editing", "modo_edicion",
         "_did_clear_padre", "_did_clear_madre"
-    ]
+    )
 
     # Palabras clave por si algún widget tiene key "libre"
     substrings_anywhere = [
@@ -1613,33 +1916,20 @@ def _clear_form_keys_for_new():
     
     for k in ubigeo_keys:
         st.session_state.pop(k, None)
-    
-    # Limpia cachés de provincias/distritos
-    keys_to_remove = [k for k in st.session_state.keys() 
-                      if k.startswith("provincias_") or k.startswith("distritos_")]
-    for k in keys_to_remove:
-        st.session_state.pop(k, None)
+
     # ========================================================================
     # FIN DEL BLOQUE NUEVO
     # ========================================================================
 
-    to_delete = set()
-    # Recorre todas las claves (case-insensitive para prefijos/substrings)
+    # Una sola pasada sobre las claves (case-insensitive para prefijos/substrings)
+    to_delete = []
     for k in list(st.session_state.keys()):
         kl = k.lower()
+        if k in explicit_keys or kl.startswith(prefixes) or any(sub in kl for sub in substrings_anywhere):
+            to_delete.append(k)
 
-        if k in explicit_keys:
-            to_delete.add(k); continue
-
-        if any(kl.startswith(p) for p in prefixes):
-            to_delete.add(k); continue
-
-        if any(sub in kl for sub in substrings_anywhere):
-            to_delete.add(k); continue
-
-    # Borra sin error si no existe
     for k in to_delete:
-        st.session_state.pop(k, None)
+        del st.session_state[k]
         
 # --- Callbacks para limpiar buscadores/fields ---
 def _limpiar_padre_cb():
@@ -1712,6 +2002,96 @@ def _limpiar_menor_cb():
     st.session_state["hermanos"] = []
 
 
+def _purge_rec_keys(ss) -> None:
+    """Recepción al arribo: borra las filas rec_*_i y los campos simples rec_* (compat),
+    y deja el contador en 0. Una sola pasada sobre session_state."""
+    ss["rec_list_count"] = 0
+    for k in [k for k in ss.keys() if k in _REC_CAMPOS or k.startswith(_REC_PREFIXES)]:
+        del ss[k]
+
+# Agregar/quitar filas dinámicas: como on_click se aplican antes del rerun que
+# provoca el propio botón (sin un st.rerun() extra que redibuje todo otra vez)
+def _agregar_hermano_cb():
+    # (El dict aquí es solo un slot visual; los valores reales viven en session_state)
+    st.session_state.hermanos.append({"nombre": "", "dni": "", "fnac": None})
+
+def _agregar_tercero_cb():
+    st.session_state.terceros.append({})
+
+def _agregar_rec_cb():
+    st.session_state["rec_list_count"] += 1
+
+def _quitar_rec_cb():
+    ss = st.session_state
+    ss["rec_list_count"] -= 1
+    # limpia claves de la última fila
+    i = ss["rec_list_count"]
+    for kk in (f"{c}_{i}" for c in _REC_CAMPOS):
+        ss.pop(kk, None)
+
+def _eliminar_tercero_cb(i: int):
+    """Quita el tercero i y corre una posición las keys de los siguientes
+    (si no, el tercero i+1 quedaría mostrando los datos del eliminado)."""
+    ss = st.session_state
+    ss.terceros.pop(i)
+    n = len(ss.terceros)
+    for j in range(i, n):
+        for campo in _TERCERO_CAMPOS:
+            ss[f"{campo}_{j}"] = ss.pop(f"{campo}_{j+1}", "")
+    for campo in _TERCERO_CAMPOS:  # la última fila quedó huérfana
+        ss.pop(f"{campo}_{n}", None)
+
+
+# 🔧 Callbacks de widgets PADRE/MADRE/MENOR (rol = "padre" | "madre" | "menor")
+def _on_change_doc_tipo(rol: str):
+    """Con DNI la nacionalidad no aplica: se limpia."""
+    if canon_doc(st.session_state.get(f"{rol}_doc_tipo")) == "DNI":
+        st.session_state[f"{rol}_nacionalidad"] = ""
+
+def _on_change_depto(rol: str):
+    """Cuando cambia el departamento, limpia provincia y distrito"""
+    st.session_state.pop(f"{rol}_provincia_sel", None)
+    st.session_state.pop(f"{rol}_distrito_sel", None)
+
+def _on_change_prov(rol: str):
+    """Cuando cambia la provincia, limpia distrito"""
+    st.session_state.pop(f"{rol}_distrito_sel", None)
+
+
+# Niveles de la cascada UBIGEO: (campo, rótulo, loader cacheado, callback on_change)
+_UBIGEO_NIVELES = (
+    ("departamento", "Departamento", _deps,  _on_change_depto),
+    ("provincia",    "Provincia",    _provs, _on_change_prov),
+    ("distrito",     "Distrito",     _dists, None),
+)
+
+@st.fragment
+def _ubigeo_cascada(rol: str, valores: dict, disabled: bool, pid_suffix: str = "") -> tuple[str, str, str]:
+    """Selectores Departamento/Provincia/Distrito en cascada para PADRE o MADRE.
+    Al ser fragmento, elegir un valor solo re-ejecuta estos tres selectbox y no
+    todo el formulario; devuelve (departamento, provincia, distrito) en la corrida completa."""
+    elegidos: list[str] = []
+    for col, (campo, rotulo, loader, cb) in zip(st.columns(3), _UBIGEO_NIVELES):
+        with col:
+            if all(elegidos):
+                # Carga las opciones del nivel según lo elegido en los niveles anteriores
+                opts = [""] + _ubigeo(loader, *elegidos)
+                valor = st.selectbox(
+                    rotulo,
+                    options=opts,
+                    index=safe_index(opts, valores.get(f"{rol}_{campo}")),
+                    disabled=disabled,
+                    key=f"{rol}_{campo}_sel{pid_suffix}",  # 🔥 KEY DINÁMICA
+                    on_change=cb, args=(rol,) if cb else None,
+                )
+            else:
+                valor = st.selectbox(rotulo, [""], key=f"{rol}_{campo}_sel_empty{pid_suffix}", disabled=True)
+        elegidos.append(valor)
+
+    departamento, provincia, distrito = elegidos
+    return departamento, provincia, distrito
+
+
 def _clear_lookup_buffers():
     """Limpia todo lo relacionado a buscadores y prefills (PADRE/MADRE/MENOR)."""
     for k in (
@@ -1848,21 +2228,48 @@ def _doc_firma_adulto(tipo: str, num: str) -> str:
     return f"DNI N° {num}"
 
 # --------- Render DOCX ----------
+# DocxTemplate no se comparte entre renders: render() modifica el documento y las sesiones
+# son concurrentes. Lo reutilizable es el contenido del .docx (por mtime) y el entorno Jinja.
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _plantilla_bytes(plantilla_path: str, mtime: float) -> bytes:
+    with open(plantilla_path, "rb") as f:
+        return f.read()
+
+@st.cache_resource(show_spinner=False)
+def _jinja_env():
+    from jinja2 import Environment  # dependencia de docxtpl
+    return Environment(autoescape=False)
+
+def _nueva_plantilla(plantilla_path: str) -> DocxTemplate:
+    data = _plantilla_bytes(plantilla_path, os.path.getmtime(plantilla_path))
+    return DocxTemplate(BytesIO(data))
+
 def render_docx(plantilla_path: str, ctx: dict) -> bytes:
-    doc = DocxTemplate(plantilla_path)
-    doc.render(ctx)
+    doc = _nueva_plantilla(plantilla_path)
+    doc.render(ctx, jinja_env=_jinja_env())
     bio = BytesIO()
     doc.save(bio)
-    bio.seek(0)
-    return bio.read()
+    return bio.getvalue()
 
-def verificar_plantilla(plantilla_path: str, ctx: dict) -> set[str]:
-    doc = DocxTemplate(plantilla_path)
+# Espacio libre del disco de emitidos: cambia poco entre permisos seguidos, se consulta 1 vez por minuto
+@st.cache_data(ttl=60, show_spinner=False)
+def _disco_libre_mb(directorio: str) -> float:
+    return shutil.disk_usage(directorio).free / (1024 * 1024)
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _variables_plantilla(plantilla_path: str, mtime: float) -> frozenset:
+    """Variables Jinja que usa la plantilla (se parsea una vez por versión del archivo)."""
     try:
-        faltantes = doc.get_undeclared_template_variables(ctx)
-        return set(faltantes) if faltantes else set()
+        return frozenset(_nueva_plantilla(plantilla_path).get_undeclared_template_variables() or ())
     except Exception:
+        return frozenset()
+
+def verificar_plantilla(plantilla_path: str, ctx: dict) -> set[str]:
+    try:
+        usadas = _variables_plantilla(plantilla_path, os.path.getmtime(plantilla_path))
+    except OSError:
         return set()
+    return set(usadas - ctx.keys())
 
 def parse_iso(d: str | None) -> date | None:
     d = s(d)
@@ -1888,33 +2295,23 @@ def search_por_doc_y_rol(doc: str, rol: str) -> dict | None:
         return None
 
     rol = (rol or "").upper()
-    if rol == "PADRE":
-        sql = """
-        SELECT * FROM permisos
-        WHERE padre_doc_num = ? OR padre_dni = ?
-        ORDER BY COALESCE(datetime(updated_at), datetime(fecha_registro)) DESC, id DESC
-        LIMIT 1
-        """
-        params = (doc, doc)
-    elif rol == "MADRE":
-        sql = """
-        SELECT * FROM permisos
-        WHERE madre_doc_num = ? OR madre_dni = ?
-        ORDER BY COALESCE(datetime(updated_at), datetime(fecha_registro)) DESC, id DESC
-        LIMIT 1
-        """
-        params = (doc, doc)
-    elif rol == "MENOR":
-        sql = """
-        SELECT * FROM permisos
-        WHERE menor_doc_num = ? OR menor_dni = ?
-        ORDER BY COALESCE(datetime(updated_at), datetime(fecha_registro)) DESC, id DESC
-        LIMIT 1
-        """
-        params = (doc, doc)
-    else:
+    if rol not in ("PADRE", "MADRE", "MENOR"):
         return None
 
+    # UNION ALL: cada rama usa su propio índice (idx_perm_<rol>_doc_num / _dni)
+    # en lugar de un OR que puede terminar en escaneo completo.
+    pref = rol.lower()
+    sql = f"""
+    SELECT * FROM (
+        SELECT * FROM permisos WHERE {pref}_doc_num = ?
+        UNION ALL
+        SELECT * FROM permisos WHERE {pref}_dni = ?
+    )
+    ORDER BY COALESCE(datetime(updated_at), datetime(fecha_registro)) DESC, id DESC
+    LIMIT 1
+    """
+    params = (doc, doc)
+
     with get_conn() as conn:
         cur = conn.execute(sql, params)
         row = cur.fetchone()
@@ -1922,6 +2319,11 @@ def search_por_doc_y_rol(doc: str, rol: str) -> dict | None:
             return None
         return _dict_from_row(cur, row)
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_local_lookup(doc: str, rol: str) -> dict | None:
+    """search_por_doc_y_rol con caché (se limpia al guardar/actualizar permisos)."""
+    return search_por_doc_y_rol(doc, rol)
+
 def save_agenda(asunto: str, nota: str, vinculo_doc: str = "", creado_por: str = ""):
     fnow = datetime.now().isoformat(timespec="seconds")
     with get_conn(timeout_sec=10) as conn:
@@ -2402,6 +2804,36 @@ def _obs_terceros_multiples(terceros_list: list[dict], ac: dict) -> str:
         f"{quien_txt} DEL CUIDADO DE {ac['ART']} {ac['SUST']} DURANTE SU ESTADÍA EN LA CIUDAD."
     )
 
+# Viajan con sus padres: acompañante → (posesivo, rol, campo del nombre, campos del documento, nº de responsables)
+_ACOMP_PADRES = {
+    "PADRE": ("SU", "PADRE", "padre_nombre", ("padre_doc_num", "padre_dni"), 1),
+    "MADRE": ("SU", "MADRE", "madre_nombre", ("madre_doc_num", "madre_dni"), 1),
+    "AMBOS": ("SUS", "PADRES", None, (), 2),
+}
+_ACOMP_PADRES_OTRO = ("SU", "", None, (), 0)
+_ACOMP_TMPL = (
+    "SE DEJA CONSTANCIA QUE {ART} {SUST} {VERB_VIAJAR} {COMP_TX}; "
+    "{QUIEN_TX} DEL CUIDADO DE {ART} {SUST} DURANTE SU ESTADÍA EN LA CIUDAD."
+)
+
+def _obs_con_padres(v: dict, acomp: str, ac: dict, acomp_n: int | None = None) -> str:
+    """
+    OBS_TX cuando viajan con PADRE/MADRE/AMBOS.
+    'v' es el dict del formulario (vals) o la fila del permiso; 'acomp_n' sobreescribe el nº de la tabla.
+    """
+    posesivo, rol_txt, campo_nom, campos_doc, n = _ACOMP_PADRES.get(acomp, _ACOMP_PADRES_OTRO)
+    comp_tx = f"EN COMPAÑÍA DE {posesivo} {rol_txt}"
+    nombre = s(v.get(campo_nom, "")).upper() if campo_nom else ""
+    if nombre:
+        comp_tx += f" {nombre}"
+    doc = next(filter(None, (s(v.get(c)) for c in campos_doc)), "")
+    if doc:
+        comp_tx += f", CON DOCUMENTO N° {doc}"
+    if acomp_n is not None:
+        n = acomp_n
+    quien_txt = "QUIENES SERÁN RESPONSABLES" if n >= 2 else "QUIEN SERÁ RESPONSABLE"
+    return _ACOMP_TMPL.format_map({**ac, "COMP_TX": comp_tx, "QUIEN_TX": quien_txt})
+
 def _doc_tx(tipo: str, num: str) -> str:
     t = (tipo or "").strip().upper()
     n = (num or "").strip()
@@ -2413,6 +2845,60 @@ def _doc_tx(tipo: str, num: str) -> str:
         return f"CON CARNET DE EXTRANJERÍA N° {n}"
     return f"CUYO DOCUMENTO NACIONAL DE IDENTIDAD ES N° {n}"
 
+def _leer_hermanos_ui() -> tuple[list[dict], list[str]]:
+    """
+    Lee los hermanos desde session_state en UNA pasada (sin crear inputs).
+    Devuelve (hermanos con nombre, ya normalizados para BD/DOCX; sexo de TODAS las filas).
+    """
+    ss = st.session_state
+    hermanos_list, hermanos_sex = [], []
+    for i in range(len(ss.get("hermanos", []))):
+        hermanos_sex.append(s(ss.get(f"hermano_sexo_{i}", "")).upper())
+        h_nom = s(ss.get(f"hermano_nombre_{i}", ""))
+        if not h_nom:
+            continue
+
+        h_tipo = (ss.get(f"hermano_doc_tipo_{i}", "DNI") or "DNI").upper()
+        h_fnac = ss.get(f"hermano_fnac_{i}", None)
+
+        # Normaliza fecha a ISO
+        if h_fnac:
+            try:
+                if hasattr(h_fnac, "strftime"):
+                    fnac_iso_h = h_fnac.strftime("%Y-%m-%d")
+                else:
+                    dtmp = parse_iso(h_fnac)
+                    fnac_iso_h = dtmp.strftime("%Y-%m-%d") if dtmp else ""
+            except Exception:
+                fnac_iso_h = ""
+        else:
+            fnac_iso_h = ""
+
+        hermanos_list.append({
+            "nombre":       h_nom,
+            "sexo":         (ss.get(f"hermano_sexo_{i}", "") or "").upper(),
+            "doc_tipo":     h_tipo,
+            "doc_num":      s(ss.get(f"hermano_doc_num_{i}", "")),
+            "fnac":         fnac_iso_h,
+            # Solo LEE nacionalidad (si aplica); siempre definido ("" si no aplica)
+            "nacionalidad": s(ss.get(f"hermano_nacionalidad_{i}", "")) if h_tipo in ("PASAPORTE", "DNI EXTRANJERO") else "",
+        })
+    return hermanos_list, hermanos_sex
+
+def _leer_terceros_ui() -> list[dict]:
+    """Terceros acompañantes desde session_state (filas tercero_*_i con nombre), listos para OBS_TX y BD."""
+    ss = st.session_state
+    terceros_list = []
+    for i in range(len(ss.get("terceros", []))):
+        nombre = s(ss.get(f"tercero_nombre_{i}", "")).upper()
+        if nombre:  # Solo agregar si tiene nombre
+            terceros_list.append({
+                "rol": s(ss.get(f"tercero_rol_{i}", "")).upper(),
+                "nombre": nombre,
+                "dni": s(ss.get(f"tercero_dni_{i}", "")),
+            })
+    return terceros_list
+
 def regenerate_docx_for_permiso(permiso: dict, plantilla_path: str) -> str:
     ctx = _ctx_comun_desde_perm(permiso)
 
@@ -2557,51 +3043,13 @@ def regenerate_docx_for_permiso(permiso: dict, plantilla_path: str) -> str:
             return f"({emp_tx})"
         return ""
 
-    def _doc_num_preferido(num1: str | None, num2: str | None) -> str:
-        n1, n2 = s(num1), s(num2)
-        return n1 if n1 else n2
-
-    def _acomp_bloque_perm(perm: dict) -> tuple[str, str, str, str]:
-        """
-        Devuelve (posesivo, rol_txt, nombre_txt, doc_txt) para PADRE/MADRE/AMBOS/TERCERO.
-        posesivo: 'SU' o 'SUS'
-        rol_txt: PADRE | MADRE | PADRES | <rol tercero>
-        nombre_txt: puede venir vacío en AMBOS
-        doc_txt: 'DOCUMENTO N° ...' si hay doc; si no, ''
-        """
-        acomp = s(perm.get("acompanante","")).upper()
-        if acomp == "PADRE":
-            rol_txt = "PADRE"
-            nombre = s(perm.get("padre_nombre","")).upper()
-            doc = _doc_num_preferido(perm.get("padre_doc_num"), perm.get("padre_dni"))
-            doc_txt = f"DOCUMENTO N° {doc}" if doc else ""
-            return "SU", rol_txt, nombre, doc_txt
-        elif acomp == "MADRE":
-            rol_txt = "MADRE"
-            nombre = s(perm.get("madre_nombre","")).upper()
-            doc = _doc_num_preferido(perm.get("madre_doc_num"), perm.get("madre_dni"))
-            doc_txt = f"DOCUMENTO N° {doc}" if doc else ""
-            return "SU", rol_txt, nombre, doc_txt
-        elif acomp == "AMBOS":
-            return "SUS", "PADRES", "", ""
-        elif acomp == "TERCERO":
-            rol_txt = s(perm.get("rol_acompanante","TERCERO")).upper()
-            nombre = s(perm.get("acomp1_nombre","")).upper()
-            doc = s(perm.get("acomp1_dni","")).upper()
-            doc_txt = f"DOCUMENTO N° {doc}" if doc else ""
-            return "SU", rol_txt, nombre, doc_txt
-        return "SU", "", "", ""
-
     # Construcción de OBSERVACIONES (unificada)
     obs_tx = ""
     acompanante_val = s(permiso.get("acompanante","")).upper()
 
     if acompanante_val in ["SOLO(A)/SOLOS(AS)", "SOLO"]:
         if s(permiso.get("recibe_si","NO")).upper() == "NO":
-            obs_tx = (
-            f"SE DEJA CONSTANCIA QUE {ac['ART']} {ac['SUST']} "
-            f"{ac['VERB_VIAJAR']} {ac['ADJ_SOLO']}."
-            ).strip()
+            obs_tx = _SOLO_TMPL.format_map(ac)
         else:
             # 1) intenta lista desde BD
             rec_list = []
@@ -2620,81 +3068,50 @@ def regenerate_docx_for_permiso(permiso: dict, plantilla_path: str) -> str:
                     "pais":   s(permiso.get("rec_doc_pais","")).upper(),
                 }]
 
-            base_viaje = (
-                f"SE DEJA CONSTANCIA QUE {ac['ART']} {ac['SUST']} "
-                f"{ac['VERB_VIAJAR']} {ac['ADJ_SOLO']}."
-            )
-            recep_txt = _obs_con_recepcion_plural(ac, rec_list)
-            obs_tx = (base_viaje + " " + recep_txt).strip() if recep_txt else base_viaje
-    else:
-        # VIAJAN ACOMPAÑADOS (PADRE/MADRE/AMBOS/TERCERO)
-        acomp_val = s(permiso.get("acompanante","")).upper()
-    
-        # 🆕 CASO ESPECIAL: TERCERO con múltiples acompañantes
-        if acomp_val == "TERCERO":
-            # Leer terceros desde terceros_json en BD
+            base = _SOLO_TMPL.format_map(ac)
+            recep = _obs_con_recepcion_plural(ac, rec_list)
+            obs_tx = f"{base} {recep}" if recep else base
+    elif acompanante_val == "TERCERO":
+        # 🆕 CASO ESPECIAL: TERCERO con múltiples acompañantes (terceros_json en BD)
+        terceros_list = []
+        raw_t = permiso.get("terceros_json") or ""
+        try:
+            terceros_list = json.loads(raw_t) if raw_t else []
+        except Exception:
             terceros_list = []
-            raw_t = permiso.get("terceros_json") or ""
-            try:
-                terceros_list = json.loads(raw_t) if raw_t else []
-            except Exception:
-                terceros_list = []
-        
-            # Generar OBS_TX usando la función helper
-            obs_tx = _obs_terceros_multiples(terceros_list, ac)
-    
-        else:
-            # Lógica normal para PADRE/MADRE/AMBOS
-            posesivo, rol_txt, acomp_nom, acomp_doc = _acomp_bloque_perm(permiso)
-            acomp_n = int(permiso.get("acomp_count") or 0)
-            quien_txt = "QUIENES SERÁN RESPONSABLES" if acomp_n >= 2 else "QUIEN SERÁ RESPONSABLE"
-
-            comp_tx = f"EN COMPAÑÍA DE {posesivo} {rol_txt}"
-            if acomp_nom:
-                comp_tx += f" {acomp_nom}"
-            if acomp_doc:
-                comp_tx += f", CON {acomp_doc}"
-
-            obs_tx = (
-                f"SE DEJA CONSTANCIA QUE {ac['ART']} {ac['SUST']} {ac['VERB_VIAJAR']} {comp_tx}; "
-                f"{quien_txt} DEL CUIDADO DE {ac['ART']} {ac['SUST']} DURANTE SU ESTADÍA EN LA CIUDAD."
-            )
-    # Envía OBS a la plantilla
-    ctx["OBS_TX"] = obs_tx
-    
-    
-    # --- Observaciones precompuestas (por si tu .docx usa un bloque único ya armado) ---
-    ctx["OBSERVACIONES_BLOQUE"] = (
-        f"OBSERVACIONES: {ctx['OBS_TX']} {ctx.get('LINEA_SEPARADOR','')}"
-        if ctx.get("OBS_TX") else ""
-    )
-    
-    # Compat: por si alguna plantilla vieja aún usa HIJO_S
-    ctx["HIJO_S"] = "HIJOS(AS)" if ctx["MENORES_COUNT"] and ctx["MENORES_COUNT"] > 1 else "HIJO(A)"
-
-
-    ctx["PADRE_DOC_FIRMA"] = _doc_firma_adulto(permiso.get("padre_doc_tipo"), permiso.get("padre_doc_num") or permiso.get("padre_dni",""))
-    ctx["MADRE_DOC_FIRMA"] = _doc_firma_adulto(permiso.get("madre_doc_tipo"), permiso.get("madre_doc_num") or permiso.get("madre_dni",""))
-
-    # Normaliza tipo de documento a forma canónica para la PLANTILLA (SIEMPRE USAR "permiso" aquí)
-    ctx["PADRE_DOC_TIPO_CAN"] = canon_doc(permiso.get("padre_doc_tipo"))
-    ctx["MADRE_DOC_TIPO_CAN"] = canon_doc(permiso.get("madre_doc_tipo"))
-    ctx["MENOR_DOC_TIPO_CAN"] = canon_doc(permiso.get("menor_doc_tipo"))
-    
-    ctx.update(concordancias_plural(ctx.get("ACOMP_COUNT", 0)))
-    ctx.update(genero_menor_vars(ctx.get("SEXO_MENOR")))
-    ctx.update(viaje_vars(ctx.get("FECHA_SALIDA"), ctx.get("FECHA_RETORNO"), ctx.get("VIAS")))
+        obs_tx = _obs_terceros_multiples(terceros_list, ac)
+    else:
+        # PADRE/MADRE/AMBOS (nº de responsables según lo guardado)
+        obs_tx = _obs_con_padres(permiso, acompanante_val, ac, int(permiso.get("acomp_count") or 0))
+    # Envía OBS y los campos derivados a la plantilla en un solo update
+    padre_doc_num = permiso.get("padre_doc_num") or permiso.get("padre_dni","")
+    madre_doc_num = permiso.get("madre_doc_num") or permiso.get("madre_dni","")
+    ctx.update({
+        "OBS_TX": obs_tx,
+        # Observaciones precompuestas (por si tu .docx usa un bloque único ya armado)
+        "OBSERVACIONES_BLOQUE": (
+            f"OBSERVACIONES: {obs_tx} {ctx.get('LINEA_SEPARADOR','')}" if obs_tx else ""
+        ),
+        # Compat: por si alguna plantilla vieja aún usa HIJO_S
+        "HIJO_S": "HIJOS(AS)" if ctx["MENORES_COUNT"] and ctx["MENORES_COUNT"] > 1 else "HIJO(A)",
+
+        "PADRE_DOC_FIRMA": _doc_firma_adulto(permiso.get("padre_doc_tipo"), padre_doc_num),
+        "MADRE_DOC_FIRMA": _doc_firma_adulto(permiso.get("madre_doc_tipo"), madre_doc_num),
+
+        # Tipo de documento en forma canónica para la PLANTILLA (SIEMPRE USAR "permiso" aquí)
+        "PADRE_DOC_TIPO_CAN": canon_doc(permiso.get("padre_doc_tipo")),
+        "MADRE_DOC_TIPO_CAN": canon_doc(permiso.get("madre_doc_tipo")),
+        "MENOR_DOC_TIPO_CAN": canon_doc(permiso.get("menor_doc_tipo")),
+
+        # Texto para PADRE/MADRE resuelto (usa el helper global _doc_tx)
+        "PADRE_DOC_TEXTO": _doc_tx(permiso.get("padre_doc_tipo"), padre_doc_num),
+        "MADRE_DOC_TEXTO": _doc_tx(permiso.get("madre_doc_tipo"), madre_doc_num),
+
+        **concordancias_plural(ctx.get("ACOMP_COUNT", 0)),
+        **genero_menor_vars(ctx.get("SEXO_MENOR")),
+        **viaje_vars(ctx.get("FECHA_SALIDA"), ctx.get("FECHA_RETORNO"), ctx.get("VIAS")),
+    })
     ctx = preparar_firmas(ctx)
-    
-    # Texto para PADRE/MADRE resuelto (usa el helper global _doc_tx)
-    ctx["PADRE_DOC_TEXTO"] = _doc_tx(
-        permiso.get("padre_doc_tipo"),
-        permiso.get("padre_doc_num") or permiso.get("padre_dni","")
-    )
-    ctx["MADRE_DOC_TEXTO"] = _doc_tx(
-        permiso.get("madre_doc_tipo"),
-        permiso.get("madre_doc_num") or permiso.get("madre_dni","")
-    )
 
     falt = verificar_plantilla(plantilla_path, ctx)
     if falt:
@@ -2798,7 +3215,7 @@ with st.sidebar.expander("🛡️ Copias de seguridad", expanded=False):
 # 🧰 MANTENIMIENTO (solo desarrollador)
 # ======================================
 with st.sidebar.expander("🧰 Mantenimiento (solo desarrollador)", expanded=False):
-    DEV_KEY = "HACHIKO2025"  # cámbiala por tu clave real
+    DEV_KEY = os.getenv("DEV_KEY", "HACHIKO2025")  # en producción define DEV_KEY en el .env
 
     if "dev_mode" not in st.session_state:
         st.session_state.dev_mode = False
@@ -2807,7 +3224,7 @@ with st.sidebar.expander("🧰 Mantenimiento (solo desarrollador)", expanded=Fal
         # No uses key en el input, o si lo usas, no lo modifiques luego
         dev_pass = st.text_input("🔐 Clave de desarrollador", type="password", placeholder="Solo Hachiko")
         if st.button("Entrar modo desarrollador", use_container_width=True):
-            if (dev_pass or "") == DEV_KEY:
+            if hmac.compare_digest((dev_pass or "").encode(), DEV_KEY.encode()):  # tiempo constante
                 st.session_state.dev_mode = True
                 st.rerun()  # no intentes limpiar dev_pass aquí
             else:
@@ -2819,18 +3236,46 @@ with st.sidebar.expander("🧰 Mantenimiento (solo desarrollador)", expanded=Fal
         with colm1:
             if st.button("✅ Verificar integridad", use_container_width=True):
                 with get_conn() as conn:
+                    # quick_check: revisa páginas sin cruzar índices vs tablas (mucho más rápido)
+                    out = conn.execute("PRAGMA quick_check;").fetchone()[0]
+                st.success(out)
+
+            if st.button("🩺 Chequeo profundo (lento)", use_container_width=True):
+                with get_conn(timeout_sec=60) as conn:
                     out = conn.execute("PRAGMA integrity_check;").fetchone()[0]
                 st.success(out)
 
             if st.button("🔄 Optimizar índices", use_container_width=True):
                 with get_conn() as conn:
-                    conn.execute("PRAGMA optimize;")
+                    # 0x10002: fuerza ANALYZE de todas las tablas, pero con muestreo acotado
+                    conn.execute("PRAGMA analysis_limit=1000;")
+                    conn.execute("PRAGMA optimize=0x10002;")
+                    conn.execute(f"PRAGMA analysis_limit={conn.ANALYSIS_LIMIT};")  # conexión compartida
                 st.success("Optimización completada ✅")
 
+            if st.button("🔬 Analizar a fondo", use_container_width=True):
+                with get_conn(timeout_sec=60) as conn:
+                    conn.execute("PRAGMA analysis_limit=0;")  # sin límite: pasada completa
+                    conn.execute("PRAGMA optimize=0x10002;")
+                    conn.execute(f"PRAGMA analysis_limit={conn.ANALYSIS_LIMIT};")  # conexión compartida
+                st.success("Análisis completo finalizado ✅")
+
         with colm2:
-            if st.button("🧹 Compactar (VACUUM)", use_container_width=True):
+            if st.button("🧹 Compactar (incremental)", use_container_width=True):
+                with get_conn() as conn:
+                    page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+                    libres_antes = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+                    # Libera solo las páginas libres acumuladas (no reescribe toda la BD).
+                    # executescript: con execute() el módulo sqlite3 da un solo paso y libera 1 página.
+                    conn.executescript("PRAGMA incremental_vacuum(1000);")
+                    libres_despues = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+                liberadas = libres_antes - libres_despues
+                st.success(f"Compactación finalizada 🧾  Páginas liberadas: {liberadas} "
+                           f"({liberadas * page_size / 1024 / 1024:.2f} MB)")
+
+            confirmar_vacuum = st.checkbox("Confirmo VACUUM completo (bloquea la BD)", key="dev_confirm_vacuum")
+            if st.button("🧱 VACUUM completo (lento)", use_container_width=True, disabled=not confirmar_vacuum):
                 st.warning("No cierres la app mientras se compacta…")
-                import os
                 before = os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0
                 with get_conn(timeout_sec=60) as conn:
                     conn.execute("VACUUM;")
@@ -2840,28 +3285,30 @@ with st.sidebar.expander("🧰 Mantenimiento (solo desarrollador)", expanded=Fal
         st.markdown("---")
         st.subheader("🧾 Control del correlativo")
 
-        from datetime import date
         anio_actual = date.today().year
 
-        with get_conn() as conn:
-            row = conn.execute("SELECT numero FROM correlativos WHERE anio=?", (anio_actual,)).fetchone()
-            correl_actual = row[0] if row else None
+        correl_actual = _get_correl(anio_actual)
 
         st.write(f"📅 Año actual: {anio_actual}")
-        st.write(f"🔢 Correlativo actual: *{correl_actual if correl_actual is not None else 'Sin registrar'}*")
+        correl_box = st.empty()  # se reescribe tras actualizar, sin st.rerun()
+        correl_box.write(f"🔢 Correlativo actual: *{correl_actual if correl_actual is not None else 'Sin registrar'}*")
 
         nuevo_valor = st.number_input("Nuevo correlativo (último usado, el siguiente será +1)", min_value=0, value=correl_actual or 0, step=1)
         aplicar = st.button("💾 Actualizar correlativo", use_container_width=True)
 
         if aplicar:
             with get_conn() as conn:
+                # UPSERT: actualiza la fila existente en su sitio (sin DELETE+INSERT)
+                conn.execute("BEGIN IMMEDIATE")
                 conn.execute(
-                    "INSERT OR REPLACE INTO correlativos (anio, numero) VALUES (?, ?)",
+                    "INSERT INTO correlativos (anio, numero) VALUES (?, ?) "
+                    "ON CONFLICT(anio) DO UPDATE SET numero = excluded.numero",
                     (anio_actual, int(nuevo_valor))
                 )
-                conn.commit()
+                conn.execute("COMMIT")
+            _get_correl.clear()
+            correl_box.write(f"🔢 Correlativo actual: *{int(nuevo_valor)}*")
             st.success(f"✅ Correlativo actualizado. El siguiente permiso será *{int(nuevo_valor)+1}*.")
-            st.rerun()
         
         st.divider()
         if st.button("🚪 Salir del modo desarrollador", use_container_width=True):
@@ -2869,6 +3316,27 @@ with st.sidebar.expander("🧰 Mantenimiento (solo desarrollador)", expanded=Fal
             st.rerun()  # sin tocar dev_pass         
 
 # ============ Selección de modo ============
+# Claves de búsqueda que se limpian en CUALQUIER cambio de modo
+_MODE_CHANGE_KEYS = frozenset([
+    # Botones de búsqueda
+    "btn_buscar_padre_dni", "btn_buscar_madre_dni", "btn_buscar_menor", "btn_limpiar_menor",
+    "btn_buscar_correlativo",
+    # Inputs de búsqueda
+    "padre_dni_buscar", "madre_dni_buscar", "doc_busca_menor",
+    "anio_buscar", "numero_buscar",
+    # Flags internos
+    "padre_dni_auto", "madre_dni_auto", "_did_clear_padre", "_did_clear_madre",
+])
+# Al entrar a "Nuevo permiso" además se limpian los selectores UBIGEO
+_NEW_MODE_KEYS = _MODE_CHANGE_KEYS | frozenset([
+    "padre_departamento_sel", "padre_provincia_sel", "padre_distrito_sel",
+    "madre_departamento_sel", "madre_provincia_sel", "madre_distrito_sel",
+])
+_HERMANO_PREFIXES = (
+    "hermano_nombre_", "hermano_sexo_", "hermano_doc_tipo_",
+    "hermano_doc_num_", "hermano_fnac_", "hermano_nacionalidad_",
+)
+
 modo = st.radio("¿Qué quieres hacer?", ["➕ Nuevo permiso", "✏️ Editar / Re-generar", "📇 DNI registrados", "🤖 Asistente IA"], horizontal=True)
 
 prev_modo = st.session_state.get("_last_mode")
@@ -2881,28 +3349,12 @@ if prev_modo != modo:
         st.session_state.sel_id = 0
         st.session_state.pop("pid_editing", None)
         st.session_state.modo_edicion = False
-        # Limpia buscador de permisos
-        for k in ["anio_buscar", "numero_buscar", "btn_buscar_correlativo"]:
-            st.session_state.pop(k, None)
     
-    # 🔥 PASO 3: Si entras a "Nuevo permiso" → limpieza AGRESIVA
-    if modo == "➕ Nuevo permiso":
-        # Limpia TODOS los widgets posibles (incluye los del modo anterior)
-        keys_to_clean = [
-            # Botones de búsqueda
-            "btn_buscar_padre_dni", "btn_buscar_madre_dni", "btn_buscar_menor", "btn_limpiar_menor",
-            "btn_buscar_correlativo",
-            # Inputs de búsqueda
-            "padre_dni_buscar", "madre_dni_buscar", "doc_busca_menor",
-            "anio_buscar", "numero_buscar",
-            # Flags internos
-            "padre_dni_auto", "madre_dni_auto", "_did_clear_padre", "_did_clear_madre",
-            # Selectores de provincia/distrito/departamento
-            "padre_departamento_sel", "padre_provincia_sel", "padre_distrito_sel",
-            "madre_departamento_sel", "madre_provincia_sel", "madre_distrito_sel",
-        ]
-        for k in keys_to_clean:
-            st.session_state.pop(k, None)
+    # 🔥 PASO 3: Limpia botones y campos de búsqueda (TODOS los modos, incluye el
+    # buscador de permisos); si entras a "Nuevo permiso" también los selectores UBIGEO
+    _keys_modo = _NEW_MODE_KEYS if modo == "➕ Nuevo permiso" else _MODE_CHANGE_KEYS
+    for k in list(st.session_state.keys() & _keys_modo):
+        del st.session_state[k]
     
     # 1) Limpia buffers de buscadores
     _clear_lookup_buffers()
@@ -2910,16 +3362,6 @@ if prev_modo != modo:
     st.session_state.pop("_prefill_terceros_pid", None)
     st.session_state.pop("_prefill_recep_pid", None)
     
-    # 🔥 Limpia botones y campos de búsqueda (para TODOS los modos)
-    botones_busqueda = [
-        "btn_buscar_padre_dni", "btn_buscar_madre_dni", "btn_buscar_menor", "btn_limpiar_menor",
-        "padre_dni_buscar", "madre_dni_buscar", "doc_busca_menor",
-        "padre_dni_auto", "madre_dni_auto", "_did_clear_padre", "_did_clear_madre",
-        "btn_buscar_correlativo", "anio_buscar", "numero_buscar"
-    ]
-    for key in botones_busqueda:
-        st.session_state.pop(key, None)
-    
     # 2) Si entras a "Nuevo permiso", borra todo el formulario y siembra defaults
     if modo == "➕ Nuevo permiso":
         _clear_form_keys_for_new()
@@ -2948,11 +3390,9 @@ if prev_modo != modo:
         }
         for k, v in seed.items():
             st.session_state[k] = v
-        # limpia hermanos dinámicos
-        if "hermanos" in st.session_state:
-            for i in range(len(st.session_state["hermanos"])):
-                for kk in (f"hermano_nombre_{i}", f"hermano_sexo_{i}", f"hermano_doc_tipo_{i}", f"hermano_doc_num_{i}", f"hermano_fnac_{i}"):
-                    st.session_state.pop(kk, None)
+        # limpia hermanos dinámicos (una sola pasada por prefijo)
+        for k in [k for k in st.session_state.keys() if k.startswith(_HERMANO_PREFIXES)]:
+            del st.session_state[k]
         st.session_state["hermanos"] = []
         # saliendo de edición: baja flags
         st.session_state.modo_edicion = False
@@ -2965,12 +3405,39 @@ else:
     # 🔥 Ya no estamos en transición
     st.session_state._modo_transitorio = False
 # ============ Carga de plantilla ============
+_TMP_PLANTILLA = os.path.join(BASE_DIR, "_tmp_plantilla.docx")  # también la usa Editar/Re-generar
+
+def _persist_template(data: bytes) -> str:
+    """
+    Copia la plantilla subida a _tmp_plantilla.docx solo si cambió: cada rerun vuelve a
+    entregar el mismo archivo. La firma (md5, tamaño, mtime) queda en la sesión y se
+    compara con un os.stat, así se reescribe si otra sesión la pisó o si se borró.
+    """
+    md5 = hashlib.md5(data).hexdigest()
+    try:
+        stt = os.stat(_TMP_PLANTILLA)
+        firma_disco = (md5, stt.st_size, stt.st_mtime_ns)
+    except OSError:
+        firma_disco = None
+    if firma_disco is None or st.session_state.get("_tmpl_firma") != firma_disco:
+        tmp = _TMP_PLANTILLA + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, _TMP_PLANTILLA)
+        stt = os.stat(_TMP_PLANTILLA)
+        st.session_state["_tmpl_firma"] = (md5, stt.st_size, stt.st_mtime_ns)
+        # Restos de la versión que guardaba una copia por contenido (_tmpl_<md5>.docx)
+        for viejo in glob.glob(os.path.join(BASE_DIR, "_tmpl_*.docx")):
+            try:
+                os.remove(viejo)
+            except OSError:
+                pass
+    return _TMP_PLANTILLA
+
 with st.expander("⚙️ Plantilla (.docx)", expanded=False):
     plantilla_subida = st.file_uploader("Usar una plantilla DOCX personalizada (opcional)", type=["docx"])
     if plantilla_subida:
-        plantilla_path = os.path.join(BASE_DIR, "_tmp_plantilla.docx")
-        with open(plantilla_path, "wb") as f:
-            f.write(plantilla_subida.read())
+        plantilla_path = _persist_template(plantilla_subida.getvalue())
     else:
         plantilla_path = PLANTILLA_DEFAULT
 
@@ -2981,16 +3448,12 @@ with st.expander("⚙️ Plantilla (.docx)", expanded=False):
 
 # ============ Formulario ============
 def formulario_base(valores: dict | None = None, disabled: bool = False):
-    def safe_index(options: list[str], value: str | None, default_idx: int = 0) -> int:
-        """Nunca lanza ValueError (si value es '', None o inválido, devuelve default_idx)."""
-        v = (value or "").strip().upper()
-        try:
-            return options.index(v)
-        except Exception:
-            return default_idx
-        
-    modo_edicion = st.session_state.get("modo_edicion", False)
+    ss = st.session_state  # alias local: evita LOAD_GLOBAL st + LOAD_ATTR en cada acceso
+    modo_edicion = ss.get("modo_edicion", False)
     disable_lookup = disabled or modo_edicion
+    en_transicion = ss.get("_modo_transitorio", False)
+    # Sufijo de las keys UBIGEO dinámicas (se calcula una sola vez por render)
+    _pid_suffix = f"_{ss.get('pid_editing', 0)}" if modo_edicion else ""
     valores = valores or {}
 
     # ===== Defaults seguros para recepción (evita NameError en el return) =====
@@ -3002,39 +3465,31 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
 
     # --- Evita UnboundLocalError en "Nuevo permiso"
     perm = None
-    if st.session_state.get("modo_edicion", False) and isinstance(valores, dict) and valores.get("id"):
+    if modo_edicion and isinstance(valores, dict) and valores.get("id"):
         # en edición puedes querer tener el dict del permiso cargado
         perm = valores
     
     # --- Inicialización lista de hermanos (UI dinámica) ---
-    if "hermanos" not in st.session_state:
-        st.session_state.hermanos = []
+    if "hermanos" not in ss:
+        ss.hermanos = []
 
     # --- Prefill de HERMANOS cuando estamos en Editar/Re-Generar ---
     _hermanos_bd = valores.get("hermanos") or []
     _perm_id_actual = valores.get("id") or valores.get("permiso_id") or valores.get("num_permiso")
 
     # 💡 SOLO si hay un permiso cargado (_perm_id_actual), hacemos prefill/limpieza
-    if _perm_id_actual and isinstance(_hermanos_bd, list) and (_hermanos_bd or st.session_state.get("_prefill_hermanos_pid") != _perm_id_actual):
+    if _perm_id_actual and isinstance(_hermanos_bd, list) and (_hermanos_bd or ss.get("_prefill_hermanos_pid") != _perm_id_actual):
         # Limpia cualquier rastro anterior
-        prev_len = len(st.session_state.get("hermanos", []))
-        for i in range(prev_len):
-            for k in (
-                f"hermano_nombre_{i}", f"hermano_sexo_{i}",
-                f"hermano_doc_tipo_{i}", f"hermano_doc_num_{i}",
-                f"hermano_fnac_{i}",     f"hermano_nacionalidad_{i}"  # <- NUEVO
-            ):
-                st.session_state.pop(k, None)
+        for k in [k for k in ss.keys() if k.startswith(_HERMANO_PREFIXES)]:
+            del ss[k]
 
-        st.session_state.hermanos = []
-
-        # Pobla desde BD
+        # Pobla desde BD (se arma un dict y se vuelca con un solo update)
+        batch = {"hermanos": [{} for _ in _hermanos_bd]}
         for i, h in enumerate(_hermanos_bd):
-            st.session_state.hermanos.append({})
-            st.session_state[f"hermano_nombre_{i}"]   = s(h.get("nombre", ""))
-            st.session_state[f"hermano_sexo_{i}"]     = (h.get("sexo", "F") or "F").upper()
-            st.session_state[f"hermano_doc_tipo_{i}"] = (h.get("doc_tipo", "DNI") or "DNI").upper()
-            st.session_state[f"hermano_doc_num_{i}"]  = s(h.get("doc_num", "") or h.get("dni", ""))
+            batch[f"hermano_nombre_{i}"]   = s(h.get("nombre", ""))
+            batch[f"hermano_sexo_{i}"]     = (h.get("sexo", "F") or "F").upper()
+            batch[f"hermano_doc_tipo_{i}"] = (h.get("doc_tipo", "DNI") or "DNI").upper()
+            batch[f"hermano_doc_num_{i}"]  = s(h.get("doc_num", "") or h.get("dni", ""))
 
             _fnac_h = h.get("fnac")
             if _fnac_h:
@@ -3048,40 +3503,40 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                     _fnac_val = None
             else:
                 _fnac_val = None
-            st.session_state[f"hermano_fnac_{i}"] = _fnac_val
-            st.session_state[f"hermano_nacionalidad_{i}"] = s(h.get("nacionalidad", "")).upper()
-
+            batch[f"hermano_fnac_{i}"] = _fnac_val
+            batch[f"hermano_nacionalidad_{i}"] = s(h.get("nacionalidad", "")).upper()
+        ss.update(batch)
 
-        st.session_state["_prefill_hermanos_pid"] = _perm_id_actual
+        ss["_prefill_hermanos_pid"] = _perm_id_actual
 
 
         # Marca para no prefillar de nuevo en cada rerun
-        st.session_state["_prefill_hermanos_pid"] = _perm_id_actual
+        ss["_prefill_hermanos_pid"] = _perm_id_actual
 
     
     if not modo_edicion:
         for key in ("prefill_padre", "prefill_madre", "prefill_menor"):
-            if key in st.session_state:
-                valores = _merge_nonempty(valores, st.session_state[key])
-        if "prefill_from_search" in st.session_state:
-            v_search = dict(st.session_state.prefill_from_search)
+            if key in ss:
+                valores = _merge_nonempty(valores, ss[key])
+        if "prefill_from_search" in ss:
+            v_search = dict(ss.prefill_from_search)
             v_search = {k: v for k, v in v_search.items() if v not in (None, "", [])}
             valores = {**valores, **v_search}
 
     st.subheader("1) Cabecera")
     colA, colB = st.columns(2)
     with colA:
-        ciudad = st.text_input(
+        ciudad = _norm_up(st.text_input(
             "Ciudad",
-            value=s(valores.get("ciudad", "CHICLAYO")).upper(),
+            value=_norm_up(valores.get("ciudad", "CHICLAYO")),
             disabled=disabled
-        ).upper()
+        ))
     with colB:
-        notario = st.text_input(
+        notario = _norm_up(st.text_input(
             "Nombre del Notario",
-            value=s(valores.get("notario", "SEGUNDO ALFREDO SANTA CRUZ VERA")).upper(),
+            value=_norm_up(valores.get("notario", "SEGUNDO ALFREDO SANTA CRUZ VERA")),
             disabled=disabled
-        ).upper()
+        ))
 
     # ---- Tipo de viaje (seguro) ----
     opciones_viaje = ["NACIONAL", "INTERNACIONAL"]
@@ -3149,7 +3604,6 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
             st.write("")  # Espaciado
             st.write("")
             # Deshabilita si estamos cambiando de modo
-            en_transicion = st.session_state.get("_modo_transitorio", False)
             buscar_padre_btn = st.button("🔍 Buscar", key="btn_buscar_padre_dni", disabled=(disable_lookup or en_transicion))
 
         # Procesar búsqueda de DNI
@@ -3160,7 +3614,7 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                 # 🔥 PASO 1: Buscar en BD LOCAL primero (0 peticiones API)
                 # ═══════════════════════════════════════════════════════
                 with st.spinner("🔎 Buscando en permisos anteriores..."):
-                    perm_local = search_por_doc_y_rol(padre_dni_buscar, "PADRE")
+                    perm_local = _cached_local_lookup(padre_dni_buscar, "PADRE")
             
                 if perm_local:
                     # ✅ ENCONTRADO EN BD LOCAL (sin consumir API)
@@ -3174,52 +3628,25 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                     # ══════════════════════════════════════════════════════════════════
                     # 🔥 FIX 1: Guardar en AMBAS keys (la normal Y la del selectbox)
                     # ══════════════════════════════════════════════════════════════════
-                    _pid_suffix = f"_{st.session_state.get('pid_editing', 0)}" if st.session_state.get("modo_edicion", False) else ""
-                
-                    # Keys normales (para text_input y compatibilidad)
-                    for k in ("padre_nombre", "padre_doc_tipo", "padre_doc_num", "padre_dni",
-                              "padre_nacionalidad", "padre_estado_civil", "padre_direccion"):
-                        st.session_state[k] = vals_padre.get(k, "")
-                
-                    # ══════════════════════════════════════════════════════════════════
-                    # 🔥 FIX 2: Guardar UBIGEO en las keys de los selectbox
-                    # ══════════════════════════════════════════════════════════════════
-                    padre_dep = vals_padre.get("padre_departamento", "")
-                    padre_prov = vals_padre.get("padre_provincia", "")
-                    padre_dist = vals_padre.get("padre_distrito", "")
-                
-                    # Guardar en las keys normales también (para el payload final)
-                    st.session_state["padre_departamento"] = padre_dep
-                    st.session_state["padre_provincia"] = padre_prov
-                    st.session_state["padre_distrito"] = padre_dist
-                
-                    # Guardar en las keys de los selectbox (las que usan los widgets)
-                    if padre_dep:
-                        st.session_state[f"padre_departamento_sel{_pid_suffix}"] = padre_dep
-                
-                    if padre_prov:
-                        st.session_state[f"padre_provincia_sel{_pid_suffix}"] = padre_prov
-                
-                    if padre_dist:
-                        st.session_state[f"padre_distrito_sel{_pid_suffix}"] = padre_dist
                 
+                    # Keys normales (para text_input y compatibilidad); todo se junta en
+                    # un dict y se vuelca a session_state con un solo update()
+                    payload = {k: vals_padre.get(k, "") for k in (
+                        "padre_nombre", "padre_doc_tipo", "padre_doc_num", "padre_dni",
+                        "padre_nacionalidad", "padre_estado_civil", "padre_direccion",
+                        "padre_departamento", "padre_provincia", "padre_distrito",  # para el payload final
+                    )}
+
                     # ══════════════════════════════════════════════════════════════════
-                    # 🔥 FIX 3: Pre-cargar cachés de provincias/distritos
+                    # 🔥 FIX 2: Guardar UBIGEO en las keys de los selectbox (las que usan los widgets)
                     # ══════════════════════════════════════════════════════════════════
-                    if padre_dep:
-                        # Cargar provincias del departamento
-                        cache_key_prov = f"provincias_{padre_dep}"
-                        if cache_key_prov not in st.session_state:
-                            st.session_state[cache_key_prov] = obtener_provincias(padre_dep)
-                    
-                        if padre_prov:
-                            # Cargar distritos de la provincia
-                            cache_key_dist = f"distritos_{padre_dep}_{padre_prov}"
-                            if cache_key_dist not in st.session_state:
-                                st.session_state[cache_key_dist] = obtener_distritos(padre_dep, padre_prov)
-                
+                    for campo in ("departamento", "provincia", "distrito"):
+                        if payload[f"padre_{campo}"]:
+                            payload[f"padre_{campo}_sel{_pid_suffix}"] = payload[f"padre_{campo}"]
+
                     # Guardar prefill para compatibilidad con el resto del código
-                    st.session_state.prefill_padre = vals_padre
+                    payload["prefill_padre"] = vals_padre
+                    ss.update(payload)
                 
                     # 📊 Indicador de origen (trazabilidad)
                     st.info(f"📋 **Origen del dato**: Permiso N° {perm_local.get('numero'):04d}-NSC-{perm_local.get('anio')} (búsqueda local, 0 peticiones API usadas)")
@@ -3230,7 +3657,10 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                     # 🔥 PASO 2: Si NO está en BD, llamar a API RENIEC
                     # ═══════════════════════════════════════════════════════
                     with st.spinner("🌐 No encontrado localmente. Consultando RENIEC... (consumirá 1 petición API)"):
-                        datos_padre = consultar_dni_reniec(padre_dni_buscar)
+                        try:
+                            datos_padre = _cached_reniec(padre_dni_buscar)
+                        except LookupError:
+                            datos_padre = None
                 
                     if datos_padre:
                         # ✅ ENCONTRADO EN API RENIEC
@@ -3243,8 +3673,8 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                         nombre_completo = f"{nombres} {apellido_paterno} {apellido_materno}".strip().upper()
                     
                         # Guardar en session_state
-                        st.session_state["padre_nombre"] = nombre_completo
-                        st.session_state["padre_doc_num"] = padre_dni_buscar
+                        ss["padre_nombre"] = nombre_completo
+                        ss["padre_doc_num"] = padre_dni_buscar
                     
                         # 📊 Indicador de origen
                         st.info("📡 **Origen del dato**: API RENIEC (1 petición consumida)")
@@ -3271,158 +3701,75 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                 st.warning("⚠️ El DNI debe tener exactamente 8 dígitos numéricos")
 
         # Si viene de la API de búsqueda, usa ese valor; si no, usa valores de precarga
-        if "padre_nombre" not in st.session_state:
-            st.session_state["padre_nombre"] = valores.get("padre_nombre", "")
+        ss.setdefault("padre_nombre", _norm_up(valores.get("padre_nombre", "")))
 
         padre_nombre = st.text_input(
             "Nombres completos del Padre",
-            value=st.session_state["padre_nombre"].upper() if st.session_state.get("padre_nombre") else "",
             disabled=disabled,
-            key="padre_nombre"  # 🔑 MANTENER LA KEY ORIGINAL
-        ).upper()
+            key="padre_nombre",  # 🔑 MANTENER LA KEY ORIGINAL
+            on_change=_upper_cb, args=("padre_nombre",),
+        )
 
         # Tipo de documento
-        def _on_change_doc_tipo_padre():
-            if canon_doc(st.session_state.get("padre_doc_tipo")) == "DNI":
-                st.session_state["padre_nacionalidad"] = ""
-
         padre_doc_tipo = st.selectbox(
             "Padre – Tipo de documento",
             DOC_TIPOS_UI,
             index=safe_index(DOC_TIPOS_UI, valores.get("padre_doc_tipo", "DNI"), 0),
             disabled=disabled,
             key="padre_doc_tipo",
-            on_change=_on_change_doc_tipo_padre,
+            on_change=_on_change_doc_tipo, args=("padre",),
         )
 
         # Determina el valor inicial ANTES del widget
-        _padre_doc_val = ""
-        if "padre_dni_auto" in st.session_state and st.session_state["padre_dni_auto"]:
-            _padre_doc_val = st.session_state["padre_dni_auto"]
-        elif "padre_doc_num" in st.session_state and st.session_state["padre_doc_num"]:
-            _padre_doc_val = st.session_state["padre_doc_num"]
-        elif valores.get("padre_doc_num"):
-            _padre_doc_val = valores.get("padre_doc_num")
-        elif valores.get("padre_dni"):
-            _padre_doc_val = valores.get("padre_dni")
+        # (auto de RENIEC > lo ya escrito > precarga; cada key se lee una sola vez)
+        _padre_doc_val = (
+            ss.get("padre_dni_auto")
+            or ss.get("padre_doc_num")
+            or valores.get("padre_doc_num")
+            or valores.get("padre_dni")
+            or ""
+        )
 
+        _padre_canon = canon_doc(padre_doc_tipo)
         padre_doc_num = st.text_input(
-            f"Padre – Nº {'DNI' if canon_doc(padre_doc_tipo)=='DNI' else ('Pasaporte' if canon_doc(padre_doc_tipo)=='PASAPORTE' else 'DNI Extranjero')}",
+            f"Padre – Nº {_DOC_LABEL.get(_padre_canon, 'DNI Extranjero')}",
             value=_padre_doc_val,
             disabled=disabled,
             key="padre_doc_num"
         )
 
         # Nacionalidad (solo si es pasaporte/extranjero)
+        ss.setdefault("padre_nacionalidad", _norm_up(valores.get("padre_nacionalidad","")))
         padre_nac = st.text_input(
             "Padre – Nacionalidad (si Pasaporte/DNI Extranjero)",
-            value=s(st.session_state.get("padre_nacionalidad", valores.get("padre_nacionalidad",""))).upper(),
-            disabled=disabled or (canon_doc(padre_doc_tipo) == "DNI"),
-            key="padre_nacionalidad"
-        ).upper()
+            disabled=disabled or (_padre_canon == "DNI"),
+            key="padre_nacionalidad",
+            on_change=_upper_cb, args=("padre_nacionalidad",),
+        )
 
         # Estado civil
+        ss.setdefault("padre_estado_civil", _norm_up(valores.get("padre_estado_civil","")))
         padre_ec = st.text_input(
             "Padre – Estado civil",
-            value=s(st.session_state.get("padre_estado_civil", valores.get("padre_estado_civil",""))).upper(),
             disabled=disabled,
-            key="padre_estado_civil"
-        ).upper()
+            key="padre_estado_civil",
+            on_change=_upper_cb, args=("padre_estado_civil",),
+        )
 
         # 🆕 Domicilio con UBIGEO en cascada
         st.markdown("**Domicilio del Padre:**")
 
         # Dirección (calle y número)
+        ss.setdefault("padre_direccion", _norm_up(valores.get("padre_direccion","")))
         padre_direccion = st.text_input(
             "Dirección (calle, número, urbanización)",
-            value=s(st.session_state.get("padre_direccion", valores.get("padre_direccion",""))).upper(),
             disabled=disabled,
-            key="padre_direccion"
-        ).upper()
+            key="padre_direccion",
+            on_change=_upper_cb, args=("padre_direccion",),
+        )
 
-        # 🔧 Callbacks para limpiar cascada
-        def _on_change_padre_depto():
-            """Cuando cambia el departamento del padre, limpia provincia y distrito"""
-            # Limpia selectores
-            st.session_state.pop("padre_provincia_sel", None)
-            st.session_state.pop("padre_distrito_sel", None)
-        
-            # 🔥 NUEVO: Limpia cachés de provincias/distritos
-            keys_to_remove = [k for k in st.session_state.keys() 
-                              if k.startswith("provincias_") or k.startswith("distritos_")]
-            for k in keys_to_remove:
-                st.session_state.pop(k, None)
-
-        def _on_change_padre_prov():
-            """Cuando cambia la provincia del padre, limpia distrito"""
-            st.session_state.pop("padre_distrito_sel", None)
-
-        # Selector de UBIGEO en cascada
-        col_u1, col_u2, col_u3 = st.columns(3)
-
-        # 🔥 NUEVO: Key dinámica basada en el permiso que se está editando
-        _pid_suffix = f"_{st.session_state.get('pid_editing', 0)}" if st.session_state.get("modo_edicion", False) else ""
-
-        with col_u1:
-            # Cargar departamentos (caché global)
-            if "departamentos_list" not in st.session_state:
-                with st.spinner("Cargando departamentos..."):
-                    st.session_state["departamentos_list"] = obtener_departamentos()
-
-            padre_departamento = st.selectbox(
-                "Departamento",
-                options=[""] + st.session_state.get("departamentos_list", []),
-                index=0 if not valores.get("padre_departamento") else (
-                    st.session_state.get("departamentos_list", []).index(valores.get("padre_departamento")) + 1 
-                    if valores.get("padre_departamento") in st.session_state.get("departamentos_list", []) else 0
-                ),
-                disabled=disabled,
-                key=f"padre_departamento_sel{_pid_suffix}",  # 🔥 KEY DINÁMICA
-                on_change=_on_change_padre_depto
-            )
-
-        with col_u2:
-            if padre_departamento:
-                # Cargar provincias del departamento seleccionado
-                cache_key = f"provincias_{padre_departamento}"
-                if cache_key not in st.session_state:
-                    with st.spinner("Cargando provincias..."):
-                        st.session_state[cache_key] = obtener_provincias(padre_departamento)
-
-                padre_provincia = st.selectbox(
-                    "Provincia",
-                    options=[""] + st.session_state.get(cache_key, []),
-                    index=0 if not valores.get("padre_provincia") else (
-                        st.session_state.get(cache_key, []).index(valores.get("padre_provincia")) + 1 
-                        if valores.get("padre_provincia") in st.session_state.get(cache_key, []) else 0
-                    ),
-                    disabled=disabled,
-                    key=f"padre_provincia_sel{_pid_suffix}",  # 🔥 KEY DINÁMICA
-                    on_change=_on_change_padre_prov
-                )
-            else:
-                padre_provincia = st.selectbox("Provincia", [""], key=f"padre_provincia_sel_empty{_pid_suffix}", disabled=True)
-
-        with col_u3:
-            if padre_departamento and padre_provincia:
-                # Cargar distritos de la provincia seleccionada
-                cache_key = f"distritos_{padre_departamento}_{padre_provincia}"
-                if cache_key not in st.session_state:
-                    with st.spinner("Cargando distritos..."):
-                        st.session_state[cache_key] = obtener_distritos(padre_departamento, padre_provincia)
-
-                padre_distrito = st.selectbox(
-                    "Distrito",
-                    options=[""] + st.session_state.get(cache_key, []),
-                    index=0 if not valores.get("padre_distrito") else (
-                        st.session_state.get(cache_key, []).index(valores.get("padre_distrito")) + 1 
-                        if valores.get("padre_distrito") in st.session_state.get(cache_key, []) else 0
-                    ),
-                    disabled=disabled,
-                    key=f"padre_distrito_sel{_pid_suffix}"  # 🔥 KEY DINÁMICA
-                )
-            else:
-                padre_distrito = st.selectbox("Distrito", [""], key=f"padre_distrito_sel_empty{_pid_suffix}", disabled=True)
+        # Selector de UBIGEO en cascada (fragmento: no re-ejecuta todo el formulario)
+        padre_departamento, padre_provincia, padre_distrito = _ubigeo_cascada("padre", valores, disabled, _pid_suffix)
 
         # Guardar valores en variables normales (no solo session_state)
         padre_dist = padre_distrito
@@ -3465,7 +3812,6 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
             st.write("")  # Espaciado
             st.write("")
             # Deshabilita si estamos cambiando de modo
-            en_transicion = st.session_state.get("_modo_transitorio", False)
             buscar_madre_btn = st.button("🔍 Buscar", key="btn_buscar_madre_dni", disabled=(disable_lookup or en_transicion))
 
         # Procesar búsqueda de DNI
@@ -3476,7 +3822,7 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                 # 🔥 PASO 1: Buscar en BD LOCAL primero (0 peticiones API)
                 # ═══════════════════════════════════════════════════════
                 with st.spinner("🔎 Buscando en permisos anteriores..."):
-                    perm_local = search_por_doc_y_rol(madre_dni_buscar, "MADRE")
+                    perm_local = _cached_local_lookup(madre_dni_buscar, "MADRE")
             
                 if perm_local:
                     # ✅ ENCONTRADO EN BD LOCAL (sin consumir API)
@@ -3490,52 +3836,25 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                     # ══════════════════════════════════════════════════════════════════
                     # 🔥 FIX 1: Guardar en AMBAS keys (la normal Y la del selectbox)
                     # ══════════════════════════════════════════════════════════════════
-                    _pid_suffix = f"_{st.session_state.get('pid_editing', 0)}" if st.session_state.get("modo_edicion", False) else ""
-                
-                    # Keys normales (para text_input y compatibilidad)
-                    for k in ("madre_nombre", "madre_doc_tipo", "madre_doc_num", "madre_dni",
-                              "madre_nacionalidad", "madre_estado_civil", "madre_direccion"):
-                        st.session_state[k] = vals_madre.get(k, "")
-                
-                    # ══════════════════════════════════════════════════════════════════
-                    # 🔥 FIX 2: Guardar UBIGEO en las keys de los selectbox
-                    # ══════════════════════════════════════════════════════════════════
-                    madre_dep = vals_madre.get("madre_departamento", "")
-                    madre_prov = vals_madre.get("madre_provincia", "")
-                    madre_dist = vals_madre.get("madre_distrito", "")
-                
-                    # Guardar en las keys normales también (para el payload final)
-                    st.session_state["madre_departamento"] = madre_dep
-                    st.session_state["madre_provincia"] = madre_prov
-                    st.session_state["madre_distrito"] = madre_dist
-                
-                    # Guardar en las keys de los selectbox (las que usan los widgets)
-                    if madre_dep:
-                        st.session_state[f"madre_departamento_sel{_pid_suffix}"] = madre_dep
-                
-                    if madre_prov:
-                        st.session_state[f"madre_provincia_sel{_pid_suffix}"] = madre_prov
-                
-                    if madre_dist:
-                        st.session_state[f"madre_distrito_sel{_pid_suffix}"] = madre_dist
                 
+                    # Keys normales (para text_input y compatibilidad); todo se junta en
+                    # un dict y se vuelca a session_state con un solo update()
+                    payload = {k: vals_madre.get(k, "") for k in (
+                        "madre_nombre", "madre_doc_tipo", "madre_doc_num", "madre_dni",
+                        "madre_nacionalidad", "madre_estado_civil", "madre_direccion",
+                        "madre_departamento", "madre_provincia", "madre_distrito",  # para el payload final
+                    )}
+
                     # ══════════════════════════════════════════════════════════════════
-                    # 🔥 FIX 3: Pre-cargar cachés de provincias/distritos
+                    # 🔥 FIX 2: Guardar UBIGEO en las keys de los selectbox (las que usan los widgets)
                     # ══════════════════════════════════════════════════════════════════
-                    if madre_dep:
-                        # Cargar provincias del departamento
-                        cache_key_prov = f"provincias_{madre_dep}"
-                        if cache_key_prov not in st.session_state:
-                            st.session_state[cache_key_prov] = obtener_provincias(madre_dep)
-                    
-                        if madre_prov:
-                            # Cargar distritos de la provincia
-                            cache_key_dist = f"distritos_{madre_dep}_{madre_prov}"
-                            if cache_key_dist not in st.session_state:
-                                st.session_state[cache_key_dist] = obtener_distritos(madre_dep, madre_prov)
-                
+                    for campo in ("departamento", "provincia", "distrito"):
+                        if payload[f"madre_{campo}"]:
+                            payload[f"madre_{campo}_sel{_pid_suffix}"] = payload[f"madre_{campo}"]
+
                     # Guardar prefill para compatibilidad con el resto del código
-                    st.session_state.prefill_madre = vals_madre
+                    payload["prefill_madre"] = vals_madre
+                    ss.update(payload)
                 
                     # 📊 Indicador de origen (trazabilidad)
                     st.info(f"📋 **Origen del dato**: Permiso N° {perm_local.get('numero'):04d}-NSC-{perm_local.get('anio')} (búsqueda local, 0 peticiones API usadas)")
@@ -3546,7 +3865,10 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                     # 🔥 PASO 2: Si NO está en BD, llamar a API RENIEC
                     # ═══════════════════════════════════════════════════════
                     with st.spinner("🌐 No encontrado localmente. Consultando RENIEC... (consumirá 1 petición API)"):
-                        datos_madre = consultar_dni_reniec(madre_dni_buscar)
+                        try:
+                            datos_madre = _cached_reniec(madre_dni_buscar)
+                        except LookupError:
+                            datos_madre = None
                 
                     if datos_madre:
                         # ✅ ENCONTRADO EN API RENIEC
@@ -3559,8 +3881,8 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                         nombre_completo = f"{nombres} {apellido_paterno} {apellido_materno}".strip().upper()
                     
                         # Guardar en session_state
-                        st.session_state["madre_nombre"] = nombre_completo
-                        st.session_state["madre_doc_num"] = madre_dni_buscar
+                        ss["madre_nombre"] = nombre_completo
+                        ss["madre_doc_num"] = madre_dni_buscar
                     
                         # 📊 Indicador de origen
                         st.info("📡 **Origen del dato**: API RENIEC (1 petición consumida)")
@@ -3587,158 +3909,75 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                 st.warning("⚠️ El DNI debe tener exactamente 8 dígitos numéricos")
 
        # Si viene de la API de búsqueda, usa ese valor; si no, usa valores de precarga
-        if "madre_nombre" not in st.session_state:
-            st.session_state["madre_nombre"] = valores.get("madre_nombre", "")
+        ss.setdefault("madre_nombre", _norm_up(valores.get("madre_nombre", "")))
 
         madre_nombre = st.text_input(
             "Nombres completos de la Madre",
-            value=st.session_state["madre_nombre"].upper() if st.session_state.get("madre_nombre") else "",
             disabled=disabled,
-            key="madre_nombre"  # 🔑 MANTENER LA KEY ORIGINAL
-        ).upper()
+            key="madre_nombre",  # 🔑 MANTENER LA KEY ORIGINAL
+            on_change=_upper_cb, args=("madre_nombre",),
+        )
 
         # Tipo de documento
-        def _on_change_doc_tipo_madre():
-            if canon_doc(st.session_state.get("madre_doc_tipo")) == "DNI":
-                st.session_state["madre_nacionalidad"] = ""
-
         madre_doc_tipo = st.selectbox(
             "Madre – Tipo de documento",
             DOC_TIPOS_UI,
             index=safe_index(DOC_TIPOS_UI, valores.get("madre_doc_tipo", "DNI"), 0),
             disabled=disabled,
             key="madre_doc_tipo",
-            on_change=_on_change_doc_tipo_madre,
+            on_change=_on_change_doc_tipo, args=("madre",),
         )
 
         # Determina el valor inicial ANTES del widget
-        _madre_doc_val = ""
-        if "madre_dni_auto" in st.session_state and st.session_state["madre_dni_auto"]:
-            _madre_doc_val = st.session_state["madre_dni_auto"]
-        elif "madre_doc_num" in st.session_state and st.session_state["madre_doc_num"]:
-            _madre_doc_val = st.session_state["madre_doc_num"]
-        elif valores.get("madre_doc_num"):
-            _madre_doc_val = valores.get("madre_doc_num")
-        elif valores.get("madre_dni"):
-            _madre_doc_val = valores.get("madre_dni")
+        # (auto de RENIEC > lo ya escrito > precarga; cada key se lee una sola vez)
+        _madre_doc_val = (
+            ss.get("madre_dni_auto")
+            or ss.get("madre_doc_num")
+            or valores.get("madre_doc_num")
+            or valores.get("madre_dni")
+            or ""
+        )
 
+        _madre_canon = canon_doc(madre_doc_tipo)
         madre_doc_num = st.text_input(
-            f"Madre – Nº {'DNI' if canon_doc(madre_doc_tipo)=='DNI' else ('Pasaporte' if canon_doc(madre_doc_tipo)=='PASAPORTE' else 'DNI Extranjero')}",
+            f"Madre – Nº {_DOC_LABEL.get(_madre_canon, 'DNI Extranjero')}",
             value=_madre_doc_val,
             disabled=disabled,
             key="madre_doc_num"
         )
 
         # Nacionalidad (solo si es pasaporte/extranjero)
+        ss.setdefault("madre_nacionalidad", _norm_up(valores.get("madre_nacionalidad","")))
         madre_nac = st.text_input(
             "Madre – Nacionalidad (si Pasaporte/DNI Extranjero)",
-            value=s(st.session_state.get("madre_nacionalidad", valores.get("madre_nacionalidad",""))).upper(),
-            disabled=disabled or (canon_doc(madre_doc_tipo) == "DNI"),
-            key="madre_nacionalidad"
-        ).upper()
+            disabled=disabled or (_madre_canon == "DNI"),
+            key="madre_nacionalidad",
+            on_change=_upper_cb, args=("madre_nacionalidad",),
+        )
 
         # Estado civil
+        ss.setdefault("madre_estado_civil", _norm_up(valores.get("madre_estado_civil","")))
         madre_ec = st.text_input(
             "Madre – Estado civil",
-            value=s(st.session_state.get("madre_estado_civil", valores.get("madre_estado_civil",""))).upper(),
             disabled=disabled,
-            key="madre_estado_civil"
-        ).upper()
+            key="madre_estado_civil",
+            on_change=_upper_cb, args=("madre_estado_civil",),
+        )
 
         # 🆕 Domicilio con UBIGEO en cascada
         st.markdown("**Domicilio de la Madre:**")
 
         # Dirección (calle y número)
+        ss.setdefault("madre_direccion", _norm_up(valores.get("madre_direccion","")))
         madre_direccion = st.text_input(
             "Dirección (calle, número, urbanización)",
-            value=s(st.session_state.get("madre_direccion", valores.get("madre_direccion",""))).upper(),
             disabled=disabled,
-            key="madre_direccion"
-        ).upper()
-
-        # 🔧 Callbacks para limpiar cascada
-        def _on_change_madre_depto():
-            """Cuando cambia el departamento de la madre, limpia provincia y distrito"""
-            # Limpia selectores
-            st.session_state.pop("madre_provincia_sel", None)
-            st.session_state.pop("madre_distrito_sel", None)
-        
-            # 🔥 NUEVO: Limpia cachés de provincias/distritos
-            keys_to_remove = [k for k in st.session_state.keys() 
-                              if k.startswith("provincias_") or k.startswith("distritos_")]
-            for k in keys_to_remove:
-                st.session_state.pop(k, None)
-
-        def _on_change_madre_prov():
-            """Cuando cambia la provincia de la madre, limpia distrito"""
-            st.session_state.pop("madre_distrito_sel", None)
-
-        # Selector de UBIGEO en cascada
-        col_u1, col_u2, col_u3 = st.columns(3)
-
-        # 🔥 MISMO sufijo dinámico que usamos para el padre
-        _pid_suffix = f"_{st.session_state.get('pid_editing', 0)}" if st.session_state.get("modo_edicion", False) else ""
-
-        with col_u1:
-            # Usar la misma lista de departamentos que ya cargamos para el padre
-            if "departamentos_list" not in st.session_state:
-                with st.spinner("Cargando departamentos..."):
-                    st.session_state["departamentos_list"] = obtener_departamentos()
-
-            madre_departamento = st.selectbox(
-                "Departamento",
-                options=[""] + st.session_state.get("departamentos_list", []),
-                index=0 if not valores.get("madre_departamento") else (
-                    st.session_state.get("departamentos_list", []).index(valores.get("madre_departamento")) + 1 
-                    if valores.get("madre_departamento") in st.session_state.get("departamentos_list", []) else 0
-                ),
-                disabled=disabled,
-                key=f"madre_departamento_sel{_pid_suffix}",  # 🔥 KEY DINÁMICA
-                on_change=_on_change_madre_depto
-            )
+            key="madre_direccion",
+            on_change=_upper_cb, args=("madre_direccion",),
+        )
 
-        with col_u2:
-            if madre_departamento:
-                # Cargar provincias del departamento seleccionado
-                cache_key = f"provincias_{madre_departamento}"
-                if cache_key not in st.session_state:
-                    with st.spinner("Cargando provincias..."):
-                        st.session_state[cache_key] = obtener_provincias(madre_departamento)
-
-                madre_provincia = st.selectbox(
-                    "Provincia",
-                    options=[""] + st.session_state.get(cache_key, []),
-                    index=0 if not valores.get("madre_provincia") else (
-                        st.session_state.get(cache_key, []).index(valores.get("madre_provincia")) + 1 
-                        if valores.get("madre_provincia") in st.session_state.get(cache_key, []) else 0
-                    ),
-                    disabled=disabled,
-                    key=f"madre_provincia_sel{_pid_suffix}",  # 🔥 KEY DINÁMICA
-                    on_change=_on_change_madre_prov
-                )
-            else:
-                madre_provincia = st.selectbox("Provincia", [""], key=f"madre_provincia_sel_empty{_pid_suffix}", disabled=True)
-
-        with col_u3:
-            if madre_departamento and madre_provincia:
-                # Cargar distritos de la provincia seleccionada
-                cache_key = f"distritos_{madre_departamento}_{madre_provincia}"
-                if cache_key not in st.session_state:
-                    with st.spinner("Cargando distritos..."):
-                        st.session_state[cache_key] = obtener_distritos(madre_departamento, madre_provincia)
-
-                madre_distrito = st.selectbox(
-                    "Distrito",
-                    options=[""] + st.session_state.get(cache_key, []),
-                    index=0 if not valores.get("madre_distrito") else (
-                        st.session_state.get(cache_key, []).index(valores.get("madre_distrito")) + 1 
-                        if valores.get("madre_distrito") in st.session_state.get(cache_key, []) else 0
-                    ),
-                    disabled=disabled,
-                    key=f"madre_distrito_sel{_pid_suffix}"  # 🔥 KEY DINÁMICA
-                )
-            else:
-                madre_distrito = st.selectbox("Distrito", [""], key=f"madre_distrito_sel_empty{_pid_suffix}", disabled=True)
+        # Selector de UBIGEO en cascada (fragmento: no re-ejecuta todo el formulario)
+        madre_departamento, madre_provincia, madre_distrito = _ubigeo_cascada("madre", valores, disabled, _pid_suffix)
 
         # Guardar valores en variables normales (no solo session_state)
         madre_dist = madre_distrito
@@ -3764,25 +4003,16 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
     # ============ 4) Menor ============
     st.subheader("4) Menor")
 
-    # Usa el helper de arriba
-    def safe_index(options: list[str], value: str | None, default_idx: int = 0) -> int:
-        v = (value or "").strip().upper()
-        try:
-            return options.index(v)
-        except Exception:
-            return default_idx
-
     opciones_doc_menor = DOC_TIPOS_UI
 
     # --- Buscador por documento del MENOR (MEJORADO - solo BD local) ---
     st.caption("🔎 Buscar MENOR por DNI/Pasaporte")
-    doc_menor = st.text_input("Doc. MENOR", key="doc_busca_menor", disabled=(disabled or st.session_state.get("modo_edicion", False))).strip().upper()
+    doc_menor = _norm_up(st.text_input("Doc. MENOR", key="doc_busca_menor", disabled=(disabled or modo_edicion)))
 
     col_m1, col_m2 = st.columns(2)
     with col_m1:
         # Deshabilita si estamos cambiando de modo
-        en_transicion = st.session_state.get("_modo_transitorio", False)
-        if st.button("Buscar MENOR", key="btn_buscar_menor", disabled=(disabled or st.session_state.get("modo_edicion", False) or en_transicion)):
+        if st.button("Buscar MENOR", key="btn_buscar_menor", disabled=(disabled or modo_edicion or en_transicion)):
             if not doc_menor:
                 st.warning("⚠️ Ingresa el documento del MENOR para buscar.")
             else:
@@ -3790,7 +4020,7 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                 # 🔥 Búsqueda en BD LOCAL (menores normalmente no usan API)
                 # ═══════════════════════════════════════════════════════
                 with st.spinner("🔎 Buscando en permisos anteriores..."):
-                    perm = search_por_doc_y_rol(doc_menor, "MENOR")
+                    perm = _cached_local_lookup(doc_menor, "MENOR")
             
                 if perm:
                     # ✅ ENCONTRADO EN BD LOCAL
@@ -3809,16 +4039,16 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
                     
                         # NO inferir tipo de documento (respetar lo que viene del registro)
                         if not vals_men.get("menor_doc_tipo"):
-                            vals_men["menor_doc_tipo"] = st.session_state.get("menor_doc_tipo", "DNI")
+                            vals_men["menor_doc_tipo"] = ss.get("menor_doc_tipo", "DNI")
                     
-                        # Guardar en session_state
-                        st.session_state.prefill_menor = vals_men
-                        for k in ("menor_nombre", "menor_doc_tipo", "menor_doc_num", "menor_nacionalidad",
-                                  "menor_fnac", "sexo_menor", "menor_dni"):
-                            if k == "menor_fnac":
-                                st.session_state[k] = parse_iso(vals_men.get(k)) or date(2015, 1, 1)
-                            else:
-                                st.session_state[k] = vals_men.get(k, "")
+                        # Guardar en session_state (un solo update)
+                        payload = {k: vals_men.get(k, "") for k in (
+                            "menor_nombre", "menor_doc_tipo", "menor_doc_num", "menor_nacionalidad",
+                            "sexo_menor", "menor_dni",
+                        )}
+                        payload["menor_fnac"] = parse_iso(vals_men.get("menor_fnac")) or date(2015, 1, 1)
+                        payload["prefill_menor"] = vals_men
+                        ss.update(payload)
                     
                         # 📊 Indicador de origen (trazabilidad)
                         st.info(f"📋 **Origen del dato**: Permiso N° {perm.get('numero'):04d}-NSC-{perm.get('anio')} (búsqueda local)")
@@ -3831,18 +4061,18 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
 
     with col_m2:
         # Deshabilita si estamos cambiando de modo
-        en_transicion = st.session_state.get("_modo_transitorio", False)
-        st.button("Limpiar MENOR", key="btn_limpiar_menor", on_click=_limpiar_menor_cb, disabled=(disabled or st.session_state.get("modo_edicion", False) or en_transicion))
+        st.button("Limpiar MENOR", key="btn_limpiar_menor", on_click=_limpiar_menor_cb, disabled=(disabled or modo_edicion or en_transicion))
 
     # --- Campos del MENOR (mismo estilo que Padre/Madre) ---
     m1, m2, m3 = st.columns(3)
     with m1:
+        ss.setdefault("menor_nombre", _norm_up(valores.get("menor_nombre", "")))
         menor_nombre = st.text_input(
             "Menor – Nombres y Apellidos",
-            value=s(valores.get("menor_nombre", "")).upper(),
             disabled=disabled,
-            key="menor_nombre"  # mantiene tu key
-        ).upper()
+            key="menor_nombre",  # mantiene tu key
+            on_change=_upper_cb, args=("menor_nombre",),
+        )
 
     with m2:
         # 🔥 CAMBIO: Ahora SEXO va en la columna 2
@@ -3857,51 +4087,46 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
 
     with m3:
         # 🔥 CAMBIO: Ahora TIPO DE DOC va en la columna 3
-        # Callback del menor: definir ANTES del selectbox
-        def _on_change_doc_tipo_menor():
-            if canon_doc(st.session_state.get("menor_doc_tipo")) == "DNI":
-                st.session_state["menor_nacionalidad"] = ""
-
         menor_doc_tipo = st.selectbox(
             "Menor – Tipo de documento",
             DOC_TIPOS_UI,
             index=safe_index(DOC_TIPOS_UI, valores.get("menor_doc_tipo", "DNI"), 0),
             disabled=disabled,
             key="menor_doc_tipo",
-            on_change=_on_change_doc_tipo_menor,  # <- AQUÍ
+            on_change=_on_change_doc_tipo, args=("menor",),  # <- AQUÍ
         )
 
     # 🔧 Normaliza la fecha del MENOR en session_state a datetime.date
-    _fnac_state = st.session_state.get("menor_fnac", (valores.get("menor_fnac") or None))
-    if isinstance(_fnac_state, str):
-        # parse_iso debe devolver datetime.date o None si no puede
-        _fnac_state = parse_iso(_fnac_state)
-    if _fnac_state is None:
-        _fnac_state = date(2015, 1, 1)
-    st.session_state["menor_fnac"] = _fnac_state
+    #    (solo si aún no es date: tras el primer render el date_input ya la deja así)
+    if not isinstance(ss.get("menor_fnac"), date):
+        _fnac_state = ss.get("menor_fnac", (valores.get("menor_fnac") or None))
+        if isinstance(_fnac_state, str):
+            # parse_iso debe devolver datetime.date o None si no puede
+            _fnac_state = parse_iso(_fnac_state)
+        ss["menor_fnac"] = _fnac_state or date(2015, 1, 1)
     # Número (dinámico según tipo)
+    _menor_canon = canon_doc(menor_doc_tipo)
     menor_doc_num = st.text_input(
-        f"Menor – Nº {'DNI' if canon_doc(menor_doc_tipo)=='DNI' else ('Pasaporte' if canon_doc(menor_doc_tipo)=='PASAPORTE' else 'DNI Extranjero')}",
+        f"Menor – Nº {_DOC_LABEL.get(_menor_canon, 'DNI Extranjero')}",
         value=s(valores.get("menor_doc_num") or valores.get("menor_dni", "")),
         disabled=disabled,
         key="menor_doc_num"
     )
 
     # Nacionalidad: solo si PASAPORTE (si es DNI, deshabilitada)
+    ss.setdefault("menor_nacionalidad", _norm_up(valores.get("menor_nacionalidad", "")))
     menor_nac = st.text_input(
         "Menor – Nacionalidad (si Pasaporte/DNI Extranjero)",
-        value=s(valores.get("menor_nacionalidad", "")).upper(),
-        disabled=disabled or (canon_doc(menor_doc_tipo) == "DNI"),
-        key="menor_nacionalidad"
-    ).upper()
+        disabled=disabled or (_menor_canon == "DNI"),
+        key="menor_nacionalidad",
+        on_change=_upper_cb, args=("menor_nacionalidad",),
+    )
     
 
 
-    # Fecha de nacimiento: ¡UN SOLO date_input!
-    fnac_default = parse_iso(valores.get("menor_fnac")) or date(2015, 1, 1)
+    # Fecha de nacimiento: ¡UN SOLO date_input! (el valor lo da la key, ya normalizada arriba)
     fnac = st.date_input(
         "Fecha de nacimiento",
-        value=fnac_default,
         min_value=date(1900, 1, 1),
         max_value=date.today(),
         disabled=disabled,
@@ -3910,163 +4135,146 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
     # === 3) Menor ===
     st.markdown("### 👨‍👩‍👧‍👦 Hermanos biológicos (opcional)")
 
-    if st.button("➕ Agregar hermano biológico", key="btn_add_hermano"):
-        # (El dict aquí es solo un slot visual; los valores reales viven en session_state)
-        st.session_state.hermanos.append({"nombre": "", "dni": "", "fnac": None})
-        st.rerun()
+    st.button("➕ Agregar hermano biológico", key="btn_add_hermano", on_click=_agregar_hermano_cb)
 
     _min_d = date(1900, 1, 1)
     _max_d = date.today()
 
-    for i in range(len(st.session_state.hermanos)):
-        st.divider()
-        st.markdown(f"**Hermano {i+1}**")
+    _n_hermanos = len(ss.hermanos)
+    for i in range(_n_hermanos):
+        # Keys del hermano i (se formatean una sola vez por iteración)
+        k_nombre, k_sexo, k_tipo = f"hermano_nombre_{i}", f"hermano_sexo_{i}", f"hermano_doc_tipo_{i}"
+        k_doc, k_fnac, k_nac = f"hermano_doc_num_{i}", f"hermano_fnac_{i}", f"hermano_nacionalidad_{i}"
+        curr_tipo = _norm_up(ss.get(k_tipo)) or "DNI"
 
-        # Nombre y sexo
-        c1, c2 = st.columns([2, 1])
-        with c1:
-            st.text_input(
-                f"Hermano {i+1} – Nombre completo",
-                key=f"hermano_nombre_{i}",
-                value=st.session_state.get(f"hermano_nombre_{i}", "")
-            )
-        with c2:
-            st.selectbox(
-                f"Hermano {i+1} – Sexo",
-                ["F", "M"],
-                key=f"hermano_sexo_{i}",
-                index=0 if st.session_state.get(f"hermano_sexo_{i}", "F") == "F" else 1
-            )
+        # Cada hermano en su expander; solo el último (el recién agregado) se muestra abierto.
+        # Rótulo fijo: si incluyera el nombre, el expander se recrearía (y cerraría) al escribirlo.
+        with st.expander(f"Hermano {i+1}", expanded=(i == _n_hermanos - 1)):
 
-        # Tipo/N° de documento
-        c3, c4 = st.columns([1, 1])
-        with c3:
-            _h_opts = ["DNI", "PASAPORTE", "DNI EXTRANJERO"]
-            _curr   = (st.session_state.get(f"hermano_doc_tipo_{i}", "DNI") or "DNI").upper()
-            _idx    = _h_opts.index(_curr) if _curr in _h_opts else 0
-
-            st.selectbox(
-                f"Hermano {i+1} – Tipo de documento",
-                _h_opts,
-                key=f"hermano_doc_tipo_{i}",
-                index=_idx
-            )
+            # Nombre y sexo
+            c1, c2 = st.columns([2, 1])
+            with c1:
+                st.text_input(
+                    f"Hermano {i+1} – Nombre completo",
+                    key=k_nombre,
+                )
+            with c2:
+                st.selectbox(
+                    f"Hermano {i+1} – Sexo",
+                    ["F", "M"],
+                    key=k_sexo,
+                    index=0 if ss.get(k_sexo, "F") == "F" else 1
+                )
 
-        with c4:
-            # ✅ ESTA ES LA PARTE QUE PREGUNTABAS (va aquí)
-            lbl = "Nº DNI" if _curr == "DNI" else ("Nº Pasaporte" if _curr == "PASAPORTE" else "Nº DNI Extranjero")
-            st.text_input(
-                f"Hermano {i+1} – {lbl}",
-                key=f"hermano_doc_num_{i}",
-                value=st.session_state.get(f"hermano_doc_num_{i}", "")
-            )
+            # Tipo/N° de documento
+            c3, c4 = st.columns([1, 1])
+            with c3:
+                _h_opts = ["DNI", "PASAPORTE", "DNI EXTRANJERO"]
+                _idx    = _h_opts.index(curr_tipo) if curr_tipo in _h_opts else 0
+
+                st.selectbox(
+                    f"Hermano {i+1} – Tipo de documento",
+                    _h_opts,
+                    key=k_tipo,
+                    index=_idx
+                )
+
+            with c4:
+                # ✅ ESTA ES LA PARTE QUE PREGUNTABAS (va aquí)
+                lbl = f"Nº {_DOC_LABEL[canon_doc(curr_tipo)]}"
+                st.text_input(
+                    f"Hermano {i+1} – {lbl}",
+                    key=k_doc,
+                )
         
-        # Nacionalidad del hermano (solo si PASAPORTE o DNI EXTRANJERO)
-        _h_tipo = (st.session_state.get(f"hermano_doc_tipo_{i}", "DNI") or "DNI").upper()
-        if _h_tipo in ("PASAPORTE", "DNI EXTRANJERO"):
-            st.text_input(
-                f"Hermano {i+1} – Nacionalidad",
-                key=f"hermano_nacionalidad_{i}",
-                value=st.session_state.get(f"hermano_nacionalidad_{i}", "")
-            )
-        else:
-            # Si cambian a DNI, limpiamos la nacionalidad para no guardar basura
-            st.session_state.pop(f"hermano_nacionalidad_{i}", None)
+            # Nacionalidad del hermano (solo si PASAPORTE o DNI EXTRANJERO)
+            if curr_tipo in ("PASAPORTE", "DNI EXTRANJERO"):
+                st.text_input(
+                    f"Hermano {i+1} – Nacionalidad",
+                    key=k_nac,
+                )
+            else:
+                # Si cambian a DNI, limpiamos la nacionalidad para no guardar basura
+                ss.pop(k_nac, None)
   
-        # Fecha de nacimiento — MISMO RANGO QUE EL MENOR (1900…HOY)
-        _h_fnac_val = st.session_state.get(f"hermano_fnac_{i}", None)
-        if _h_fnac_val is None:
-            # default estable dentro del rango (puedes cambiarlo si quieres)
-            _h_fnac_val = date(2015, 1, 1)
-        # Recorta por si viene algo fuera de rango (seguridad)
-        if _h_fnac_val < _min_d: _h_fnac_val = _min_d
-        if _h_fnac_val > _max_d: _h_fnac_val = _max_d
-
-        st.date_input(
-            f"Hermano {i+1} – Fecha de nacimiento",
-            key=f"hermano_fnac_{i}",
-            value=_h_fnac_val,
-            min_value=_min_d,
-            max_value=_max_d,
-        )
+            # Fecha de nacimiento — MISMO RANGO QUE EL MENOR (1900…HOY)
+            _h_fnac_val = ss.get(k_fnac, None)
+            if _h_fnac_val is None:
+                # default estable dentro del rango (puedes cambiarlo si quieres)
+                _h_fnac_val = date(2015, 1, 1)
+            # Recorta por si viene algo fuera de rango (seguridad)
+            if _h_fnac_val < _min_d: _h_fnac_val = _min_d
+            if _h_fnac_val > _max_d: _h_fnac_val = _max_d
+
+            st.date_input(
+                f"Hermano {i+1} – Fecha de nacimiento",
+                key=k_fnac,
+                value=_h_fnac_val,
+                min_value=_min_d,
+                max_value=_max_d,
+            )
 
-        # Eliminar hermano
-        cols = st.columns([1, 4])
-        with cols[0]:
-            if st.button(f"❌ Eliminar", key=f"del_hermano_{i}"):
-                for kk in (
-                    f"hermano_nombre_{i}",
-                    f"hermano_sexo_{i}",
-                    f"hermano_doc_tipo_{i}",
-                    f"hermano_doc_num_{i}",
-                    f"hermano_fnac_{i}",
-                    f"hermano_nacionalidad_{i}",   # <- NUEVO: limpiar nacionalidad también
-                ):
-                    st.session_state.pop(kk, None)
-                st.session_state.hermanos.pop(i)
-                st.rerun()
+            # Eliminar hermano
+            cols = st.columns([1, 4])
+            with cols[0]:
+                if st.button(f"❌ Eliminar", key=f"del_hermano_{i}"):
+                    for kk in (k_nombre, k_sexo, k_tipo, k_doc, k_fnac, k_nac):
+                        ss.pop(kk, None)
+                    ss.hermanos.pop(i)
+                    st.rerun()
 
     # Edad calculada (en memoria, para validación y template)
-    edad_num = calcular_edad(fnac.strftime("%Y-%m-%d"))
-    edad_letras = edad_en_letras(edad_num)
+    edad_num, edad_letras = _edad_cached(fnac, date.today())
     if (edad_num >= 18) and (not disabled):
         st.warning("⚠ La persona ya es *mayor de edad* (18+). Este permiso es para *menores*.")
 
     st.subheader("5) Viaje")
     v1, v2 = st.columns(2)
     with v1:
-        origen = st.text_input(
+        origen = _norm_up(st.text_input(
             "Origen",
-            value=s(valores.get("origen", "")).upper(),
+            value=_norm_up(valores.get("origen", "")),
             disabled=disabled
-        ).upper()
-        destino = st.text_input(
+        ))
+        destino = _norm_up(st.text_input(
             "Destino",
-            value=s(valores.get("destino", "")).upper(),
+            value=_norm_up(valores.get("destino", "")),
             disabled=disabled
-        ).upper()
+        ))
     with v2:
-        vias_permitidas = ["TERRESTRE", "AÉREA"]
-        vtx = s(valores.get("vias", ""))
-        if isinstance(valores.get("vias"), list):
-            vias_pre = [v for v in valores["vias"] if v in vias_permitidas]
+        _vias_val = valores.get("vias")
+        if isinstance(_vias_val, list):
+            vias_pre = [v for v in _vias_val if v in _VIAS_SET]
         else:
-            if "Y/O" in vtx:
-                vias_pre = [p.strip().upper() for p in vtx.split("Y/O") if p.strip().upper() in vias_permitidas]
-            elif vtx:
-                vias_pre = [vtx.upper()] if vtx.upper() in vias_permitidas else []
-            else:
-                vias_pre = []
+            # "AÉREA Y/O TERRESTRE" o una sola vía (split sin "Y/O" devuelve el texto entero)
+            vias_pre = [u for p in s(_vias_val).split("Y/O") if (u := p.strip().upper()) in _VIAS_SET]
         if not vias_pre:
             vias_pre = ["AÉREA"]
 
-        vias = st.multiselect("Vía", vias_permitidas, default=vias_pre, disabled=disabled)
-        empresa = st.text_input(
+        vias = st.multiselect("Vía", _VIAS_PERMITIDAS, default=vias_pre, disabled=disabled)
+        empresa = _norm_up(st.text_input(
             "Empresa (opcional)",
-            value=s(valores.get("empresa", "")).upper(),
+            value=_norm_up(valores.get("empresa", "")),
             disabled=disabled
-        ).upper()
+        ))
 
+    _retorno_iso = s(valores.get("retorno"))
     fs_default = parse_iso(valores.get("salida")) or date.today()
-    fr_default = parse_iso(valores.get("retorno")) or date.today()
+    fr_default = parse_iso(_retorno_iso) or date.today()
     fs = st.date_input("Fecha de salida", value=fs_default, disabled=disabled)
 
-    tiene_retorno_default = bool(s(valores.get("retorno", "")))
+    tiene_retorno_default = bool(_retorno_iso)
     tiene_retorno = st.toggle("Tiene fecha de retorno", value=tiene_retorno_default, disabled=disabled)
     fr = st.date_input("Fecha de retorno", value=fr_default, disabled=(not tiene_retorno or disabled)) if tiene_retorno else None
 
     st.subheader("6) Acompañante / Observaciones")
 
         # --- Opciones (con nuevo rótulo y compatibilidad hacia atrás) ---
-    opciones_acomp = ["PADRE", "MADRE", "AMBOS", "TERCERO", "SOLO(A)/SOLOS(AS)"]
-    _ini = s(valores.get("acompanante", "SOLO")).upper()
-    if _ini == "SOLO":
-        _ini = "SOLO(A)/SOLOS(AS)"  # compatibilidad con permisos antiguos
-    acomp_idx = safe_index(opciones_acomp, _ini, opciones_acomp.index("SOLO(A)/SOLOS(AS)"))
+    acomp_idx = _ACOMP_IDX.get(_norm_up(valores.get("acompanante", "SOLO")), _ACOMP_SOLO_IDX)
 
     acompanante = st.radio(
         "¿Quién acompaña? (si viaja solo/a, elige 'SOLO(A)/SOLOS(AS)')",
-        opciones_acomp,
+        _ACOMP_OPCIONES,
         index=acomp_idx,
         horizontal=True,
         disabled=disabled
@@ -4097,61 +4305,54 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
 
     elif acompanante == "TERCERO":
         # --- Inicializar lista de terceros en session_state ---
-        if "terceros" not in st.session_state:
-            st.session_state.terceros = []
+        if "terceros" not in ss:
+            ss.terceros = []
     
         # Si no hay ninguno, crea el primero automáticamente
-        if len(st.session_state.terceros) == 0:
-            st.session_state.terceros.append({})
+        if len(ss.terceros) == 0:
+            ss.terceros.append({})
     
-        acomp_count = len(st.session_state.terceros)
+        acomp_count = len(ss.terceros)
     
         # --- Botón para agregar más terceros ---
-        if st.button("➕ Agregar tercero adicional", key="btn_add_tercero"):
-            st.session_state.terceros.append({})
-            st.rerun()
+        st.button("➕ Agregar tercero adicional", key="btn_add_tercero", on_click=_agregar_tercero_cb)
     
         st.markdown("---")
     
         # --- Renderizar campos para cada tercero ---
-        for i in range(len(st.session_state.terceros)):
-            st.markdown(f"**Tercero {i+1}**")
-        
-            col1, col2 = st.columns([2, 1])
-            with col1:
+        _n_terceros = len(ss.terceros)
+        for i in range(_n_terceros):
+            # Cada tercero en su expander; solo el último (el recién agregado) abierto
+            with st.expander(f"Tercero {i+1}", expanded=(i == _n_terceros - 1)):
+                col1, col2 = st.columns([2, 1])
+                with col1:
+                    st.text_input(
+                        f"Parentesco del tercero {i+1} (TUTOR/TUTORA/TÍA/TÍO/ABUELO/ABUELA/HERMANO/HERMANA)",
+                        key=f"tercero_rol_{i}",
+                        disabled=disabled
+                    )
+                with col2:
+                    pass  # Espacio visual
+
                 st.text_input(
-                    f"Parentesco del tercero {i+1} (TUTOR/TUTORA/TÍA/TÍO/ABUELO/ABUELA/HERMANO/HERMANA)",
-                    key=f"tercero_rol_{i}",
-                    value=st.session_state.get(f"tercero_rol_{i}", ""),
+                    f"Nombre del tercero {i+1}",
+                    key=f"tercero_nombre_{i}",
                     disabled=disabled
                 )
-            with col2:
-                pass  # Espacio visual
-        
-            st.text_input(
-                f"Nombre del tercero {i+1}",
-                key=f"tercero_nombre_{i}",
-                value=st.session_state.get(f"tercero_nombre_{i}", ""),
-                disabled=disabled
-            )
-        
-            st.text_input(
-                f"DNI/Pasaporte del tercero {i+1}",
-                key=f"tercero_dni_{i}",
-                value=st.session_state.get(f"tercero_dni_{i}", ""),
-                disabled=disabled
-            )
-        
-            # Botón eliminar (solo si hay más de 1 tercero)
-            if len(st.session_state.terceros) > 1:
-                if st.button(f"❌ Eliminar tercero {i+1}", key=f"del_tercero_{i}"):
-                    # Limpiar keys del session_state
-                    for k in (f"tercero_rol_{i}", f"tercero_nombre_{i}", f"tercero_dni_{i}"):
-                        st.session_state.pop(k, None)
-                    st.session_state.terceros.pop(i)
-                    st.rerun()
-        
-            st.markdown("---")
+
+                st.text_input(
+                    f"DNI/Pasaporte del tercero {i+1}",
+                    key=f"tercero_dni_{i}",
+                    disabled=disabled
+                )
+
+                # Botón eliminar (solo si hay más de 1 tercero)
+                if len(ss.terceros) > 1:
+                    # on_click: reindexa las keys antes del rerun (dentro del script ya no se
+                    # pueden reescribir las de widgets que se dibujaron en esta pasada)
+                    st.button(f"❌ Eliminar tercero {i+1}", key=f"del_tercero_{i}",
+                              on_click=_eliminar_tercero_cb, args=(i,))
+
     
         # Recopilar datos de todos los terceros para el payload
         rol_acompanante = ""  # No se usa en múltiples terceros
@@ -4168,142 +4369,119 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
         recibe_si = st.selectbox(
             "Seleccione una opción",
             ["NO", "SI"],
-            index=1 if s(valores.get("recibe_si","NO")).upper()=="SI" else 0,
+            index=1 if _norm_up(valores.get("recibe_si","NO"))=="SI" else 0,
             key="recibe_si",
             disabled=disabled
         )
 
         # --------- LIMPIEZA ESTRICTA CUANDO ES "NO" ---------
-        if s(st.session_state.get("recibe_si","NO")).upper() == "NO":
-            # 1) contador a 0
-            st.session_state["rec_list_count"] = 0
-            # 2) borra TODAS las filas dinámicas rec_*_i si las hubiera
-            i = 0
-            while True:
-                had_any = False
-                for kk in (f"rec_nombre_{i}", f"rec_doc_tipo_{i}", f"rec_doc_num_{i}", f"rec_doc_pais_{i}"):
-                    if kk in st.session_state:
-                        st.session_state.pop(kk, None)
-                        had_any = True
-                if not had_any:
-                    break
-                i += 1
-            # (opcional) deja también vacíos los campos "simples" por compat
-            for kk in ("rec_nombre","rec_doc_tipo","rec_doc_num","rec_doc_pais"):
-                st.session_state.pop(kk, None)
+        if _norm_up(ss.get("recibe_si","NO")) == "NO":
+            # contador a 0 + borra TODAS las filas rec_*_i y los campos "simples" (compat)
+            _purge_rec_keys(ss)
             # No renderizamos filas si es NO
         else:
             # ====== SI = "SI" → mostrar/editar filas ======
             # Inicializa contador (mínimo 1) de forma segura
-            if "rec_list_count" not in st.session_state:
-                st.session_state["rec_list_count"] = max(1, int(valores.get("rec_list_count", 0)))
-            total = int(st.session_state["rec_list_count"])
+            if "rec_list_count" not in ss:
+                ss["rec_list_count"] = max(1, int(valores.get("rec_list_count", 0)))
+            total = int(ss["rec_list_count"])
 
             for i in range(total):
-                st.markdown(f"Persona que recibe #{i+1}")
-
-                c1, c2 = st.columns([2, 1])
-                with c1:
-                    st.text_input(
-                        "Nombre completo de la persona que recibe",
-                        value=s(st.session_state.get(f"rec_nombre_{i}", "")).upper(),
-                        key=f"rec_nombre_{i}",
-                        disabled=disabled
-                    )
-                with c2:
-                    st.selectbox(
-                        "Documento de la persona que recibe",
-                        ["DNI PERUANO", "DNI EXTRANJERO", "PASAPORTE"],
-                        index=0 if s(st.session_state.get(f"rec_doc_tipo_{i}",""))=="" else
-                           ["DNI PERUANO", "DNI EXTRANJERO", "PASAPORTE"].index(
-                               s(st.session_state.get(f"rec_doc_tipo_{i}","DNI PERUANO")).upper()
-                        ),
-                        key=f"rec_doc_tipo_{i}",
-                        disabled=disabled
-                    )
+                with st.expander(f"Persona que recibe #{i+1}", expanded=(i == total - 1)):
+                    c1, c2 = st.columns([2, 1])
+                    with c1:
+                        st.text_input(
+                            "Nombre completo de la persona que recibe",
+                            key=f"rec_nombre_{i}",
+                            on_change=_upper_cb, args=(f"rec_nombre_{i}",),
+                            disabled=disabled
+                        )
+                    with c2:
+                        tipo_i = st.selectbox(
+                            "Documento de la persona que recibe",
+                            _REC_DOC_TIPOS,
+                            index=_REC_DOC_TIPO_IDX.get(_norm_up(ss.get(f"rec_doc_tipo_{i}")), 0),
+                            key=f"rec_doc_tipo_{i}",
+                            disabled=disabled
+                        )
 
-                c3, c4 = st.columns(2)
-                with c3:
-                    st.text_input(
-                        "N° de documento",
-                        value=s(st.session_state.get(f"rec_doc_num_{i}", "")),
-                        key=f"rec_doc_num_{i}",
-                        disabled=disabled
-                    )
-                with c4:
-                    tipo_i = st.session_state.get(f"rec_doc_tipo_{i}", "DNI PERUANO")
-                    st.text_input(
-                        "País del DNI extranjero (p.ej. DEL REINO DE ESPAÑA)",
-                        value=s(st.session_state.get(f"rec_doc_pais_{i}", "")).upper(),
-                        key=f"rec_doc_pais_{i}",
-                        disabled=disabled or (tipo_i != "DNI EXTRANJERO")
-                    )
+                    c3, c4 = st.columns(2)
+                    with c3:
+                        st.text_input(
+                            "N° de documento",
+                            key=f"rec_doc_num_{i}",
+                            disabled=disabled
+                        )
+                    with c4:
+                        st.text_input(
+                            "País del DNI extranjero (p.ej. DEL REINO DE ESPAÑA)",
+                            key=f"rec_doc_pais_{i}",
+                            on_change=_upper_cb, args=(f"rec_doc_pais_{i}",),
+                            disabled=disabled or (tipo_i != "DNI EXTRANJERO")
+                        )
 
             cadd, crem = st.columns(2)
             with cadd:
-                if st.button("➕ Agregar otra persona que recibe", use_container_width=True):
-                    st.session_state["rec_list_count"] += 1
-                    st.rerun()
+                st.button("➕ Agregar otra persona que recibe", use_container_width=True, on_click=_agregar_rec_cb)
             with crem:
-                if st.session_state["rec_list_count"] > 1 and st.button("➖ Quitar la última", use_container_width=True):
-                    st.session_state["rec_list_count"] -= 1
-                    # limpia claves de la última fila
-                    i = st.session_state["rec_list_count"]
-                    for kk in (f"rec_nombre_{i}", f"rec_doc_tipo_{i}", f"rec_doc_num_{i}", f"rec_doc_pais_{i}"):
-                        st.session_state.pop(kk, None)
-                    st.rerun()
+                if ss["rec_list_count"] > 1:
+                    st.button("➖ Quitar la última", use_container_width=True, on_click=_quitar_rec_cb)
 
     else:
         # --------- NO VIAJAN SOLOS → LIMPIEZA COMPLETA ---------
-        st.session_state["recibe_si"] = "NO"
-        st.session_state["rec_list_count"] = 0
-        i = 0
-        while True:
-            had_any = False
-            for kk in (f"rec_nombre_{i}", f"rec_doc_tipo_{i}", f"rec_doc_num_{i}", f"rec_doc_pais_{i}"):
-                if kk in st.session_state:
-                    st.session_state.pop(kk, None)
-                    had_any = True
-            if not had_any:
-                break
-            i += 1
-        for kk in ("rec_nombre","rec_doc_tipo","rec_doc_num","rec_doc_pais"):
-            st.session_state.pop(kk, None)
+        ss["recibe_si"] = "NO"
+        _purge_rec_keys(ss)
     # ================== FIN RECEPCIÓN AL ARRIBO ==================
 
     st.subheader("7) Motivo del viaje")
-    motivo = st.text_input(
+    motivo = _norm_up(st.text_input(
         "Motivo",
-        value=s(valores.get("motivo", "")).upper(),
+        value=_norm_up(valores.get("motivo", "")),
         disabled=disabled
-    ).upper()
-    ciudad_evento = st.text_input(
+    ))
+    ciudad_evento = _norm_up(st.text_input(
         "Ciudad del evento (opcional)",
-        value=s(valores.get("ciudad_evento", "")).upper(),
+        value=_norm_up(valores.get("ciudad_evento", "")),
         disabled=disabled
-    ).upper()
+    ))
     fecha_evento = st.text_input(
         "Fecha del evento (opcional, ej. 10/12/2025)",
         value=s(valores.get("fecha_evento", "")),
         disabled=disabled
     )
-    organizador = st.text_input(
+    organizador = _norm_up(st.text_input(
         "Organizador (opcional)",
-        value=s(valores.get("organizador", "")).upper(),
+        value=_norm_up(valores.get("organizador", "")),
         disabled=disabled
-    ).upper()
+    ))
 
     # 🔥 NOTA: La sección "7) Firmas" YA NO EXISTE AQUÍ (se movió arriba después de "Tipo de viaje")
     
-    # --- refresco único tras limpiar ---
-    if st.session_state.get("_did_clear_padre"):
-        st.session_state["_did_clear_padre"] = False
-        st.rerun()
-    if st.session_state.get("_did_clear_madre"):
-        st.session_state["_did_clear_madre"] = False
+    # --- refresco único tras limpiar (| y no "or": ambos flags se consumen en la misma pasada) ---
+    if ss.pop("_did_clear_padre", False) | ss.pop("_did_clear_madre", False):
         st.rerun()
         
     # ---- payload ----
+    # Solo lectura (permiso ANULADO): nada puede cambiar el payload → se reutiliza el del mismo permiso
+    if disabled:
+        _cached = ss.get("_payload_cache")
+        if _cached is not None and _cached[0] == _perm_id_actual:
+            return dict(_cached[1])
+    else:
+        ss.pop("_payload_cache", None)
+
+    # Campos de documento de PADRE/MADRE: solo se leen de session_state si la sección se mostró
+    padre_fields = {
+        "padre_doc_tipo": ss.get("padre_doc_tipo", ""),
+        "padre_doc_num": ss.get("padre_doc_num") or ss.get("padre_dni", ""),
+        "padre_nacionalidad": ss.get("padre_nacionalidad", ""),
+    } if mostrar_padre else {"padre_doc_tipo": "", "padre_doc_num": "", "padre_nacionalidad": ""}
+    madre_fields = {
+        "madre_doc_tipo": ss.get("madre_doc_tipo", ""),
+        "madre_doc_num": ss.get("madre_doc_num") or ss.get("madre_dni", ""),
+        "madre_nacionalidad": ss.get("madre_nacionalidad", ""),
+    } if mostrar_madre else {"madre_doc_tipo": "", "madre_doc_num": "", "madre_nacionalidad": ""}
+
     payload = {
         "ciudad": ciudad,
         "notario": notario,
@@ -4316,9 +4494,7 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
         "padre_distrito": padre_dist,
         "padre_provincia": padre_prov,
         "padre_departamento": padre_dep,
-        "padre_doc_tipo": st.session_state.get("padre_doc_tipo", "") if mostrar_padre else "",
-        "padre_doc_num": st.session_state.get("padre_doc_num") or st.session_state.get("padre_dni", "") if mostrar_padre else "",
-        "padre_nacionalidad": st.session_state.get("padre_nacionalidad", "") if mostrar_padre else "",
+        **padre_fields,
 
         "madre_nombre": madre_nombre,
         "madre_dni": madre_doc_num,  # compat histórico
@@ -4327,17 +4503,15 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
         "madre_distrito": madre_dist,
         "madre_provincia": madre_prov,
         "madre_departamento": madre_dep,
-        "madre_doc_tipo": st.session_state.get("madre_doc_tipo", "") if mostrar_madre else "",
-        "madre_doc_num": st.session_state.get("madre_doc_num") or st.session_state.get("madre_dni", "") if mostrar_madre else "",
-        "madre_nacionalidad": st.session_state.get("madre_nacionalidad", "") if mostrar_madre else "",
+        **madre_fields,
 
         "menor_nombre": menor_nombre,
         "menor_dni": menor_doc_num,  # compat histórico
-        "menor_fnac": fnac.strftime("%Y-%m-%d"),
+        "menor_fnac": fnac.isoformat(),  # date → "YYYY-MM-DD" (sin parsear formato)
         "sexo_menor": sexo_menor,
-        "menor_doc_tipo": st.session_state.get("menor_doc_tipo", ""),
-        "menor_doc_num": st.session_state.get("menor_doc_num") or st.session_state.get("menor_dni", ""),
-        "menor_nacionalidad": st.session_state.get("menor_nacionalidad", ""),
+        "menor_doc_tipo": ss.get("menor_doc_tipo", ""),
+        "menor_doc_num": ss.get("menor_doc_num") or ss.get("menor_dni", ""),
+        "menor_nacionalidad": ss.get("menor_nacionalidad", ""),
 
         "edad_num": edad_num,
         "edad_letras": edad_letras,
@@ -4371,6 +4545,8 @@ def formulario_base(valores: dict | None = None, disabled: bool = False):
         "quien_firma": quien_firma,
         "quien_firma_int": quien_firma_int,
     }
+    if disabled:
+        ss["_payload_cache"] = (_perm_id_actual, dict(payload))
     return payload
 
 # =========================
@@ -4385,14 +4561,73 @@ from textwrap import dedent
 # import streamlit as st
 # from io import BytesIO   # solo si exportas
 
+# ---- Patrones precompilados (se compilan una sola vez al cargar el módulo) ----
+_RE_DIGITS      = re.compile(r"\d+")
+_RE_YEAR        = re.compile(r"\b(19\d{2}|20\d{2})\b")
+_RE_NO_ALNUM    = re.compile(r"[^a-z0-9 ]+")
+_RE_DOC         = re.compile(r"(?:DNI|DOCUMENTO|DOC|PASAPORTE)\s+([A-Z0-9]+)", re.I)
+_RE_CORREL      = re.compile(r"(?:PERMISO|NSC)[^\d](\d{4}).?(\d+)")
+_RE_DEST_SUG    = re.compile(r"(?:DESTINO|A|HACIA)\s+([A-ZÁÉÍÓÚÑ ]+)")
+_RE_NOMBRE      = re.compile(r"(?:NOMBRE|APELLID(?:O|OS|AS))\s+([A-ZÁÉÍÓÚÑ ]+)")
+# Entidades del router en un solo recorrido: cada alternativa va en un lookahead (se prueba
+# en todas las posiciones), así la primera aparición de cada una es la misma que daría su
+# propio re.search (ninguna de ellas puede empezar en la misma posición que otra).
+_RE_ENTIDADES   = re.compile(
+    r"(?=(?P<doc>(?i:(?:DNI|DOCUMENTO|DOC|PASAPORTE)\s+(?P<doc_v>[A-Z0-9]+)))"
+    r"|(?P<correl>(?:PERMISO|NSC)[^\d](?P<c_anio>\d{4}).?(?P<c_num>\d+))"
+    r"|(?P<dest>(?:A|HACIA)\s+(?P<dest_v>[A-ZÁÉÍÓÚÑ ]+))"
+    r"|(?P<nom>(?:NOMBRE|APELLID(?:O|OS|AS))\s+(?P<nom_v>[A-ZÁÉÍÓÚÑ ]+))"
+    r"|(?P<year>\b(?:19\d{2}|20\d{2})\b))"
+)
+_N_ENTIDADES = 5
+_RE_ULTIMOS     = re.compile(r"RECIENTE|ULTIMOS?|ÚLTIMOS?")
+_RE_TENDENCIA   = re.compile(r"TENDENCIA|EVOLUCI[ÓO]N|CRECIMIENTO|COMPARAR")
+_RE_COMPARAR    = re.compile(r"COMPARAR\s+(\d{4})\s+Y\s+(\d{4})")
+_RE_CUANTOS     = re.compile(r"CU[ÁA]NT(OS|AS)\s+PERMIS(OS|AS).*?(\d{4})")
+_RE_TIPO_ANIO   = re.compile(r"(INTERNACIONAL|NACIONAL)(ES)?(?:.*?)(\d{4})")
+_RE_PERM_DEST   = re.compile(r"(?:PERMISO|PERMISOS).*(?:A|HACIA)\s+([A-ZÁÉÍÓÚÑ ]+)(?:\s+EN\s+(\d{4}))?")
+_RE_MENOR_NOM   = re.compile(r"(MENOR|HIJO[A]?)\s+(LLAMAD[OA]|NOMBRE)\s+([A-ZÁÉÍÓÚÑ ]+)")
+_RE_FIRMA       = re.compile(r"(FIRM[ÓO]|FIRMA)(?:\s+LA\s+MADRE|\s+EL\s+PADRE|\s+AMBOS)(?:.*?(\d{4}))?")
+_RE_4DIG        = re.compile(r"(\d{4})")
+
+def _compile_ordered(patterns, flags=0):
+    """
+    Une varios patrones en un solo regex (un único recorrido del texto).
+    Cada alternativa va en un lookahead con grupo nombrado k<i>, así se
+    prueba en TODAS las posiciones y la prioridad sigue el orden de la lista.
+    """
+    alts = "|".join(f"(?P<k{i}>{p})" for i, p in enumerate(patterns))
+    return re.compile(f"(?=(?:{alts}))", flags)
+
+def _first_hit(rx, text: str) -> int | None:
+    """Índice del primer patrón (según el orden original) que aparece en text."""
+    best = None
+    for m in rx.finditer(text):
+        i = int(m.lastgroup[1:])
+        if best is None or i < best:
+            best = i
+            if i == 0:
+                break
+    return best
+
+# Palabras clave del router de notaría, en orden de prioridad
+_RE_ROUTER_KW = _compile_ordered([
+    r"VIAJAN?\s+SOL[OA]|SIN\s+ACOMPA[ÑN]ANTE",
+    r"CON\s+HERMANOS|HERMANOS?\s+BIOL[ÓO]GIC",
+    r"RECEPCI[ÓO]N|RECOG(?:EN|IDO)|RECIB(?:EN|IDO)",
+    r"ANULAD[OA]S?",
+    r"TOP\s+DESTINOS|DESTINOS?\s+M[ÁA]S\s+FRECUENT",
+    r"RECIENTE|ULTIMOS?|ÚLTIMOS?",
+])
+
 # ---- Utilidades básicas ----
 def _safe_to_int(x, default=None):
     if x is None: return default
-    m = re.search(r"\d+", str(x))
+    m = _RE_DIGITS.search(str(x))
     return int(m.group()) if m else default
 
 def _extract_year(text, default=None):
-    for y in re.findall(r"\b(19\d{2}|20\d{2})\b", str(text)):
+    for y in _RE_YEAR.findall(str(text)):
         yi = _safe_to_int(y)
         if yi and 2000 <= yi <= 2100:
             return yi
@@ -4408,20 +4643,30 @@ def _like_token(s: str) -> str:
     return f"%{_norm(s).upper()}%"
 
 # ---- Limpieza/normalización de lenguaje natural ----
+# Diacríticos combinables (U+0300–U+036F): cubren tildes, diéresis y la virgulilla de la Ñ
+_MN_TABLE = dict.fromkeys(c for c in range(0x300, 0x370) if unicodedata.category(chr(c)) == "Mn")
+
 def _strip_accents(s: str) -> str:
-    return "".join(c for c in unicodedata.normalize("NFD", s or "") if unicodedata.category(c) != "Mn")
+    s = s or ""
+    if s.isascii():
+        return s
+    r = unicodedata.normalize("NFD", s).translate(_MN_TABLE)
+    if r.isascii():
+        return r
+    # Caso raro: quedan marcas fuera del bloque principal
+    return "".join(c for c in r if unicodedata.category(c) != "Mn")
 
 def _clean_text(x: str) -> str:
     t = _strip_accents(str(x)).lower()
-    return re.sub(r"[^a-z0-9 ]+", " ", t).strip()
-
-def _contains(t: str, needle: str) -> bool:
-    return needle in t
+    return _RE_NO_ALNUM.sub(" ", t).strip()
 
 _MONTHS_ES = {
     "enero":1,"febrero":2,"marzo":3,"abril":4,"mayo":5,"junio":6,
     "julio":7,"agosto":8,"septiembre":9,"setiembre":9,"octubre":10,"noviembre":11,"diciembre":12
 }
+# "en <mes> [de <año>]" con los meses como alternativas: el propio regex descarta "en lima"
+# y sigue buscando, así "en lima en marzo" también resuelve el mes
+_RE_EN_MES = re.compile(r"\ben\s+(" + "|".join(_MONTHS_ES) + r")\b(?:\s+de\s+(\d{4}))?")
 
 def _ymd(d: date) -> str:
     return d.strftime("%Y-%m-%d")
@@ -4436,57 +4681,63 @@ def _pick_tipo(txtc: str) -> str | None:
 def _wants_count(txtc: str) -> bool:
     return any(k in txtc for k in ["cuanto","cuantos","cuantas","total","numero","conteo","contar"])
 
+_ANIO_TOKENS = ("ano", "anio", "año")
+
 def _range_for_phrase(txtc: str) -> tuple[str, str] | None:
+    # Se tokeniza una vez: las frases de 2 palabras solo se buscan si su palabra clave está
+    tokens = set(txtc.split())
     today = date.today()
-    if _contains(txtc, "hoy"):
+    if "hoy" in tokens:
         return _ymd(today), _ymd(today + timedelta(days=1))
-    if _contains(txtc, "ayer"):
+    if "ayer" in tokens:
         return _ymd(today - timedelta(days=1)), _ymd(today)
-    if _contains(txtc, "esta semana"):
-        monday = today - timedelta(days=today.weekday())
-        return _ymd(monday), _ymd(monday + timedelta(days=7))
-    if _contains(txtc, "semana pasada"):
-        monday = today - timedelta(days=today.weekday()+7)
-        return _ymd(monday), _ymd(monday + timedelta(days=7))
-    if _contains(txtc, "este mes"):
-        first = today.replace(day=1)
-        next_first = date(first.year + (1 if first.month==12 else 0), 1 if first.month==12 else first.month+1, 1)
-        return _ymd(first), _ymd(next_first)
-    if _contains(txtc, "mes pasado"):
-        first = date(today.year-1, 12, 1) if today.month == 1 else date(today.year, today.month-1, 1)
-        next_first = date(first.year + (1 if first.month==12 else 0), 1 if first.month==12 else first.month+1, 1)
-        return _ymd(first), _ymd(next_first)
-    if _contains(txtc, "este ano") or _contains(txtc, "este anio") or _contains(txtc, "este año"):
-        first = date(today.year, 1, 1)
-        return _ymd(first), _ymd(date(today.year+1, 1, 1))
-    m = re.search(r"\ben\s+([a-z]+)(?:\s+de\s+(\d{4}))?", txtc)
+    if "semana" in tokens:
+        if "esta semana" in txtc:
+            monday = today - timedelta(days=today.weekday())
+            return _ymd(monday), _ymd(monday + timedelta(days=7))
+        if "semana pasada" in txtc:
+            monday = today - timedelta(days=today.weekday()+7)
+            return _ymd(monday), _ymd(monday + timedelta(days=7))
+    if "mes" in tokens:
+        if "este mes" in txtc:
+            first = today.replace(day=1)
+            next_first = date(first.year + (1 if first.month==12 else 0), 1 if first.month==12 else first.month+1, 1)
+            return _ymd(first), _ymd(next_first)
+        if "mes pasado" in txtc:
+            first = date(today.year-1, 12, 1) if today.month == 1 else date(today.year, today.month-1, 1)
+            next_first = date(first.year + (1 if first.month==12 else 0), 1 if first.month==12 else first.month+1, 1)
+            return _ymd(first), _ymd(next_first)
+    if "este" in tokens and not tokens.isdisjoint(_ANIO_TOKENS):
+        if any(f"este {t}" in txtc for t in _ANIO_TOKENS):
+            first = date(today.year, 1, 1)
+            return _ymd(first), _ymd(date(today.year+1, 1, 1))
+    if "en" not in tokens:
+        return None
+    m = _RE_EN_MES.search(txtc)
     if m:
-        mes_txt = m.group(1)
         y = int(m.group(2)) if m.group(2) else today.year
-        if mes_txt in _MONTHS_ES:
-            mm = _MONTHS_ES[mes_txt]
-            first = date(y, mm, 1)
-            last = calendar.monthrange(y, mm)[1]
-            return _ymd(first), _ymd(date(y, mm, last) + timedelta(days=1))
+        mm = _MONTHS_ES[m.group(1)]
+        first = date(y, mm, 1)
+        last = calendar.monthrange(y, mm)[1]
+        return _ymd(first), _ymd(date(y, mm, last) + timedelta(days=1))
     return None
 
 # ---- FAQ cortas (sin BD) ----
+_FAQ_PATTERNS = [
+    (r"COMO\s+ANULO|ANULAR\s+PERMISO",
+     "Para anular: ✏ Editar / Re-generar → busca el permiso → ⚠ Anular permiso → escribe ANULAR y confirma."),
+    (r"DIFERENCIAS?\s+ENTRE\s+EMITIDO|ANULAD|CORREGID",
+     "Estados: EMITIDO (vigente), CORREGIDO (nueva versión), ANULADO (no válido; solo lectura)."),
+    (r"DONDE\s+SE\s+GUARDA|RUTA\s+DE\s+ARCHIVOS",
+     "Los DOCX se guardan en emitidos/<año>/. Si quieres, podemos separar corregidos en emitidos/corregidos/."),
+    (r"EXPORTAR|EXCEL|CONTROL\s+ANUAL",
+     "En ✏ Editar / Re-generar → 📤 Exportaciones puedes descargar el Excel anual."),
+]
+_FAQ_RX = _compile_ordered([pat for pat, _ in _FAQ_PATTERNS], re.I)
+
 def _faq_answer(q: str) -> str | None:
-    Q = _u(q)
-    F = [
-        (r"COMO\s+ANULO|ANULAR\s+PERMISO",
-         "Para anular: ✏ Editar / Re-generar → busca el permiso → ⚠ Anular permiso → escribe ANULAR y confirma."),
-        (r"DIFERENCIAS?\s+ENTRE\s+EMITIDO|ANULAD|CORREGID",
-         "Estados: EMITIDO (vigente), CORREGIDO (nueva versión), ANULADO (no válido; solo lectura)."),
-        (r"DONDE\s+SE\s+GUARDA|RUTA\s+DE\s+ARCHIVOS",
-         "Los DOCX se guardan en emitidos/<año>/. Si quieres, podemos separar corregidos en emitidos/corregidos/."),
-        (r"EXPORTAR|EXCEL|CONTROL\s+ANUAL",
-         "En ✏ Editar / Re-generar → 📤 Exportaciones puedes descargar el Excel anual."),
-    ]
-    for pat, ans in F:
-        if re.search(pat, Q):
-            return ans
-    return None
+    idx = _first_hit(_FAQ_RX, _u(q))
+    return _FAQ_PATTERNS[idx][1] if idx is not None else None
 
 # ---- Acceso a BD (usa tu get_conn) ----
 def _query(sql: str, params: tuple = ()) -> list[dict]:
@@ -4495,57 +4746,120 @@ def _query(sql: str, params: tuple = ()) -> list[dict]:
         cols = [d[0] for d in cur.description]
         return [dict(zip(cols, r)) for r in cur.fetchall()]
 
+@st.cache_resource(show_spinner=False)
+def _fts_disponible() -> bool:
+    """True si migrate_db pudo crear permisos_fts (SQLite con FTS5 + trigram)."""
+    with get_conn() as conn:
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='permisos_fts'"
+        ).fetchone() is not None
+
+@st.cache_resource(show_spinner=False)
+def _cols_permisos() -> frozenset:
+    """Columnas de permisos, incluidas las generadas (docs_all / nombres_all de migrate_db)."""
+    with get_conn() as conn:
+        return frozenset(r[1] for r in conn.execute("PRAGMA table_xinfo(permisos)").fetchall())
+
+def _where_contiene(fts_cols: tuple[str, ...], like_exprs: tuple[str, ...], term: str,
+                    col_all: str | None = None) -> tuple[str, tuple]:
+    """
+    Condición WHERE "alguno de los campos contiene term".
+    Con FTS5 trigram usa el índice (requiere >= 3 caracteres); si no, cae al LIKE '%term%',
+    sobre la columna generada col_all (una sola expresión) cuando existe.
+    """
+    if len(term) >= 3 and _fts_disponible():
+        match = "{" + " ".join(fts_cols) + '} : "' + term.replace('"', '""') + '"'
+        return "id IN (SELECT rowid FROM permisos_fts WHERE permisos_fts MATCH ?)", (match,)
+    like = f"%{term}%"
+    if col_all and "|" not in term and col_all in _cols_permisos():
+        return f"{col_all} LIKE ?", (like,)
+    return "(" + " OR ".join(f"{e} LIKE ?" for e in like_exprs) + ")", (like,) * len(like_exprs)
+
+# Tope de filas que traen las búsquedas "contiene" del asistente (el total se cuenta aparte)
+_ASIST_MAX_FILAS = int(os.getenv("ASISTENTE_MAX_FILAS", "200"))
+_SQL_LISTADO = "SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre FROM permisos"
+
+def _query_limitado(where: str, params: tuple, order: str) -> tuple[list[dict], int]:
+    """
+    Filas del listado con LIMIT en SQL; el total real solo se cuenta (COUNT) si se llegó al tope.
+    """
+    rows = _query(f"{_SQL_LISTADO} WHERE {where} ORDER BY {order} LIMIT ?", (*params, _ASIST_MAX_FILAS))
+    total = len(rows)
+    if total >= _ASIST_MAX_FILAS:
+        total = _query(f"SELECT COUNT(*) c FROM permisos WHERE {where}", params)[0]["c"]
+    return rows, total
+
+def _tope_txt(rows: list, total: int) -> str:
+    return f" (se muestran los primeros {len(rows)})" if total > len(rows) else ""
+
+_DOC_FTS_COLS = ("menor_doc", "padre_doc", "madre_doc")
+_DOC_LIKE_EXPRS = ("UPPER(COALESCE(menor_doc_num, menor_dni, ''))",
+                   "UPPER(COALESCE(padre_doc_num, padre_dni, ''))",
+                   "UPPER(COALESCE(madre_doc_num, madre_dni, ''))")
+_NOMBRE_FTS_COLS = ("menor_nombre", "padre_nombre", "madre_nombre")
+_NOMBRE_LIKE_EXPRS = ("UPPER(menor_nombre)", "UPPER(padre_nombre)", "UPPER(madre_nombre)")
+
 # ---- Presentación ----
+_LISTADO_FMT = "- Permiso {nro} — NSC-{anio} | {tipo_viaje} | Destino: {destino} | Menor: {menor_nombre} | Firma: {firma_quien}"
+
+class _FilaListado(dict):
+    """Fila para format_map: campos ausentes → '' (anio → '----')."""
+    def __missing__(self, k):
+        return "----" if k == "anio" else ""
+
+def _fila_listado(r: dict) -> str:
+    d = _FilaListado(r)
+    n = d.get("numero")
+    d["nro"] = f"{int(n):04d}" if n is not None else "----"
+    return _LISTADO_FMT.format_map(d)
+
 def _fmt_listado(rows: list[dict], max_n=10) -> str:
     if not rows: return "No encontré resultados."
-    out = []
-    for r in rows[:max_n]:
-        nro = f"{int(r['numero']):04d}" if r.get('numero') is not None else "----"
-        anio = r.get('anio', "----")
-        out.append(f"- Permiso {nro} — NSC-{anio} | {r.get('tipo_viaje','')} | Destino: {r.get('destino','')} | Menor: {r.get('menor_nombre','')} | Firma: {r.get('firma_quien','')}")
-    if len(rows) > max_n: out.append(f"… y {len(rows)-max_n} más.")
-    return "\n".join(out)
+    out = "\n".join(map(_fila_listado, rows[:max_n]))
+    if len(rows) > max_n: out += f"\n… y {len(rows)-max_n} más."
+    return out
 
-def _show_rows_table(rows: list[dict]):
+_ROWS_TABLE_COLS = ["id","anio","numero","tipo_viaje","destino","firma_quien","menor_nombre"]
+_ROWS_TABLE_DTYPES = {"id": "int32", "anio": "int16", "numero": "int32"}  # si hay nulos se dejan tal cual
+
+def _show_rows_table(rows: list[dict], df: pd.DataFrame | None = None):
     if not rows: return
-    df = pd.DataFrame(rows, columns=["id","anio","numero","tipo_viaje","destino","firma_quien","menor_nombre"])
-    st.dataframe(df, use_container_width=True)
+    if df is None:
+        df = pd.DataFrame.from_records(rows)
+    tabla = df.reindex(columns=_ROWS_TABLE_COLS).astype(_ROWS_TABLE_DTYPES, errors="ignore")
+    st.dataframe(tabla, use_container_width=True)
+
+def _conteo_col(df: pd.DataFrame, col: str) -> pd.Series:
+    """Conteo por valor (strip + upper, sin vacíos), de mayor a menor."""
+    v = df[col].fillna("").astype(str).str.strip().str.upper()
+    return v[v != ""].value_counts()
 
-def _show_chart_if_applicable(rows: list[dict], query: str):
+def _show_chart_if_applicable(rows: list[dict], query: str, df: pd.DataFrame | None = None):
     """
     Muestra gráficos automáticos si la consulta es de tipo estadístico.
     """
     if not rows or len(rows) < 2:
         return  # No hay suficientes datos
-    
-    Q = _u(query)
+    if df is None:
+        df = pd.DataFrame.from_records(rows)
     
     # 📊 Gráfico por TIPO DE VIAJE
-    if "tipo_viaje" in rows[0]:
-        tipos = {}
-        for r in rows:
-            t = s(r.get("tipo_viaje","")).upper()
-            if t:
-                tipos[t] = tipos.get(t, 0) + 1
-        
-        if len(tipos) > 1:
+    if "tipo_viaje" in df.columns:
+        tipos = _conteo_col(df, "tipo_viaje")
+        if tipos.size > 1:
             st.markdown("### 📊 Distribución por Tipo de Viaje")
-            df_tipos = pd.DataFrame(list(tipos.items()), columns=["Tipo", "Cantidad"])
-            st.bar_chart(df_tipos.set_index("Tipo"))
+            st.bar_chart(tipos.rename_axis("Tipo").to_frame("Cantidad"))
     
     # 📊 Gráfico por DESTINO (top 10)
-    if "destino" in rows[0] and len(rows) > 5:
-        destinos = {}
-        for r in rows:
-            d = s(r.get("destino","")).upper()
-            if d:
-                destinos[d] = destinos.get(d, 0) + 1
-        
-        if len(destinos) > 1:
+    if "destino" in df.columns and len(rows) > 5:
+        if "total" in df.columns:
+            # Filas ya agregadas por SQLite (GROUP BY destino, p.ej. _h_top_destinos): no recontar
+            destinos = df.set_index("destino")["total"].sort_values(ascending=False)
+        else:
+            destinos = _conteo_col(df, "destino")
+        if destinos.size > 1:
             st.markdown("### 📊 Top Destinos")
-            sorted_dest = sorted(destinos.items(), key=lambda x: x[1], reverse=True)[:10]
-            df_dest = pd.DataFrame(sorted_dest, columns=["Destino", "Cantidad"])
-            st.bar_chart(df_dest.set_index("Destino"))
+            st.bar_chart(destinos.head(10).rename_axis("Destino").to_frame("Cantidad"))
 
 # ── A) ROUTER AVANZADO ───────────────────────────────────────
 def _extract_entities(q_raw: str):
@@ -4553,19 +4867,22 @@ def _extract_entities(q_raw: str):
     Qc = _clean_text(q_raw)
     rng = _range_for_phrase(Qc)
     tipo = _pick_tipo(Qc)
-    m_doc = re.search(r"(?:dni|documento|doc|pasaporte)\s+([a-z0-9]+)", Q, re.I)
-    doc = m_doc.group(1).upper() if m_doc else None
-    m_corr = re.search(r"(?:PERMISO|NSC)[^\d](\d{4}).?(\d+)", Q)
-    correl = (int(m_corr.group(1)), int(m_corr.group(2))) if m_corr and m_corr.group(1).isdigit() and m_corr.group(2).isdigit() else None
-    m_dest = re.search(r"(?:A|HACIA)\s+([A-ZÁÉÍÓÚÑ ]+)", Q)
-    destino = _norm(m_dest.group(1)).upper() if m_dest else None
-    m_nom = re.search(r"(?:NOMBRE|APELLID(?:O|OS|AS))\s+([A-ZÁÉÍÓÚÑ ]+)", Q)
-    nombre = _norm(m_nom.group(1)).upper() if m_nom else None
-    m_year = re.search(r"\b(20\d{2}|19\d{2})\b", Q)
-    anio = int(m_year.group(1)) if m_year else None
+    found = {}
+    for m in _RE_ENTIDADES.finditer(Q):
+        found.setdefault(m.lastgroup, m)
+        if len(found) == _N_ENTIDADES:
+            break
+    m_doc, m_corr = found.get("doc"), found.get("correl")
+    m_dest, m_nom, m_year = found.get("dest"), found.get("nom"), found.get("year")
+    doc = m_doc.group("doc_v").upper() if m_doc else None
+    correl = (int(m_corr.group("c_anio")), int(m_corr.group("c_num"))) if m_corr and m_corr.group("c_anio").isdigit() and m_corr.group("c_num").isdigit() else None
+    destino = _norm(m_dest.group("dest_v")).upper() if m_dest else None
+    nombre = _norm(m_nom.group("nom_v")).upper() if m_nom else None
+    anio = int(m_year.group("year")) if m_year else None
     if anio and not (2000 <= anio <= 2100): anio = None
     wants_count = _wants_count(Qc)
-    return {"rng": rng, "tipo": tipo, "doc": doc, "correl": correl, "destino": destino, "nombre": nombre, "anio": anio, "wants_count": wants_count}
+    return {"rng": rng, "tipo": tipo, "doc": doc, "correl": correl, "destino": destino, "nombre": nombre, "anio": anio, "wants_count": wants_count,
+            "Q": Q, "Qc": Qc}
 
 def _h_conteo_periodo(ent):
     if not ent["rng"]: return None
@@ -4606,38 +4923,24 @@ def _h_correlativo(ent):
 
 def _h_documento(ent):
     if not ent["doc"]: return None
-    like_d = f"%{ent['doc']}%"
-    rows = _query("""SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre
-                     FROM permisos
-                     WHERE UPPER(COALESCE(menor_doc_num, menor_dni, '')) LIKE ?
-                        OR UPPER(COALESCE(padre_doc_num, padre_dni, '')) LIKE ?
-                        OR UPPER(COALESCE(madre_doc_num, madre_dni, '')) LIKE ?
-                     ORDER BY anio DESC, numero ASC""", (like_d, like_d, like_d))
-    return (f"Permisos que contienen el documento {ent['doc']}: {len(rows)}.", rows)
+    cond, params = _where_contiene(_DOC_FTS_COLS, _DOC_LIKE_EXPRS, ent["doc"], "docs_all")
+    rows, total = _query_limitado(cond, params, "anio DESC, numero ASC")
+    return (f"Permisos que contienen el documento {ent['doc']}: {total}.{_tope_txt(rows, total)}", rows)
 
 def _h_destino(ent):
     if not ent["destino"]: return None
-    like_t = f"%{ent['destino']}%"
+    cond, params = _where_contiene(("destino",), ("UPPER(destino)",), ent["destino"])
     if ent["anio"]:
-        rows = _query("""SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre
-                         FROM permisos WHERE anio=? AND UPPER(destino) LIKE ?
-                         ORDER BY numero ASC""", (ent["anio"], like_t))
+        rows, total = _query_limitado(f"anio=? AND {cond}", (ent["anio"], *params), "numero ASC")
     else:
-        rows = _query("""SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre
-                         FROM permisos WHERE UPPER(destino) LIKE ?
-                         ORDER BY anio DESC, numero ASC""", (like_t,))
-    return (f"Permisos con destino parecido a {ent['destino'].title()}: {len(rows)}.", rows)
+        rows, total = _query_limitado(cond, params, "anio DESC, numero ASC")
+    return (f"Permisos con destino parecido a {ent['destino'].title()}: {total}.{_tope_txt(rows, total)}", rows)
 
 def _h_nombre(ent):
     if not ent["nombre"]: return None
-    like_n = f"%{ent['nombre']}%"
-    rows = _query("""SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre
-                     FROM permisos
-                     WHERE UPPER(menor_nombre) LIKE ?
-                        OR UPPER(padre_nombre) LIKE ?
-                        OR UPPER(madre_nombre) LIKE ?
-                     ORDER BY anio DESC, numero ASC""", (like_n, like_n, like_n))
-    return (f"Permisos que coinciden con el nombre/apellidos {ent['nombre'].title()}: {len(rows)}.", rows)
+    cond, params = _where_contiene(_NOMBRE_FTS_COLS, _NOMBRE_LIKE_EXPRS, ent["nombre"], "nombres_all")
+    rows, total = _query_limitado(cond, params, "anio DESC, numero ASC")
+    return (f"Permisos que coinciden con el nombre/apellidos {ent['nombre'].title()}: {total}.{_tope_txt(rows, total)}", rows)
 
 def _h_tipo_anio(ent):
     if not ent["tipo"] or not ent["anio"]: return None
@@ -4646,8 +4949,10 @@ def _h_tipo_anio(ent):
                      ORDER BY numero ASC""", (ent["anio"], ent["tipo"]))
     return (f"Permisos {ent['tipo'].lower()} en {ent['anio']}: {len(rows)}.", rows)
 
-def _advanced_router(q: str):
-    ent = _extract_entities(q)
+def _advanced_router(q: str, ent: dict | None = None):
+    if ent is None:
+        ent = _extract_entities(q)
+    Q = ent["Q"]  # pregunta ya normalizada (_u) una sola vez
     
     # ========== HANDLERS ORIGINALES ==========
     if ent["rng"] and ent["wants_count"]:
@@ -4666,21 +4971,13 @@ def _advanced_router(q: str):
     if r: return r
     
     # ========== HANDLERS ESPECÍFICOS DE NOTARÍA ==========
-    if re.search(r"VIAJAN?\s+SOL[OA]|SIN\s+ACOMPA[ÑN]ANTE", _u(q)):
-        return _h_viajan_solos(ent)
-    if re.search(r"CON\s+HERMANOS|HERMANOS?\s+BIOL[ÓO]GIC", _u(q)):
-        return _h_con_hermanos(ent)
-    if re.search(r"RECEPCI[ÓO]N|RECOG(EN|IDO)|RECIB(EN|IDO)", _u(q)):
-        return _h_con_recepcion(ent)
-    if re.search(r"ANULAD[OA]S?", _u(q)):
-        return _h_anulados(ent)
-    if re.search(r"TOP\s+DESTINOS|DESTINOS?\s+M[ÁA]S\s+FRECUENT", _u(q)):
-        return _h_top_destinos(ent)
-    if re.search(r"RECIENTE|ULTIMOS?|ÚLTIMOS?", _u(q)):
-        return _h_ultimos(ent)
+    idx = _first_hit(_RE_ROUTER_KW, Q)
+    if idx is not None:
+        return (_h_viajan_solos, _h_con_hermanos, _h_con_recepcion,
+                _h_anulados, _h_top_destinos, _h_ultimos)[idx](ent)
     
     # 🔥 NUEVO: Análisis avanzado
-    r = _h_analisis_avanzado(q)
+    r = _h_analisis_avanzado(q, Q)
     if r: return r
     
     return None
@@ -4689,7 +4986,7 @@ def _advanced_router(q: str):
 # Si RapidFuzz no está, el modo semántico se desactiva sin romper la app.
 _RF_READY = False
 try:
-    from rapidfuzz import fuzz
+    from rapidfuzz import fuzz, process
     _RF_READY = True
 except Exception:
     _RF_READY = False
@@ -4707,26 +5004,23 @@ def _norm_q_sem(q: str) -> str:
     # Reutiliza tu normalizador para ser tolerante a faltas
     return _clean_text(q)
 
+# El corpus es fijo: se normaliza una sola vez
+_FAQ_CORPUS_NORM = [_norm_q_sem(q) for q in _FAQ_CORPUS]
+
 def _faq_semantic_answer(q: str) -> str | None:
     if not _RF_READY:
         return None
-    qn = _norm_q_sem(q)
-    best_score, best_idx = -1, -1
-    for i, cand in enumerate(_FAQ_CORPUS):
-        score = fuzz.token_set_ratio(qn, _norm_q_sem(cand))
-        if score > best_score:
-            best_score, best_idx = score, i
-    # Umbral ajustable
-    if best_score >= 78 and best_idx >= 0:
-        return _FAQ_KB[best_idx][1]
-    return None
+    # Umbral ajustable (score_cutoff): el recorrido del corpus lo hace RapidFuzz en C
+    match = process.extractOne(_norm_q_sem(q), _FAQ_CORPUS_NORM,
+                               scorer=fuzz.token_set_ratio, score_cutoff=78)
+    return _FAQ_KB[match[2]][1] if match else None
 
 def _suggest_alternatives(q: str) -> str | None:
     """Si la consulta no devolvió resultados, sugiere alternativas."""
     Q = _u(q)
     
     # Caso 1: Buscó un destino que no existe
-    m = re.search(r"(?:DESTINO|A|HACIA)\s+([A-ZÁÉÍÓÚÑ ]+)", Q)
+    m = _RE_DEST_SUG.search(Q)
     if m:
         destino_buscado = m.group(1).upper()
         prefix = destino_buscado[:3]
@@ -4833,19 +5127,20 @@ def _h_top_destinos(ent=None):
     if not rows:
         return ("No hay destinos registrados.", [])
     
-    msg = "Top 10 destinos más frecuentes:\n"
-    for r in rows:
-        msg += f"- {r['destino']}: {r['total']} permisos\n"
+    msg = "Top 10 destinos más frecuentes:\n" + "".join(
+        f"- {r['destino']}: {r['total']} permisos\n" for r in rows
+    )
     return (msg, rows)
 
-def _h_analisis_avanzado(query: str):
+def _h_analisis_avanzado(query: str, Q: str | None = None):
     """
     Análisis avanzado: detecta patrones y tendencias en los datos.
+    Q: la pregunta ya pasada por _u (si el llamador la tiene).
     """
-    Q = _u(query)
+    Q = Q if Q is not None else _u(query)
     
     # Detección de análisis temporal (tendencias)
-    if re.search(r"TENDENCIA|EVOLUCI[ÓO]N|CRECIMIENTO|COMPARAR", Q):
+    if _RE_TENDENCIA.search(Q):
         with get_conn() as conn:
             rows = conn.execute("""
                 SELECT strftime('%Y-%m', fecha_registro) AS mes, 
@@ -4863,8 +5158,8 @@ def _h_analisis_avanzado(query: str):
             return (f"Se encontró tendencia en {len(rows)} períodos.", [])
     
     # Comparación entre años
-    if re.search(r"COMPARAR\s+(\d{4})\s+Y\s+(\d{4})", Q):
-        m = re.search(r"COMPARAR\s+(\d{4})\s+Y\s+(\d{4})", Q)
+    m = _RE_COMPARAR.search(Q)
+    if m:
         anio1, anio2 = int(m.group(1)), int(m.group(2))
         
         with get_conn() as conn:
@@ -4880,27 +5175,72 @@ def _h_analisis_avanzado(query: str):
     return None
 
 # ── C) LOGS (no rompe si falla) ──────────────────────────────────────────
-def _log_q(q: str, msg: str, nrows: int):
+# Las preguntas se acumulan en un búfer del proceso y se escriben en lote
+# (una sola transacción) al llegar a _LOG_FLUSH_N filas o cuando la más antigua
+# ya esperó _LOG_FLUSH_SEG segundos; esto último se revisa en cada rerun de
+# cualquier sesión (ver _flush_logs_vencidos). El log es "best effort": si el
+# proceso muere sin pasar por atexit (SIGKILL, reinicio del contenedor) se
+# pierden como mucho las filas aún en el búfer.
+_LOG_FLUSH_N = 8
+_LOG_FLUSH_SEG = 30
+
+def _flush_logs(buf: dict):
+    with buf["lock"]:
+        pendientes = list(buf["rows"])
+        buf["rows"].clear()
+        buf["first"] = None
+    if not pendientes:
+        return
     try:
         with get_conn() as conn:
-            conn.execute("""CREATE TABLE IF NOT EXISTS asistente_logs(
-                                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                ts TEXT DEFAULT CURRENT_TIMESTAMP,
-                                pregunta TEXT, respuesta TEXT, filas INTEGER)""")
-            conn.execute("INSERT INTO asistente_logs(pregunta,respuesta,filas) VALUES(?,?,?)",
-                         (q, (msg or "")[:500], int(nrows or 0)))
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO asistente_logs(ts,pregunta,respuesta,filas) VALUES(?,?,?,?)",
+                             pendientes)
+    except Exception:
+        pass
+
+@st.cache_resource(show_spinner=False)
+def _log_buffer() -> dict:
+    """Búfer compartido (sobrevive a los reruns); se vacía también al cerrar el proceso."""
+    buf = {"rows": [], "first": None, "lock": threading.Lock()}  # first: monotonic de la fila más antigua
+    atexit.register(_flush_logs, buf)
+    return buf
+
+def _log_q(q: str, msg: str, nrows: int):
+    try:
+        buf = _log_buffer()
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())  # mismo formato que CURRENT_TIMESTAMP
+        with buf["lock"]:
+            buf["rows"].append((ts, q, (msg or "")[:500], int(nrows or 0)))
+            if buf["first"] is None:
+                buf["first"] = time.monotonic()
+            lleno = len(buf["rows"]) >= _LOG_FLUSH_N
+        if lleno:
+            _flush_logs(buf)
+    except Exception:
+        pass
+
+def _flush_logs_vencidos():
+    """Escribe el búfer si su fila más antigua ya superó _LOG_FLUSH_SEG (barato: lock + una resta)."""
+    try:
+        buf = _log_buffer()
+        with buf["lock"]:
+            vencido = buf["first"] is not None and time.monotonic() - buf["first"] >= _LOG_FLUSH_SEG
+        if vencido:
+            _flush_logs(buf)
     except Exception:
         pass
 
 # ── Núcleo NLQ clásico (se mantiene por compatibilidad) ──────────────────
-def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
-    Q = _u(q)
-    Qc = _clean_text(q)
-    rng = _range_for_phrase(Qc)
+def _qa_sql(q: str, ent: dict | None = None) -> tuple[str, list[dict]] | None:
+    # Reutiliza lo que ya extrajo _extract_entities (si el router corrió antes)
+    if ent is None:
+        ent = _extract_entities(q)
+    Q, rng = ent["Q"], ent["rng"]
     if rng:
         start_iso, end_iso = rng
-        tipo = _pick_tipo(Qc)
-        if _wants_count(Qc):
+        tipo = ent["tipo"]
+        if ent["wants_count"]:
             if tipo:
                 row = _query("""SELECT COUNT(*) c FROM permisos
                                 WHERE date(fecha_registro) >= ? AND date(fecha_registro) < ? AND UPPER(tipo_viaje)=?""",
@@ -4925,13 +5265,13 @@ def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
                                  ORDER BY fecha ASC, numero ASC""", (start_iso, end_iso))
                 return (f"Permisos en {start_iso} → {end_iso}: {len(rows)}.", rows)
 
-    m = re.search(r"CU[ÁA]NT(OS|AS)\s+PERMIS(OS|AS).*?(\d{4})", Q)
+    m = _RE_CUANTOS.search(Q)
     if m:
         anio = _extract_year(m.group(2), default=date.today().year)
         c = _query("SELECT COUNT(*) c FROM permisos WHERE anio=?", (anio,))[0]['c']
         return (f"Se emitieron {c} permisos en {anio}.", [])
 
-    m = re.search(r"(INTERNACIONAL|NACIONAL)(ES)?(?:.*?)(\d{4})", Q)
+    m = _RE_TIPO_ANIO.search(Q)
     if m:
         tipo = "INTERNACIONAL" if "INTERNACIONAL" in m.group(1) else "NACIONAL"
         anio = int(m.group(3))
@@ -4940,7 +5280,7 @@ def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
                          ORDER BY numero ASC""", (anio, tipo))
         return (f"Permisos {tipo.lower()} en {anio}: {len(rows)}.", rows)
 
-    m = re.search(r"(?:PERMISO|PERMISOS).*(?:A|HACIA)\s+([A-ZÁÉÍÓÚÑ ]+)(?:\s+EN\s+(\d{4}))?", Q)
+    m = _RE_PERM_DEST.search(Q)
     if m:
         destino = _like_token(m.group(1))
         anio = m.group(2)
@@ -4954,7 +5294,7 @@ def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
                              ORDER BY anio DESC, numero ASC""", (destino,))
         return (f"Permisos con destino parecido a {_norm(m.group(1)).title()}: {len(rows)}.", rows)
 
-    m = re.search(r"(?:NOMBRE|APELLID(?:O|OS|AS))\s+([A-ZÁÉÍÓÚÑ ]+)", Q)
+    m = _RE_NOMBRE.search(Q)
     if m:
         name = _like_token(m.group(1))
         rows = _query("""SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre
@@ -4965,7 +5305,7 @@ def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
                          ORDER BY anio DESC, numero ASC""", (name, name, name))
         return (f"Permisos que coinciden con el nombre/apellidos {_norm(m.group(1)).title()}: {len(rows)}.", rows)
 
-    m = re.search(r"(?:DNI|DOCUMENTO|DOC|PASAPORTE)\s+([A-Z0-9]+)", Q)
+    m = _RE_DOC.search(Q)
     if m:
         d = _u(m.group(1))
         like_d = f"%{d}%"
@@ -4977,7 +5317,7 @@ def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
                          ORDER BY anio DESC, numero ASC""", (like_d, like_d, like_d))
         return (f"Permisos que contienen el documento {d}: {len(rows)}.", rows)
 
-    m = re.search(r"(MENOR|HIJO[A]?)\s+(LLAMAD[OA]|NOMBRE)\s+([A-ZÁÉÍÓÚÑ ]+)", Q)
+    m = _RE_MENOR_NOM.search(Q)
     if m:
         nombre = _like_token(m.group(3))
         rows = _query("""SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre
@@ -4985,11 +5325,11 @@ def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
                          ORDER BY anio DESC, numero ASC""", (nombre,))
         return (f"Permisos del menor que coincide con {_norm(m.group(3)).title()}: {len(rows)}.", rows)
 
-    m = re.search(r"(FIRM[ÓO]|FIRMA)(?:\s+LA\s+MADRE|\s+EL\s+PADRE|\s+AMBOS)(?:.*?(\d{4}))?", Q)
+    m = _RE_FIRMA.search(Q)
     if m:
         quien = "MADRE" if "MADRE" in Q else ("PADRE" if "PADRE" in Q else "AMBOS")
         cond_tipo = " AND UPPER(tipo_viaje)='INTERNACIONAL'" if "INTERNACIONAL" in Q else ""
-        m2 = re.search(r"(\d{4})", Q)
+        m2 = _RE_4DIG.search(Q)
         if m2:
             rows = _query(f"""SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre
                               FROM permisos WHERE anio=? AND UPPER(firma_quien)=?{cond_tipo}
@@ -5000,7 +5340,7 @@ def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
                               ORDER BY anio DESC, numero ASC""", (quien,))
         return (f"Permisos firmados por {quien}: {len(rows)}.", rows)
 
-    m = re.search(r"(?:PERMISO|NSC)[^\d](\d{4}).?(\d+)", Q)
+    m = _RE_CORREL.search(Q)
     if m and m.group(1).isdigit() and m.group(2).isdigit():
         anio, numero = int(m.group(1)), int(m.group(2))
         rows = _query("""SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre
@@ -5008,7 +5348,7 @@ def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
         msg = f"Encontré el correlativo {numero:04d} — NSC-{anio}." if rows else f"No encontré el correlativo {numero:04d} — NSC-{anio}."
         return (msg, rows)
 
-    if re.search(r"RECIENTE|ULTIMOS?|ÚLTIMOS?", Q):
+    if _RE_ULTIMOS.search(Q):
         rows = _query("""SELECT id, anio, numero, tipo_viaje, destino, firma_quien, menor_nombre
                          FROM permisos
                          ORDER BY COALESCE(datetime(updated_at), datetime(fecha_registro)) DESC, id DESC
@@ -5018,19 +5358,27 @@ def _qa_sql(q: str) -> tuple[str, list[dict]] | None:
     return None
 
 # ── Wrappers ──────────────────────────────────────────────────────────────
-def _answer_question_struct(q: str) -> dict:
+@st.cache_data(show_spinner=False, max_entries=512)
+def _answer_cached(q: str, rev: int, hoy: str) -> dict:
+    """
+    Respuesta del asistente para la pregunta ya normalizada (_u).
+    'rev' (revisión de permisos) y 'hoy' solo forman parte de la clave del caché:
+    una escritura en permisos o el cambio de día invalidan las respuestas guardadas.
+    Los gráficos/métricas que emiten los handlers se repiten al leer del caché.
+    """
     ans = _faq_answer(q)
     if ans:
-        _log_q(q, ans, 0); return {"msg": ans, "rows": []}
-    routed = _advanced_router(q)
+        return {"msg": ans, "rows": []}
+    ent = _extract_entities(q)  # una sola extracción para el router y el NLQ clásico
+    routed = _advanced_router(q, ent)
     if routed:
-        msg, rows = routed; _log_q(q, msg, len(rows or [])); return {"msg": msg, "rows": rows}
-    res = _qa_sql(q)
+        msg, rows = routed; return {"msg": msg, "rows": rows or []}
+    res = _qa_sql(q, ent)
     if res:
-        msg, rows = res; _log_q(q, msg, len(rows or [])); return {"msg": msg, "rows": rows}
+        msg, rows = res; return {"msg": msg, "rows": rows or []}
     ans2 = _faq_semantic_answer(q)
     if ans2:
-        _log_q(q, ans2, 0); return {"msg": ans2, "rows": []}
+        return {"msg": ans2, "rows": []}
     
     # Si llegamos aquí, no entendió nada
     sugerencia = _suggest_alternatives(q)
@@ -5039,19 +5387,24 @@ def _answer_question_struct(q: str) -> dict:
     else:
         msg = ("No entendí. Prueba: “permisos nacionales este mes”, “internacionales ayer”, "
                "“destino PIURA mes pasado”, “dni 12345678”, “permiso 2025 número 31”.")
-    _log_q(q, msg, 0)
     return {"msg": msg, "rows": []}
 
+def _answer_question_struct(q: str) -> dict:
+    res = _answer_cached(_u(q), _conn().permisos_rev, date.today().isoformat())
+    _log_q(q, res["msg"], len(res["rows"]))
+    return res
+
 def _answer_question(q: str):
     res = _answer_question_struct(q)
     st.markdown(res["msg"])
     if res.get("rows"):
         st.markdown(_fmt_listado(res["rows"]))
+        df_rows = pd.DataFrame.from_records(res["rows"])  # una sola vez para tabla y gráficos
         with st.expander("Ver tabla"):
-            _show_rows_table(res["rows"])
+            _show_rows_table(res["rows"], df_rows)
         
         # 🔥 NUEVO: Mostrar gráficos automáticos
-        _show_chart_if_applicable(res["rows"], q)  # ← AGREGAR ESTA LÍNEA
+        _show_chart_if_applicable(res["rows"], q, df_rows)
     
     try:
         st.session_state["ia_last_rows"] = res.get("rows", [])
@@ -5065,6 +5418,9 @@ if "sel_anio" not in st.session_state:
     st.session_state.sel_anio = date.today().year
 if "sel_numero" not in st.session_state:
     st.session_state.sel_numero = 1  # mínimo 1
+
+# Logs del asistente pendientes por antigüedad: cualquier rerun (de cualquier página) los escribe
+_flush_logs_vencidos()
 # ------------------- NUEVO -------------------
 
 if modo == "➕ Nuevo permiso":
@@ -5125,6 +5481,14 @@ if modo == "➕ Nuevo permiso":
             )
 
 
+            # Documentos de padres/menor normalizados una sola vez (ctx, textos y firmas)
+            padre_tipo = s(vals["padre_doc_tipo"]).upper()
+            padre_num = s(vals["padre_doc_num"])
+            padre_dni = s(vals["padre_dni"])
+            madre_tipo = s(vals["madre_doc_tipo"]).upper()
+            madre_num = s(vals["madre_doc_num"])
+            madre_dni = s(vals["madre_dni"])
+
             ctx = {
                 "CIUDAD": s(vals["ciudad"]),
                 "NOTARIO_NOMBRE": s(vals["notario"]),
@@ -5132,25 +5496,31 @@ if modo == "➕ Nuevo permiso":
 
                 # Padres (texto general)
                 "PADRE_NOMBRE": s(vals["padre_nombre"]),
-                "PADRE_DNI": s(vals["padre_dni"]),
+                "PADRE_DNI": padre_dni,
                 "PADRE_ESTADO_CIVIL": s(vals["padre_estado_civil"]),
                 "PADRE_DIRECCION": s(vals["padre_direccion"]),
                 "PADRE_DISTRITO": s(vals["padre_distrito"]),
                 "PADRE_PROVINCIA": s(vals["padre_provincia"]),
                 "PADRE_DEPARTAMENTO": s(vals["padre_departamento"]),
-                "PADRE_DOC_TIPO": s(vals["padre_doc_tipo"]).upper(),
-                "PADRE_DOC_NUM": s(vals["padre_doc_num"]),
+                "PADRE_DOC_TIPO": padre_tipo,
+                "PADRE_DOC_NUM": padre_num,
+                "PADRE_DOC_TIPO_CAN": canon_doc(padre_tipo),
+                "PADRE_DOC_TEXTO": _doc_tx(padre_tipo, padre_num or padre_dni),
+                "PADRE_DOC_FIRMA": _doc_firma_adulto(padre_tipo, padre_num),
                 "PADRE_NACIONALIDAD": s(vals["padre_nacionalidad"]),
 
                 "MADRE_NOMBRE": s(vals["madre_nombre"]),
-                "MADRE_DNI": s(vals["madre_dni"]),
+                "MADRE_DNI": madre_dni,
                 "MADRE_ESTADO_CIVIL": s(vals["madre_estado_civil"]),
                 "MADRE_DIRECCION": s(vals["madre_direccion"]),
                 "MADRE_DISTRITO": s(vals["madre_distrito"]),
                 "MADRE_PROVINCIA": s(vals["madre_provincia"]),
                 "MADRE_DEPARTAMENTO": s(vals["madre_departamento"]),
-                "MADRE_DOC_TIPO": s(vals["madre_doc_tipo"]).upper(),
-                "MADRE_DOC_NUM": s(vals["madre_doc_num"]),
+                "MADRE_DOC_TIPO": madre_tipo,
+                "MADRE_DOC_NUM": madre_num,
+                "MADRE_DOC_TIPO_CAN": canon_doc(madre_tipo),
+                "MADRE_DOC_TEXTO": _doc_tx(madre_tipo, madre_num or madre_dni),
+                "MADRE_DOC_FIRMA": _doc_firma_adulto(madre_tipo, madre_num),
                 "MADRE_NACIONALIDAD": s(vals["madre_nacionalidad"]),
 
                 # Menor
@@ -5160,6 +5530,7 @@ if modo == "➕ Nuevo permiso":
                 "MENOR_EDAD_NUMERO": int(vals["edad_num"] or 0),
                 "SEXO_MENOR": s(vals["sexo_menor"]),
                 "MENOR_DOC_BLOQUE": menor_bloque,
+                "MENOR_DOC_TIPO_CAN": canon_doc(vals.get("menor_doc_tipo")),
 
                 # Viaje
                 "TIPO_VIAJE": s(vals["tipo_viaje"]),
@@ -5242,48 +5613,25 @@ if modo == "➕ Nuevo permiso":
                 "EDAD_TXT": edad_txt_p
             })
 
-            for i, _ in enumerate(st.session_state.get("hermanos", [])):
-                h_nom = s(st.session_state.get(f"hermano_nombre_{i}", ""))
-                if not h_nom:
-                    continue
-
-                # Lee SIEMPRE desde el state (NO crear inputs aquí)
-                h_sex  = (st.session_state.get(f"hermano_sexo_{i}", "") or "").upper()
-                h_tipo = (st.session_state.get(f"hermano_doc_tipo_{i}", "DNI") or "DNI").upper()
-                h_num  = s(st.session_state.get(f"hermano_doc_num_{i}", ""))
-                h_fnac = st.session_state.get(f"hermano_fnac_{i}", None)
-
-                # Normaliza fnac a ISO -> edad
-                if h_fnac:
-                    try:
-                        if hasattr(h_fnac, "strftime"):
-                            fnac_iso_h = h_fnac.strftime("%Y-%m-%d")
-                        else:
-                            dtmp = parse_iso(h_fnac)
-                            fnac_iso_h = dtmp.strftime("%Y-%m-%d") if dtmp else ""
-                    except Exception:
-                        fnac_iso_h = ""
-                else:
-                    fnac_iso_h = ""
-
+            # Hermanos: una sola lectura del state sirve para el DOCX, la concordancia y el JSON de BD
+            hermanos_list, hermanos_sex = _leer_hermanos_ui()
+            for h in hermanos_list:
+                fnac_iso_h = h["fnac"]
                 try:
                     e_num = calcular_edad(fnac_iso_h) if fnac_iso_h else ""
                     e_txt = edad_en_letras(e_num) if (e_num != "") else ""
                 except Exception:
                     e_num, e_txt = "", ""
 
-                ident_tx_h = genero_menor_vars(h_sex).get("IDENT_TX", "IDENTIFICADO")
-
-                # Solo LEE nacionalidad (si aplica). NO crees inputs aquí.
-                h_nac = s(st.session_state.get(f"hermano_nacionalidad_{i}", "")) if h_tipo in ("PASAPORTE", "DNI EXTRANJERO") else ""
+                ident_tx_h = genero_menor_vars(h["sexo"]).get("IDENT_TX", "IDENTIFICADO")
 
                 # Construye el bloque correcto con nacionalidad cuando aplique
-                doc_bloque_h = _doc_bloque_menor(h_tipo, h_num, ident_tx_h, h_nac)
+                doc_bloque_h = _doc_bloque_menor(h["doc_tipo"], h["doc_num"], ident_tx_h, h["nacionalidad"])
 
                 # Agrega al contexto
                 menores_ctx.append({
                     "NRO": len(menores_ctx) + 1,
-                    "NOMBRE": h_nom.upper(),
+                    "NOMBRE": h["nombre"].upper(),
                     "DOC_BLOQUE": doc_bloque_h,
                     "EDAD_NUM": e_num,
                     "EDAD_TXT": e_txt
@@ -5302,10 +5650,7 @@ if modo == "➕ Nuevo permiso":
                 total = int(ctx_local.get("MENORES_COUNT", 1))
 
                 sex_principal = s(ctx_local.get("SEXO_MENOR","")).upper()
-                # Recolecta sexos de hermanos desde la UI (si existieran):
-                hermanos_sex = []
-                for i, _ in enumerate(st.session_state.get("hermanos", [])):
-                    hermanos_sex.append( s(st.session_state.get(f"hermano_sexo_{i}", "")).upper() )
+                # hermanos_sex: sexos de hermanos leídos arriba por _leer_hermanos_ui
 
                 all_f = (total >= 1) and (sex_principal == "F") and all(x == "F" for x in hermanos_sex if x)
 
@@ -5343,13 +5688,12 @@ if modo == "➕ Nuevo permiso":
                 if emp_tx:  return f"({emp_tx})"
                 return ""
 
-            obs_tx = ""
-            if s(vals.get("acompanante","")).upper() in ["SOLO","SOLO(A)/SOLOS(AS)"]:
+            acomp_val = s(vals.get("acompanante","")).upper()
+            # Terceros leídos una vez: sirven para OBS_TX y para terceros_json al guardar
+            terceros_list = _leer_terceros_ui() if acomp_val == "TERCERO" else []
+            if acomp_val in ("SOLO", "SOLO(A)/SOLOS(AS)"):
                 # 1) Oración base: EL/LA/LOS/LAS MENOR(ES) VIAJARÁ(N) SOLO/SOLA/SOLOS/SOLAS.
-                base_viaje = (
-                    f"SE DEJA CONSTANCIA QUE {ac['ART']} {ac['SUST']} "
-                    f"{ac['VERB_VIAJAR']} {ac['ADJ_SOLO']}."
-                )
+                base = _SOLO_TMPL.format_map(ac)
 
                 # 2) ¿Hay recepción?
                 if s(vals.get("recibe_si","NO")).upper() == "SI":
@@ -5365,83 +5709,16 @@ if modo == "➕ Nuevo permiso":
                             "pais":   s(vals.get("rec_doc_pais","")).upper(),
                         }]
 
-                    recep_txt = _obs_con_recepcion_plural(ac, rec_list)  # “Y QUE A SU ARRIBO SERÁ(N) RECOGIDO(S) ...”
-                    obs_tx = (base_viaje + " " + recep_txt).strip() if recep_txt else base_viaje
+                    recep = _obs_con_recepcion_plural(ac, rec_list)  # “Y QUE A SU ARRIBO SERÁ(N) RECOGIDO(S) ...”
+                    obs_tx = f"{base} {recep}" if recep else base
                 else:
-                    obs_tx = base_viaje
-            else:
-                # === VIAJAN ACOMPAÑADOS (PADRE/MADRE/AMBOS/TERCERO) ===
-                def _doc_num_preferido(num1: str | None, num2: str | None) -> str:
-                    n1, n2 = s(num1), s(num2)
-                    return n1 if n1 else n2
-
-                def _acomp_bloque_vals(v: dict) -> tuple[str, str, str, str]:
-                    """
-                    Devuelve (posesivo, rol_txt, nombre_txt, doc_txt) para PADRE/MADRE/AMBOS/TERCERO.
-        
-                    NOTA: Para TERCERO con múltiples acompañantes, devuelve vacíos.
-                    La lógica de múltiples terceros se maneja por separado.
-                    """
-                    acomp = s(v.get("acompanante","")).upper()
-                    if acomp == "PADRE":
-                        rol_txt = "PADRE"
-                        nombre = s(v.get("padre_nombre","")).upper()
-                        doc = _doc_num_preferido(v.get("padre_doc_num"), v.get("padre_dni"))
-                        doc_txt = f"DOCUMENTO N° {doc}" if doc else ""
-                        return "SU", rol_txt, nombre, doc_txt
-                    elif acomp == "MADRE":
-                        rol_txt = "MADRE"
-                        nombre = s(v.get("madre_nombre","")).upper()
-                        doc = _doc_num_preferido(v.get("madre_doc_num"), v.get("madre_dni"))
-                        doc_txt = f"DOCUMENTO N° {doc}" if doc else ""
-                        return "SU", rol_txt, nombre, doc_txt
-                    elif acomp == "AMBOS":
-                        return "SUS", "PADRES", "", ""
-                    elif acomp == "TERCERO":
-                        # 👉 NUEVO: retornar vacíos para manejar múltiples terceros por separado
-                        return "", "", "", ""
-                    return "SU", "", "", ""
-
-                acomp_val = s(vals.get("acompanante","")).upper()
-    
+                    obs_tx = base
+            elif acomp_val == "TERCERO":
                 # 🆕 CASO ESPECIAL: TERCERO con múltiples acompañantes
-                if acomp_val == "TERCERO":
-                    # Recopilar todos los terceros desde session_state
-                    terceros_list = []
-                    for i in range(len(st.session_state.get("terceros", []))):
-                        rol = s(st.session_state.get(f"tercero_rol_{i}", "")).upper()
-                        nombre = s(st.session_state.get(f"tercero_nombre_{i}", "")).upper()
-                        dni = s(st.session_state.get(f"tercero_dni_{i}", ""))
-            
-                        if nombre:  # Solo agregar si tiene nombre
-                            terceros_list.append({"rol": rol, "nombre": nombre, "dni": dni})
-        
-                    # Generar OBS_TX usando la función helper
-                    obs_tx = _obs_terceros_multiples(terceros_list, ac)
-    
-                else:
-                    # Lógica normal para PADRE/MADRE/AMBOS
-                    posesivo, rol_txt, acomp_nom, acomp_doc = _acomp_bloque_vals(vals)
-
-                    def _acomp_plural_count(v: dict) -> int:
-                        a = s(v.get("acompanante","")).upper()
-                        if a == "AMBOS": return 2
-                        if a in ("PADRE","MADRE"): return 1
-                        return 0
-
-                    acomp_n = _acomp_plural_count(vals)
-                    quien_txt = "QUIENES SERÁN RESPONSABLES" if acomp_n >= 2 else "QUIEN SERÁ RESPONSABLE"
-
-                    comp_tx = f"EN COMPAÑÍA DE {posesivo} {rol_txt}"
-                    if acomp_nom:
-                        comp_tx += f" {acomp_nom}"
-                    if acomp_doc:
-                        comp_tx += f", CON {acomp_doc}"
-
-                    obs_tx = (
-                        f"SE DEJA CONSTANCIA QUE {ac['ART']} {ac['SUST']} {ac['VERB_VIAJAR']} {comp_tx}; "
-                        f"{quien_txt} DEL CUIDADO DE {ac['ART']} {ac['SUST']} DURANTE SU ESTADÍA EN LA CIUDAD."
-                    )
+                obs_tx = _obs_terceros_multiples(terceros_list, ac)
+            else:
+                # PADRE/MADRE/AMBOS
+                obs_tx = _obs_con_padres(vals, acomp_val, ac)
 
             ctx["OBS_TX"] = obs_tx
             
@@ -5451,27 +5728,8 @@ if modo == "➕ Nuevo permiso":
                 if ctx.get("OBS_TX") else ""
             )
 
-            # --- Tipos canónicos para que la PLANTILLA decida el texto correcto ---
-            ctx["PADRE_DOC_TIPO_CAN"] = canon_doc(ctx.get("PADRE_DOC_TIPO") or vals.get("padre_doc_tipo"))
-            ctx["MADRE_DOC_TIPO_CAN"] = canon_doc(ctx.get("MADRE_DOC_TIPO") or vals.get("madre_doc_tipo"))
-            ctx["MENOR_DOC_TIPO_CAN"] = canon_doc(ctx.get("MENOR_DOC_TIPO") or vals.get("menor_doc_tipo"))
-
-            # Texto para PADRE/MADRE resuelto (usa el helper global _doc_tx)
-            ctx["PADRE_DOC_TEXTO"] = _doc_tx(
-                ctx.get("PADRE_DOC_TIPO") or vals.get("padre_doc_tipo"),
-                ctx.get("PADRE_DOC_NUM")  or (vals.get("padre_doc_num") or vals.get("padre_dni",""))
-            )
-            ctx["MADRE_DOC_TEXTO"] = _doc_tx(
-                ctx.get("MADRE_DOC_TIPO") or vals.get("madre_doc_tipo"),
-                ctx.get("MADRE_DOC_NUM")  or (vals.get("madre_doc_num") or vals.get("madre_dni",""))
-            )
-
             # (opcional) Compatibilidad con plantillas viejas:
             ctx["HIJO_S"] = "HIJOS(AS)" if ctx["MENORES_COUNT"] and ctx["MENORES_COUNT"] > 1 else "HIJO(A)"
-           
-            # Firmas (línea inferior sin "CON")
-            ctx["PADRE_DOC_FIRMA"] = _doc_firma_adulto(vals.get("padre_doc_tipo"), vals.get("padre_doc_num"))
-            ctx["MADRE_DOC_FIRMA"] = _doc_firma_adulto(vals.get("madre_doc_tipo"), vals.get("madre_doc_num"))
 
             ctx.update(concordancias_plural(ctx.get("ACOMP_COUNT", 0)))
             ctx.update(genero_menor_vars(ctx.get("SEXO_MENOR")))
@@ -5497,8 +5755,7 @@ if modo == "➕ Nuevo permiso":
 
             try:
                 # 🔥 VALIDACIÓN 1: Verificar espacio en disco ANTES de guardar
-                disco_stats = shutil.disk_usage(emitidos_dir)
-                disco_libre_mb = disco_stats.free / (1024 * 1024)
+                disco_libre_mb = _disco_libre_mb(emitidos_dir)
     
                 if disco_libre_mb < 100:  # Menos de 100 MB libres
                     st.error(f"⚠️ **Espacio en disco insuficiente**")
@@ -5515,18 +5772,24 @@ if modo == "➕ Nuevo permiso":
                     f"Permiso_{numero_permiso:04d}_NSC-{anio_actual}.docx"
                 )
     
-                with open(archivo_salida, "wb") as f:
-                    f.write(content)
-    
-                # 🔥 VALIDACIÓN 3: Verificar que se guardó correctamente
-                if not os.path.exists(archivo_salida):
-                    raise IOError("El archivo no se creó en el disco")
-    
-                tamanio_kb = os.path.getsize(archivo_salida) / 1024
+                # Se escribe a un .tmp y se renombra al final: un archivo parcial nunca queda con el nombre definitivo
+                archivo_tmp = archivo_salida + ".tmp"
+                fd = os.open(archivo_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+                try:
+                    pendiente = memoryview(content)
+                    while pendiente:
+                        pendiente = pendiente[os.write(fd, pendiente):]
+                    os.fsync(fd)  # en disco antes de registrarlo en la BD
+
+                    # 🔥 VALIDACIÓN 3: Verificar que se guardó correctamente
+                    tamanio_kb = os.fstat(fd).st_size / 1024
+                finally:
+                    os.close(fd)
     
                 if tamanio_kb < 5:  # Archivos DOCX nunca son menores a 5 KB
-                    os.remove(archivo_salida)  # Elimina el archivo corrupto
                     raise IOError(f"El archivo generado está corrupto (solo {tamanio_kb:.1f} KB)")
+
+                os.replace(archivo_tmp, archivo_salida)
     
                 # ✅ TODO OK: Log exitoso
                 logger.info(f"✅ Archivo guardado: Permiso_{numero_permiso:04d}_NSC-{anio_actual}.docx ({tamanio_kb:.1f} KB)")
@@ -5537,10 +5800,10 @@ if modo == "➕ Nuevo permiso":
                 st.error(f"❌ No se pudo guardar el documento: {e}")
     
                 # Limpia archivo parcial si existe
-                if 'archivo_salida' in locals() and os.path.exists(archivo_salida):
+                if 'archivo_tmp' in locals() and os.path.exists(archivo_tmp):
                     try:
-                        os.remove(archivo_salida)
-                        logger.info(f"🗑️ Archivo corrupto eliminado: {archivo_salida}")
+                        os.remove(archivo_tmp)
+                        logger.info(f"🗑️ Archivo corrupto eliminado: {archivo_tmp}")
                     except:
                         pass
     
@@ -5555,44 +5818,8 @@ if modo == "➕ Nuevo permiso":
             vias_tx = " Y/O ".join(vals["vias"]).upper() if vals["vias"] else ""
             firma_quien_tx = (vals["quien_firma"] if vals["tipo_viaje"]=="NACIONAL" else vals["quien_firma_int"]) or ""
             
-            # --- Tomar hermanos de la UI y serializar a JSON para BD (SOLO LECTURA; sin inputs aquí) ---
-            hermanos_list = []
-            for i, _ in enumerate(st.session_state.get("hermanos", [])):
-                h_nom = s(st.session_state.get(f"hermano_nombre_{i}", ""))
-                if not h_nom:
-                    continue
-
-                h_sex  = (st.session_state.get(f"hermano_sexo_{i}", "") or "").upper()
-                h_tipo = (st.session_state.get(f"hermano_doc_tipo_{i}", "DNI") or "DNI").upper()
-                h_num  = s(st.session_state.get(f"hermano_doc_num_{i}", ""))
-                h_fnac = st.session_state.get(f"hermano_fnac_{i}", None)
-
-                # Normaliza fecha a ISO
-                if h_fnac:
-                    try:
-                        if hasattr(h_fnac, "strftime"):
-                            fnac_iso_h = h_fnac.strftime("%Y-%m-%d")
-                        else:
-                            dtmp = parse_iso(h_fnac)
-                            fnac_iso_h = dtmp.strftime("%Y-%m-%d") if dtmp else ""
-                    except Exception:
-                        fnac_iso_h = ""
-                else:       
-                    fnac_iso_h = ""
-
-                # Solo leer nacionalidad (no crear inputs aquí)
-                h_nac = s(st.session_state.get(f"hermano_nacionalidad_{i}", "")) if h_tipo in ("PASAPORTE", "DNI EXTRANJERO") else ""
-
-                hermanos_list.append({
-                    "nombre":       h_nom,
-                    "sexo":         h_sex,
-                    "doc_tipo":     h_tipo,
-                    "doc_num":      h_num,
-                    "fnac":         fnac_iso_h,
-                    "nacionalidad": h_nac,   # siempre definido ("" si no aplica)
-                })
-
-            hermanos_json = json.dumps(hermanos_list, ensure_ascii=False)
+            # --- Hermanos (ya leídos arriba con _leer_hermanos_ui) serializados a JSON para BD ---
+            hermanos_json = _json_col(hermanos_list)
 
             # --- Recepción múltiple: tomar de la UI y serializar a JSON para BD ---
             viaja_solo_calc = s(vals.get("acompanante","")).upper() in ["SOLO","SOLO(A)/SOLOS(AS)"]
@@ -5612,7 +5839,7 @@ if modo == "➕ Nuevo permiso":
                         "pais": doc_pais
                     })
 
-            rec_list_json = json.dumps(recep_items, ensure_ascii=False)
+            rec_list_json = _json_col(recep_items)
             recibe_si_val = "SI" if (viaja_solo_calc and len(recep_items) > 0) else "NO"
 
             rec0_nombre = recep_items[0]["nombre"]   if recep_items else ""
@@ -5620,22 +5847,8 @@ if modo == "➕ Nuevo permiso":
             rec0_num    = recep_items[0]["num"]  if recep_items else ""
             rec0_pais   = recep_items[0]["pais"] if recep_items else ""
 
-             # --- Serializar TERCEROS a JSON para guardar en BD ---
-            terceros_list = []
-            if s(vals.get("acompanante","")).upper() == "TERCERO":
-                for i in range(len(st.session_state.get("terceros", []))):
-                    rol = s(st.session_state.get(f"tercero_rol_{i}", "")).upper()
-                    nombre = s(st.session_state.get(f"tercero_nombre_{i}", "")).upper()
-                    dni = s(st.session_state.get(f"tercero_dni_{i}", ""))
-        
-                    if nombre:  # Solo guardar si tiene nombre
-                        terceros_list.append({
-                            "rol": rol,
-                            "nombre": nombre,
-                            "dni": dni
-                        })
-
-            terceros_json = json.dumps(terceros_list, ensure_ascii=False)
+            # --- Serializar TERCEROS (ya leídos arriba con _leer_terceros_ui) a JSON para BD ---
+            terceros_json = _json_col(terceros_list)
             
             save_permiso_registro({
                 "anio": anio_actual,
@@ -6016,16 +6229,10 @@ if modo == "✏️ Editar / Re-generar":
             for key in ubigeo_keys_all:
                 st.session_state.pop(key, None)
 
-            # 🔥 PASO 2: Limpiar cachés de provincias/distritos
-            keys_to_remove = [k for k in list(st.session_state.keys()) 
-                              if k.startswith("provincias_") or k.startswith("distritos_")]
-            for k in keys_to_remove:
-                st.session_state.pop(k, None)
-
-            # 🔥 PASO 3: Cargar precarga general
+            # 🔥 PASO 2: Cargar precarga general
             _push_precarga_to_state(precarga)
     
-            # 🔥 PASO 4: PRE-CARGAR UBIGEO **ANTES** de que se rendericen los selectores
+            # 🔥 PASO 3: PRE-CARGAR UBIGEO **ANTES** de que se rendericen los selectores
             # Estos valores se usan para calcular el index correcto en los selectbox
             st.session_state["padre_departamento"] = precarga.get("padre_departamento", "")
             st.session_state["padre_provincia"] = precarga.get("padre_provincia", "")
@@ -6035,35 +6242,6 @@ if modo == "✏️ Editar / Re-generar":
             st.session_state["madre_provincia"] = precarga.get("madre_provincia", "")
             st.session_state["madre_distrito"] = precarga.get("madre_distrito", "")
     
-            # 🔥 PASO 5: Pre-cargar los cachés de provincias/distritos para que existan al renderizar
-            padre_dep = precarga.get("padre_departamento", "")
-            if padre_dep:
-                # Fuerza carga del caché de provincias del padre
-                cache_key_p = f"provincias_{padre_dep}"
-                if cache_key_p not in st.session_state:
-                    st.session_state[cache_key_p] = obtener_provincias(padre_dep)
-        
-                padre_prov = precarga.get("padre_provincia", "")
-                if padre_prov:
-                    # Fuerza carga del caché de distritos del padre
-                    cache_key_d = f"distritos_{padre_dep}_{padre_prov}"
-                    if cache_key_d not in st.session_state:
-                        st.session_state[cache_key_d] = obtener_distritos(padre_dep, padre_prov)
-    
-            madre_dep = precarga.get("madre_departamento", "")
-            if madre_dep:
-                # Fuerza carga del caché de provincias de la madre
-                cache_key_p = f"provincias_{madre_dep}"
-                if cache_key_p not in st.session_state:
-                    st.session_state[cache_key_p] = obtener_provincias(madre_dep)
-        
-                madre_prov = precarga.get("madre_provincia", "")
-                if madre_prov:
-                    # Fuerza carga del caché de distritos de la madre
-                    cache_key_d = f"distritos_{madre_dep}_{madre_prov}"
-                    if cache_key_d not in st.session_state:
-                        st.session_state[cache_key_d] = obtener_distritos(madre_dep, madre_prov)
-    
             st.session_state.modo_edicion = True
             st.session_state.pid_editing = int(pid)
             st.session_state["rol_acompanante"] = precarga.get("rol_acompanante","")
@@ -6073,7 +6251,7 @@ if modo == "✏️ Editar / Re-generar":
             st.session_state.pop("_prefill_recep_pid", None)
             st.session_state.pop("_prefill_terceros_pid", None)
     
-            # 🔥 PASO 6: FORZAR RERUN para que los selectores se redibujen con los nuevos valores
+            # 🔥 PASO 4: FORZAR RERUN para que los selectores se redibujen con los nuevos valores
             st.rerun()
             
         # ---------- PRE-CARGA HERMANOS (ÚNICO BLOQUE) ----------
@@ -6239,59 +6417,13 @@ if modo == "✏️ Editar / Re-generar":
 
                                 # 3) flags y json
                                 recibe_si_val = "SI" if rec_items else "NO"
-                                rec_list_json = json.dumps(rec_items, ensure_ascii=False)
+                                rec_list_json = _json_col(rec_items)
 
                                 # --- Hermanos desde la UI (NECESARIO para data_upd["hermanos_json"]) ---
-                                hermanos_list = []
-                                for i, _ in enumerate(st.session_state.get("hermanos", [])):
-                                    h_nom = s(st.session_state.get(f"hermano_nombre_{i}", ""))
-                                    if not h_nom:
-                                        continue
-
-                                    h_sex  = (st.session_state.get(f"hermano_sexo_{i}", "") or "").upper()
-                                    h_tipo = (st.session_state.get(f"hermano_doc_tipo_{i}", "DNI") or "DNI").upper()
-                                    h_num  = s(st.session_state.get(f"hermano_doc_num_{i}", ""))
-                                    h_fnac = st.session_state.get(f"hermano_fnac_{i}", None)
-
-                                    # Normaliza fecha a ISO
-                                    if h_fnac:
-                                        try:
-                                            if hasattr(h_fnac, "strftime"):
-                                                fnac_iso_h = h_fnac.strftime("%Y-%m-%d")
-                                            else:
-                                                dtmp = parse_iso(h_fnac)
-                                                fnac_iso_h = dtmp.strftime("%Y-%m-%d") if dtmp else ""
-                                        except Exception:
-                                            fnac_iso_h = ""
-                                    else:
-                                        fnac_iso_h = ""
-
-                                    # 🚫 NUNCA crear inputs aquí. Solo LEER lo que ya existe en session_state:
-                                    h_nac = s(st.session_state.get(f"hermano_nacionalidad_{i}", "")) if h_tipo in ("PASAPORTE", "DNI EXTRANJERO") else ""
-
-                                    hermanos_list.append({
-                                        "nombre":       h_nom,
-                                        "sexo":         h_sex,
-                                        "doc_tipo":     h_tipo,
-                                        "doc_num":      h_num,
-                                        "fnac":         fnac_iso_h,
-                                        "nacionalidad": h_nac,
-                                    })
+                                hermanos_list, _ = _leer_hermanos_ui()
 
                                 # 🆕 NUEVO: Terceros desde la UI (para guardar en BD al editar)
-                                terceros_list = []
-                                if s(vals.get("acompanante","")).upper() == "TERCERO":
-                                    for i in range(len(st.session_state.get("terceros", []))):
-                                        rol = s(st.session_state.get(f"tercero_rol_{i}", "")).upper()
-                                        nombre = s(st.session_state.get(f"tercero_nombre_{i}", "")).upper()
-                                        dni = s(st.session_state.get(f"tercero_dni_{i}", ""))
-        
-                                        if nombre:  # Solo guardar si tiene nombre
-                                            terceros_list.append({
-                                                "rol": rol,
-                                                "nombre": nombre,
-                                                "dni": dni
-                                            })
+                                terceros_list = _leer_terceros_ui() if s(vals.get("acompanante","")).upper() == "TERCERO" else []
 
                                 # ===== AHORA SÍ: construir data_upd de una vez (sin .update antes) =====
                                 data_upd = {
@@ -6369,8 +6501,8 @@ if modo == "✏️ Editar / Re-generar":
                                 }
 
                                 # Si ya calculaste 'hermanos_list' antes, añádelo:
-                                data_upd["hermanos_json"] = json.dumps(hermanos_list, ensure_ascii=False)
-                                data_upd["terceros_json"] = json.dumps(terceros_list, ensure_ascii=False)  
+                                data_upd["hermanos_json"] = _json_col(hermanos_list)
+                                data_upd["terceros_json"] = _json_col(terceros_list)  
 
                                 # 5) guardar
                                 update_permiso(int(pid), data_upd)
@@ -6420,26 +6552,7 @@ if modo == "✏️ Editar / Re-generar":
                         perm_act["acomp_count"] = acomp_count_eff
 
                         # ==== HERMANOS DESDE LA UI (para regenerar) ====
-                        perm_act["hermanos"] = []
-                        for i in range(len(st.session_state.get("hermanos", []))):
-                            h_nom = s(st.session_state.get(f"hermano_nombre_{i}", ""))
-                            if not h_nom:
-                                continue
-                            h_sex = (st.session_state.get(f"hermano_sexo_{i}", "") or "").upper()
-                            h_tipo = (st.session_state.get(f"hermano_doc_tipo_{i}", "DNI") or "DNI").upper()
-                            h_num = s(st.session_state.get(f"hermano_doc_num_{i}", ""))
-                            h_fnac = st.session_state.get(f"hermano_fnac_{i}", None)
-                            h_nac = s(st.session_state.get(f"hermano_nacionalidad_{i}", "")) if h_tipo in ("PASAPORTE","DNI EXTRANJERO") else ""
-
-                            perm_act["hermanos"].append({
-                                "nombre": h_nom,
-                                "sexo": h_sex,
-                                "doc_tipo": h_tipo,
-                                "doc_num": h_num,
-                                "fnac": h_fnac,
-                                "nacionalidad": h_nac,   # ← viaja a la regeneración
-                            })
-                            # ==== FIN HERMANOS ====
+                        perm_act["hermanos"], _ = _leer_hermanos_ui()
                   
                         # justo antes del perm_act.update(...)
                         viaja_solo_calc = s(vals.get("acompanante","")).upper() in ["SOLO","SOLO(A)/SOLOS(AS)"]
@@ -6508,9 +6621,8 @@ if modo == "✏️ Editar / Re-generar":
                         
                                                 
                         plantilla_regen = PLANTILLA_DEFAULT
-                        tmp_custom = os.path.join(BASE_DIR,"_tmp_plantilla.docx")
-                        if os.path.exists(tmp_custom):
-                            plantilla_regen = tmp_custom
+                        if os.path.exists(_TMP_PLANTILLA):
+                            plantilla_regen = _TMP_PLANTILLA
 
                         try:
                             nuevo_archivo = regenerate_docx_for_permiso(perm_act, plantilla_regen)
@@ -6947,9 +7059,10 @@ if modo == "🤖 Asistente IA":
     if st.session_state.ia_chat_history:
         last_msg = st.session_state.ia_chat_history[-1]
         if last_msg.get("role") == "assistant" and last_msg.get("rows"):
+            df_rows = pd.DataFrame.from_records(last_msg["rows"])  # una sola vez para tabla y gráficos
             with st.expander("📋 Ver tabla de resultados", expanded=False):
-                _show_rows_table(last_msg["rows"])
-            _show_chart_if_applicable(last_msg["rows"], last_msg["content"])
+                _show_rows_table(last_msg["rows"], df_rows)
+            _show_chart_if_applicable(last_msg["rows"], last_msg["content"], df_rows)
     
     # ══════════════════════════════════════════════════════════════════
     # 🎯 INPUT FIJO ABAJO (usando st.chat_input nativo)